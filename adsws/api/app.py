@@ -5,8 +5,12 @@ from flask.ext.restful import Api
 from flask.ext.cors import CORS
 from flask import jsonify
 
-from views import StatusView, ProtectedView, UserResolver
-from discoverer import discover
+from views import StatusView, ProtectedView, UserResolver, ConnectionPoolsView, \
+    DatabasePoolsView, CircuitBreakersView, HedgingView, ResponseCacheView, \
+    CoalescingView
+from discoverer import discover, RouteRefresher
+from compression import compress_response
+from ..startup import profile
 
 
 def create_app(**kwargs_config):
@@ -34,7 +38,25 @@ def create_app(**kwargs_config):
     api.add_resource(StatusView, '/status')
     api.add_resource(ProtectedView, '/protected')
     api.add_resource(UserResolver, '/user/<string:identifier>')
-    discover(app)  # Incorporate local and remote applications into this one
+    api.add_resource(ConnectionPoolsView, '/status/pools')
+    api.add_resource(DatabasePoolsView, '/status/db')
+    api.add_resource(CircuitBreakersView, '/status/breakers')
+    api.add_resource(HedgingView, '/status/hedging')
+    api.add_resource(ResponseCacheView, '/status/cache')
+    api.add_resource(CoalescingView, '/status/coalescing')
+    with profile.phase('discover'):
+        discover(app)  # Incorporate local and remote applications into this one
+
+    # Pick up the changes of the remote services' routes; the thread is
+    # started by the process serving the requests (after any fork)
+    if app.config.get('WEBSERVICES_REFRESH_INTERVAL'):
+        app.extensions['route_refresher'] = RouteRefresher(
+            app, app.config['WEBSERVICES_REFRESH_INTERVAL']
+        )
+        app.before_request(app.extensions['route_refresher'].start)
+
+    # Compress the responses the client accepts compressed
+    app.after_request(compress_response)
 
     # Register custom error handlers
     if not app.config.get('DEBUG'):
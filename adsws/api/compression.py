@@ -0,0 +1,97 @@
+"""
+Compression of the responses of the API
+
+An after_request stage compresses the bodies the client accepts compressed
+(Accept-Encoding), for the content types and sizes configured by
+RESPONSE_COMPRESSION_*. Bodies already having a Content-Encoding (e.g. the
+compressed body of a remote service, forwarded as it is to the clients
+accepting its encoding) are left as they are.
+
+brotli is optional: without the module, only gzip is offered.
+"""
+
+import zlib
+
+from flask import request, current_app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def available_encodings(encodings):
+    """
+    The configured encodings this process can produce, in order of
+    preference
+    """
+    return [e for e in encodings if e == 'gzip' or (e == 'br' and brotli is not None)]
+
+
+def compressor(encoding, level):
+    """
+    Returns a (compress, flush) pair of functions for the encoding
+    """
+    if encoding == 'br':
+        # brotli levels go from 0 to 11, zlib ones from 1 to 9
+        c = brotli.Compressor(quality=min(11, level))
+        return c.process, c.finish
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress, c.flush
+
+
+def iter_compressed(chunks, encoding, level):
+    compress, flush = compressor(encoding, level)
+    for chunk in chunks:
+        data = compress(chunk)
+        if data:
+            yield data
+    yield flush()
+
+
+def compress_response(response):
+    """
+    after_request hook compressing the response if the client accepts it,
+    it is worth it (RESPONSE_COMPRESSION_MIMETYPES,
+    RESPONSE_COMPRESSION_MIN_SIZE) and nobody compressed it yet
+    """
+    config = current_app.config
+    if not config.get('RESPONSE_COMPRESSION', False):
+        return response
+    if response.status_code < 200 or response.status_code in (204, 304) \
+            or request.method == 'HEAD' \
+            or 'Content-Encoding' in response.headers \
+            or response.mimetype not in config.get('RESPONSE_COMPRESSION_MIMETYPES', []) \
+            or 'no-transform' in response.headers.get('Cache-Control', ''):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encodings = available_encodings(config.get('RESPONSE_COMPRESSION_ENCODINGS', ['br', 'gzip']))
+    encoding = request.accept_encodings.best_match(encodings)
+    if encoding is None:
+        return response
+    level = config.get('RESPONSE_COMPRESSION_LEVEL', 6)
+    min_size = config.get('RESPONSE_COMPRESSION_MIN_SIZE', 1024)
+
+    if response.is_streamed:
+        length = response.content_length
+        if length is not None and length < min_size:
+            return response
+        response.response = iter_compressed(response.iter_encoded(), encoding, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        compress, flush = compressor(encoding, level)
+        compressed = compress(data) + flush()
+        if len(compressed) >= len(data):
+            return response
+        response.set_data(compressed)
+
+    response.headers['Content-Encoding'] = encoding
+    # the compressed body is not byte-identical to the upstream one anymore
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -2,6 +2,24 @@ LOG_LEVEL = 30 # To be deprecated when all microservices use ADSFlask
 LOGGING_LEVEL = "INFO"
 LOG_STDOUT = True
 DEFAULT_REQUEST_TIMEOUT = 60 # seconds
+# Per route timeouts of remote services, unless they advertise a 'timeout' in their
+# resources: `factor` x the `percentile` latency of the route, within [`minimum`,
+# `maximum`] seconds, after `min_samples` requests (DEFAULT_REQUEST_TIMEOUT before
+# that); None disables it, e.g. {'factor': 3, 'percentile': 0.99, 'minimum': 2,
+# 'maximum': 60, 'min_samples': 100}
+REMOTE_PROXY_ADAPTIVE_TIMEOUT = None
+REMOTE_PROXY_ENGINE = 'sync' # 'gevent': proxy remote services cooperatively (requires gevent workers, e.g. gunicorn -k gevent)
+REMOTE_PROXY_MAX_INFLIGHT = 5000 # gevent engine: max concurrent upstream calls per worker
+# Circuit breaker per remote service (None disables it): once `failure_ratio` of
+# at least `min_calls` calls failed within `window` seconds, the service gets 503
+# right away for `open_seconds`, then one probe request decides whether to resume
+REMOTE_PROXY_CIRCUIT_BREAKER = {'window': 30, 'min_calls': 20, 'failure_ratio': 0.5, 'open_seconds': 15}
+REMOTE_PROXY_CIRCUIT_BREAKER_ERROR_STATUSES = [502, 503, 504] # upstream statuses counted as failures
+# Hedged GETs to consul services of these deploy paths (e.g. ['/search']): a GET not
+# answered within the `percentile` latency of its route (after `min_samples` requests)
+# is sent to another instance too, for at most `budget` extra requests per request
+REMOTE_PROXY_HEDGE_DEPLOY_PATHS = []
+REMOTE_PROXY_HEDGING = {'percentile': 0.95, 'budget': 0.05, 'burst': 10, 'min_samples': 100}
 SECURITY_REGISTER_BLUEPRINT = False
 EXTENSIONS = ['adsws.ext.menu',
               'adsws.ext.sqlalchemy',
@@ -37,8 +55,41 @@ WEBSERVICES = {
 # when defined, the remote resources will be cached (to be reused)
 # in case when the service is temporarily down during a worker startup
 # WEBSERVICES_DISCOVERY_CACHE_DIR='/tmp'
+WEBSERVICES_DISCOVERY_WORKERS = 16 # remote services queried concurrently at startup
+WEBSERVICES_DISCOVERY_DEADLINE = 15 # seconds; later services fall back to their cached resources
+# resources of the remote services, (re)generated out of band by
+# `manage.py api discovery_snapshot` and loaded by the workers at startup
+# (relative to the instance folder); the services missing from it are
+# queried. Set to None to always query the services
+WEBSERVICES_DISCOVERY_SNAPSHOT = 'discovery_snapshot.json'
+# when defined, the remote services are queried again every N seconds (in a
+# background thread of each worker, started by its requests) and the
+# changes of their routes are applied without a restart
+WEBSERVICES_REFRESH_INTERVAL = None
 
 API_PROXYVIEW_HEADERS = {'Cache-Control': 'public, max-age=600'}
 REMOTE_PROXY_ALLOWED_HEADERS = ['Content-Type', 'Content-Disposition', 'Set-Cookie'] # Set-Cookie required for affinity
+REMOTE_PROXY_WEAK_ETAG = False # add a weak ETag to buffered GET responses without one (304s then spare the body, not the upstream call)
+RESPONSE_COMPRESSION = True # compress the responses (gzip, or brotli if installed) for the clients accepting it
+RESPONSE_COMPRESSION_ENCODINGS = ['br', 'gzip'] # in order of preference
+RESPONSE_COMPRESSION_MIMETYPES = ['application/json', 'text/plain', 'text/html', 'text/csv', 'text/xml', 'application/xml', 'application/x-bibtex']
+RESPONSE_COMPRESSION_MIN_SIZE = 1024 # bytes; smaller bodies are sent as they are
+RESPONSE_COMPRESSION_LEVEL = 6
+REMOTE_PROXY_STREAM_DEPLOY_PATHS = [] # deploy paths whose responses are always streamed (e.g. ['/search'] for solr exports)
+REMOTE_PROXY_STREAM_MIN_CONTENT_LENGTH = None # bytes; larger responses (or of unknown length) are streamed, None: never
+REMOTE_PROXY_STREAM_CHUNK_SIZE = 65536 # bytes
+REMOTE_PROXY_STREAM_REQUEST_MIN_CONTENT_LENGTH = None # bytes; larger request bodies are streamed upstream, None: never
+# Cache of the GET responses of the deploy paths in REMOTE_PROXY_CACHE_DEPLOY_PATHS
+# (None disables it): per worker LRU of `size` entries/`max_bytes`, optionally shared
+# through redis (`redis_url`); upstream Cache-Control/ETag are honoured, `default_ttl`
+# applies to responses without max-age, stale entries with an ETag are revalidated
+# during `stale_ttl` seconds
+REMOTE_PROXY_CACHE = None # e.g. {'size': 1000, 'max_bytes': 67108864, 'max_entry_bytes': 1048576, 'default_ttl': 60, 'stale_ttl': 600, 'redis_url': None}
+# deploy path: vary set, i.e. what besides route and query string tells responses
+# apart: 'user', 'client', 'scopes' or request header names, e.g. {'/resolver': []};
+# without 'user', responses to requests with Authorization are only cached if they
+# are public or have an s-maxage
+REMOTE_PROXY_CACHE_DEPLOY_PATHS = {}
+REMOTE_PROXY_COALESCE_DEPLOY_PATHS = [] # deploy paths whose identical concurrent GETs share one upstream call (responses must not depend on the user); their responses are buffered, never streamed (REMOTE_PROXY_STREAM_* do not apply)
 
 AFFINITY_ENHANCED_ENDPOINTS = {"/search": "sroute",} # keys: deploy paths, value: cookie
@@ -1 +1,2 @@
-from utils import discover
\ No newline at end of file
+from utils import discover
+from refresh import RouteRefresher
\ No newline at end of file
@@ -64,6 +64,57 @@ def _build_updated_cookies(request, user_token, route, name):
     cookies_content = ImmutableTypeConversionDict(cookies)
     return cookies_header_content, cookies_content
 
+def _user_token():
+    """
+    Obtains the user token, giving priority to forwarded authorization field
+    (used when a microservice uses its own token). Returns the token and
+    whether it was a well formed bearer one.
+    """
+    user_token = request.headers.get('X-Forwarded-Authorization', None)
+    if user_token is None or user_token == u"-":
+        user_token = request.headers.get('Authorization', None)
+    if user_token and len(user_token) > 7: # This should be always true
+        return user_token[7:], True # Get rid of "Bearer:" or "Bearer "
+    return user_token, False
+
+def _apply_route(storage, route_redis_prefix, name):
+    """
+    Sets the cookie of the route assigned to the user in the request, and
+    returns the user token
+    """
+    user_token, bearer = _user_token()
+    if bearer:
+        route = _get_route(storage, route_redis_prefix, user_token)
+        cookies_header_content, cookies_content = _build_updated_cookies(request, user_token, route, name)
+        # Update request cookies (header and cookies attributes)
+        request.headers = Headers(request.headers)
+        request.headers.set('cookie', cookies_header_content)
+        request.cookies = cookies_content
+    return user_token
+
+def _store_route(storage, route_redis_prefix, name, user_token, r, route_redis_expiration_time):
+    """
+    If solr issued a set cookie in the response `r`, stores the route in
+    redis linked to the user token (and drops the cookie)
+    """
+    if type(r) is tuple and len(r) > 2:
+        response_headers = r[2]
+    elif hasattr(r, 'headers'):
+        response_headers = r.headers
+    else:
+        response_headers = None
+
+    if user_token and response_headers:
+        set_cookie = response_headers.pop('Set-Cookie', None)
+        if set_cookie:
+            cookie = Cookie.SimpleCookie()
+            cookie.load(set_cookie.encode("utf8"))
+            route = cookie.get(name, None)
+            if route:
+                _set_route(storage, route_redis_prefix, user_token, route.value, route_redis_expiration_time)
+
+ROUTE_REDIS_EXPIRATION_TIME = 86400 # 1 day
+
 def affinity_decorator(storage, name="sroute"):
     """
     Assign a cookie that will be used by solr ingress to send request to
@@ -73,42 +124,13 @@ def affinity_decorator(storage, name="sroute"):
     The storage should be a redis connection.
     """
     route_redis_prefix="token:{}:".format(name)
-    route_redis_expiration_time=86400 # 1 day
 
     def real_affinity_decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            # Obtain user token, giving priority to forwarded authorization field (used when a microservice uses its own token)
-            user_token = request.headers.get('X-Forwarded-Authorization', None)
-            if user_token is None or user_token == u"-":
-                user_token = request.headers.get('Authorization', None)
-            if user_token and len(user_token) > 7: # This should be always true
-                user_token = user_token[7:] # Get rid of "Bearer:" or "Bearer "
-                route = _get_route(storage, route_redis_prefix, user_token)
-                cookies_header_content, cookies_content = _build_updated_cookies(request, user_token, route, name)
-                # Update request cookies (header and cookies attributes)
-                request.headers = Headers(request.headers)
-                request.headers.set('cookie', cookies_header_content)
-                request.cookies = cookies_content
-
+            user_token = _apply_route(storage, route_redis_prefix, name)
             r = f(*args, **kwargs)
-            if type(r) is tuple and len(r) > 2:
-                response_headers = r[2]
-            elif hasattr(r, 'headers'):
-                response_headers = r.headers
-            else:
-                response_headers = None
-
-            if user_token and response_headers:
-                set_cookie = response_headers.pop('Set-Cookie', None)
-                if set_cookie:
-                    # If solr issued a set cookie, store the value in redis linked to the user token
-                    cookie = Cookie.SimpleCookie()
-                    cookie.load(set_cookie.encode("utf8"))
-                    route = cookie.get(name, None)
-                    if route:
-                        _set_route(storage, route_redis_prefix, user_token, route.value, route_redis_expiration_time)
+            _store_route(storage, route_redis_prefix, name, user_token, r, ROUTE_REDIS_EXPIRATION_TIME)
             return r
         return decorated_function
     return real_affinity_decorator
-
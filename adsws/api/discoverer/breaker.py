@@ -0,0 +1,167 @@
+"""
+Circuit breakers of the remote services
+
+A service that keeps failing (connection errors, timeouts, 5xx gateway
+statuses) gets its circuit opened: ProxyView answers 503 right away instead
+of having every request wait for the timeout. After a while one request is
+let through (half-open) to probe whether the service recovered.
+
+Every call let through holds a Ticket: calls started before the circuit
+opened (which may finish up to a timeout later) are not taken for the
+probe, and are not counted.
+"""
+
+import time
+import threading
+from collections import deque, namedtuple
+
+
+class Ticket(namedtuple('Ticket', ['generation', 'probe'])):
+    """
+    Call let through by the breaker: the generation of the circuit (bumped
+    every time it opens) and whether the call is the half-open probe
+    """
+    __slots__ = ()
+
+
+class CircuitBreaker(object):
+    """
+    Breaker of one service; failures are counted in per-second buckets over
+    a rolling window of `window` seconds
+
+    :param window: seconds over which the calls are counted
+    :param min_calls: calls needed in the window before the circuit can open
+    :param failure_ratio: ratio of failed calls that opens the circuit
+    :param open_seconds: seconds before a probe is let through
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, window=30, min_calls=20, failure_ratio=0.5,
+                 open_seconds=15):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.generation = 0
+        self._probe = None
+        self._probe_started = None
+        self._buckets = deque()  # [second, calls, failures]
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Returns the Ticket of a call allowed to go through, or None (in the
+        half-open state, only one call at a time goes through: the probe)
+        """
+        now = time.time()
+        with self._lock:
+            if self.state == self.CLOSED:
+                return Ticket(self.generation, False)
+            if self.state == self.OPEN:
+                if now < self.opened_at + self.open_seconds:
+                    return None
+                self.state = self.HALF_OPEN
+            elif self._probe_started is not None \
+                    and now < self._probe_started + self.open_seconds:
+                # a probe is already in flight
+                return None
+            self._probe = Ticket(self.generation, True)
+            self._probe_started = now
+            return self._probe
+
+    def record(self, success, ticket=None):
+        """
+        Records the outcome of a call
+
+        :param ticket: the Ticket given by allow() to the call; None stands
+            for a call of the current generation, not the probe
+        """
+        now = time.time()
+        with self._lock:
+            if ticket is not None and ticket.generation != self.generation:
+                # started before the circuit opened
+                return
+            if self.state == self.HALF_OPEN:
+                if ticket is None or ticket is not self._probe:
+                    return
+                self._probe = self._probe_started = None
+                if success:
+                    self.state = self.CLOSED
+                    self.opened_at = None
+                    self._buckets.clear()
+                else:
+                    self._open(now)
+                return
+            if self.state == self.OPEN:
+                return
+
+            second = int(now)
+            if self._buckets and self._buckets[-1][0] == second:
+                bucket = self._buckets[-1]
+            else:
+                bucket = [second, 0, 0]
+                self._buckets.append(bucket)
+            bucket[1] += 1
+            if not success:
+                bucket[2] += 1
+
+            calls, failures = self._counts(now)
+            if calls >= self.min_calls \
+                    and failures >= calls * self.failure_ratio:
+                self._open(now)
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.generation += 1
+
+    def _counts(self, now):
+        while self._buckets and self._buckets[0][0] <= now - self.window:
+            self._buckets.popleft()
+        calls = sum(b[1] for b in self._buckets)
+        failures = sum(b[2] for b in self._buckets)
+        return calls, failures
+
+    def status(self):
+        with self._lock:
+            calls, failures = self._counts(time.time())
+            return {
+                'state': self.state,
+                'calls': calls,
+                'failures': failures,
+                'opened_at': self.opened_at,
+            }
+
+
+class BreakerRegistry(object):
+    """
+    Process-wide circuit breakers, keyed by service_uri
+    """
+
+    def __init__(self):
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, service_uri, **kwargs):
+        with self._lock:
+            if service_uri not in self._breakers:
+                self._breakers[service_uri] = CircuitBreaker(service_uri,
+                                                             **kwargs)
+            return self._breakers[service_uri]
+
+    def status(self):
+        with self._lock:
+            breakers = self._breakers.values()
+        return dict((b.name, b.status()) for b in breakers)
+
+    def clear(self):
+        with self._lock:
+            self._breakers.clear()
+
+
+breakers = BreakerRegistry()
@@ -0,0 +1,349 @@
+"""
+Cache of the responses of the remote services
+
+Cacheable GET responses (see cache_ttl) are kept in a per process LRU,
+bounded in entries and in bytes, and optionally in redis so that all the
+workers share them. Entries are keyed by route, query string and a vary set
+(e.g. the user, when the response depends on it).
+
+Expired entries having an ETag are kept for a while (stale_ttl) so that
+they can be revalidated with If-None-Match instead of re-fetched.
+"""
+
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+import redis
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+
+def parse_cache_control(value):
+    """
+    'public, max-age=600' -> {'public': None, 'max-age': '600'}
+    """
+    directives = {}
+    for directive in (value or '').split(','):
+        name, _, argument = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def cache_ttl(status_code, headers, default_ttl=60, vary=(),
+              authorized=False):
+    """
+    Seconds a response may be served from the cache, or None if it must
+    not be cached:
+
+        - only 200 responses without Set-Cookie are cached
+        - no-store and private responses are not, no-cache ones only with
+          an ETag (and then always revalidated)
+        - the response to a request carrying Authorization (`authorized`)
+          is only shared if it is public or has an s-maxage (RFC 7234
+          section 3.2), or if the vary set of the route has the user
+        - s-maxage/max-age are honoured, default_ttl applies otherwise
+        - a Vary response header is only honoured if the request headers it
+          names are part of the vary set of the route
+    """
+    if status_code != 200 or 'Set-Cookie' in headers:
+        return None
+    vary_headers = [h.strip().lower() for h in headers.get('Vary', '').split(',') if h.strip()]
+    if '*' in vary_headers or not set(vary_headers) <= set(v.lower() for v in vary):
+        return None
+    directives = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-store' in directives or 'private' in directives:
+        return None
+    if authorized and 'user' not in vary \
+            and 'public' not in directives and 's-maxage' not in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0 if headers.get('ETag') else None
+    for name in ('s-maxage', 'max-age'):
+        if directives.get(name) is not None:
+            try:
+                return max(0, int(directives[name]))
+            except ValueError:
+                return None
+    return default_ttl
+
+
+class CachedResponse(namedtuple('CachedResponse', [
+        'status_code', 'headers', 'content', 'expires'])):
+    """
+    Response of a remote service; it quacks like the requests.Response the
+    proxy views deal with
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_response(cls, resp, ttl):
+        return cls(
+            status_code=resp.status_code,
+            headers=CaseInsensitiveDict(resp.headers),
+            content=resp.content,
+            expires=time.time() + ttl,
+        )
+
+    @classmethod
+    def read(cls, resp, decode_content=True):
+        """
+        Reads the body of an upstream response fetched lazily (stream=True)
+        and releases its connection; unless decode_content, a compressed
+        body is kept as it is, along with its Content-Encoding
+        """
+        headers = CaseInsensitiveDict(resp.headers)
+        try:
+            if decode_content:
+                content = resp.content
+                headers.pop('Content-Encoding', None)
+                headers.pop('Content-Length', None)
+            else:
+                content = resp.raw.read(decode_content=False)
+        finally:
+            resp.close()
+        return cls(status_code=resp.status_code, headers=headers,
+                   content=content, expires=0)
+
+    def close(self):
+        pass
+
+    @property
+    def etag(self):
+        return self.headers.get('ETag')
+
+    @property
+    def size(self):
+        return len(self.content) + sum(len(k) + len(v) for k, v in self.headers.items())
+
+    def is_fresh(self):
+        return self.expires > time.time()
+
+    def revalidated(self, headers):
+        """
+        Copy of the entry with the headers of a 304 Not Modified from the
+        remote service (its expiry is left to the caller)
+        """
+        updated = CaseInsensitiveDict(self.headers)
+        for name in ('Cache-Control', 'ETag', 'Expires', 'Date'):
+            if name in headers:
+                updated[name] = headers[name]
+        return self._replace(headers=updated)
+
+    def dumps(self):
+        return json.dumps([self.status_code, dict(self.headers), self.expires,
+                           self.content.encode('base64')])
+
+    @classmethod
+    def loads(cls, data):
+        status_code, headers, expires, content = json.loads(data)
+        return cls(status_code, CaseInsensitiveDict(headers),
+                   content.decode('base64'), expires)
+
+
+class RedisResponseStore(object):
+    """
+    Responses shared through redis; like the local cache, entries having an
+    ETag outlive their freshness by `stale_ttl` seconds.
+
+    Redis is an optimization: every error is logged and treated as a miss.
+    """
+
+    def __init__(self, connection, prefix='proxycache', stale_ttl=600):
+        self.redis = connection
+        self.prefix = prefix
+        self.stale_ttl = stale_ttl
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        return cls(redis.StrictRedis.from_url(url), **kwargs)
+
+    def _key(self, key):
+        return '{0}:{1}'.format(self.prefix, key)
+
+    def get(self, key):
+        try:
+            data = self.redis.get(self._key(key))
+        except redis.RedisError, e:
+            logger.warning("Could not read response from redis: {0}".format(e))
+            return None
+        if data is None:
+            return None
+        return CachedResponse.loads(data)
+
+    def set(self, key, entry):
+        ttl = entry.expires - time.time()
+        if entry.etag:
+            ttl += self.stale_ttl
+        if ttl < 1:
+            return
+        try:
+            self.redis.set(self._key(key), entry.dumps(), ex=int(ttl))
+        except redis.RedisError, e:
+            logger.warning("Could not store response in redis: {0}".format(e))
+
+
+class ResponseCache(object):
+    """
+    Bounded LRU of CachedResponse, shared by the views of a worker process
+
+    :param size: max number of entries
+    :param max_bytes: max total size of the entries
+    :param max_entry_bytes: larger responses are not cached
+    :param default_ttl: for responses without max-age (see cache_ttl)
+    :param stale_ttl: seconds expired entries having an ETag are kept for
+        revalidation
+    :param store: RedisResponseStore consulted on local misses
+    """
+
+    def __init__(self, size=1000, max_bytes=64 * 1024 * 1024,
+                 max_entry_bytes=1024 * 1024, default_ttl=60, stale_ttl=600,
+                 store=None):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        self.store = store
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, redis_url=None, redis_prefix='proxycache', **kwargs):
+        """
+        :param redis_url: REMOTE_PROXY_CACHE['redis_url'], e.g.
+            'redis://localhost:6379/1'; None keeps the cache in memory only
+        """
+        cache = cls(**kwargs)
+        if redis_url:
+            cache.store = RedisResponseStore.from_url(
+                redis_url, prefix=redis_prefix, stale_ttl=cache.stale_ttl
+            )
+        return cache
+
+    @staticmethod
+    def key(route, path, vary_values=()):
+        """
+        :param route: the route of the view
+        :param path: path and query string requested upstream
+        :param vary_values: values of the vary set of the route
+        """
+        parts = [route, path] + [unicode(v) for v in vary_values]
+        return hashlib.sha256(u'\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def ttl(self, resp, vary=(), authorized=False):
+        """
+        Seconds the response may be cached for, or None
+
+        :param authorized: whether the request carried Authorization
+        """
+        ttl = cache_ttl(resp.status_code, resp.headers, self.default_ttl, vary,
+                        authorized)
+        if ttl is None or len(resp.content) > self.max_entry_bytes:
+            return None
+        return ttl
+
+    def get(self, key):
+        """
+        Returns the entry, fresh or stale (check is_fresh), or None
+        """
+        entry = self._get_local(key)
+        if entry is None and self.store is not None:
+            entry = self.store.get(key)
+            if entry is not None:
+                self._set_local(key, entry)
+        with self._lock:
+            if entry is not None and entry.is_fresh():
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            if not self._usable(entry):
+                self._bytes -= entry.size
+                return None
+            # re-insert to mark the entry as the most recently used
+            self._data[key] = entry
+            return entry
+
+    def _usable(self, entry):
+        expires = entry.expires + (self.stale_ttl if entry.etag else 0)
+        return expires > time.time()
+
+    def set(self, key, entry):
+        self._set_local(key, entry)
+        if self.store is not None:
+            self.store.set(key, entry)
+
+    def _set_local(self, key, entry):
+        if not self.size or entry.size > self.max_entry_bytes:
+            return
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.size
+            self._data[key] = entry
+            self._bytes += entry.size
+            while self._data and (len(self._data) > self.size or self._bytes > self.max_bytes):
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= evicted.size
+
+    def status(self):
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+            self.hits = self.misses = 0
+
+
+class ResponseCacheRegistry(object):
+    """
+    Process-wide response caches, one per configuration (i.e. in practice
+    one, REMOTE_PROXY_CACHE)
+    """
+
+    def __init__(self):
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    def get(self, **config):
+        key = tuple(sorted(config.items()))
+        with self._lock:
+            if key not in self._caches:
+                self._caches[key] = ResponseCache.from_config(**config)
+            return self._caches[key]
+
+    def status(self):
+        with self._lock:
+            caches = self._caches.values()
+        return [c.status() for c in caches]
+
+    def clear(self):
+        with self._lock:
+            caches, self._caches = self._caches.values(), {}
+        for cache in caches:
+            cache.clear()
+
+
+response_caches = ResponseCacheRegistry()
@@ -0,0 +1,76 @@
+"""
+Coalescing of identical concurrent requests to the remote services
+
+While a GET is in flight, identical GETs (same key) wait for its response
+instead of sending their own: a burst of the same query costs the remote
+service one call.
+"""
+
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Runs one call per key at a time, sharing its outcome with the callers
+    that asked for the same key meanwhile
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, shareable=None):
+        """
+        Returns fn() or, if a call of the same key is in flight, its result
+        (its exception is raised as well)
+
+        :param shareable: predicate telling whether a result may be handed
+            to the other callers; if not, they call fn() themselves
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            if shareable is None or shareable(call.result):
+                return call.result
+            return fn()
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception, e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def status(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'calls': self.calls,
+                'coalesced': self.coalesced,
+            }
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,155 @@
+"""
+Hedged requests to replicated remote services
+
+A GET that has not been answered after the usual (p95) latency of its route
+is sent again to another instance of the service, and the first response
+wins. The extra load is bounded by a budget per deploy path.
+"""
+
+import threading
+import Queue
+
+
+class HedgeBudget(object):
+    """
+    Token bucket allowing `ratio` hedges per request, e.g. 0.05: at most 5%
+    extra requests; `burst` hedges can be spent at once
+    """
+
+    def __init__(self, ratio=0.05, burst=10):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = 0.0
+        self.requests = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.requests += 1
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def available(self):
+        """
+        Whether a hedge could be sent now (without spending it)
+        """
+        with self._lock:
+            return self.tokens >= 1
+
+    def withdraw(self):
+        """
+        Whether a hedge may be sent (and spends it)
+        """
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.hedges += 1
+            return True
+
+    def status(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'hedges': self.hedges,
+                'tokens': self.tokens,
+            }
+
+
+class HedgeBudgetRegistry(object):
+    """
+    Process-wide hedging budgets, keyed by deploy path
+    """
+
+    def __init__(self):
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def get(self, deploy_path, **kwargs):
+        with self._lock:
+            if deploy_path not in self._budgets:
+                self._budgets[deploy_path] = HedgeBudget(**kwargs)
+            return self._budgets[deploy_path]
+
+    def status(self):
+        with self._lock:
+            budgets = self._budgets.items()
+        return dict((path, b.status()) for path, b in budgets)
+
+    def clear(self):
+        with self._lock:
+            self._budgets.clear()
+
+
+hedge_budgets = HedgeBudgetRegistry()
+
+
+def first_response(primary, hedge, delay, budget, close=None):
+    """
+    Calls `primary()`, and `hedge()` as well if there is no response after
+    `delay` seconds (and the budget allows it) or if `primary` failed.
+    Returns the first response; the later one is handed to `close`.
+
+    Failures of both calls raise the exception of the last one.
+
+    Waiting for the primary with a timeout takes a thread, which is only
+    started if a hedge can be sent: with an empty budget, the primary runs
+    in the calling thread (and a failed one is retried in it).
+
+    :param primary: callable returning a response or raising
+    :param hedge: same as primary, e.g. on another instance
+    :param close: callable releasing a response that lost the race
+    """
+    if not budget.available():
+        try:
+            return primary()
+        except Exception:
+            # a failed primary is retried on the other instance regardless
+            # of the budget (flask-consulate would retry it as well)
+            return hedge()
+
+    results = Queue.Queue()
+    lock = threading.Lock()
+    won = []
+
+    def attempt(call):
+        try:
+            response = call()
+        except Exception, e:
+            results.put((False, e))
+            return
+        with lock:
+            lost = bool(won)
+            won.append(response)
+        if lost:
+            if close is not None:
+                close(response)
+        else:
+            results.put((True, response))
+
+    def start(call):
+        thread = threading.Thread(target=attempt, args=(call,))
+        thread.daemon = True
+        thread.start()
+
+    start(primary)
+    pending = 1
+    try:
+        ok, result = results.get(timeout=delay)
+        pending -= 1
+    except Queue.Empty:
+        ok = None
+    if ok:
+        return result
+
+    # a failed primary is retried on the other instance regardless of the
+    # budget (flask-consulate would retry it as well)
+    if ok is False or budget.withdraw():
+        start(hedge)
+        pending += 1
+    while pending:
+        ok, result = results.get()
+        pending -= 1
+        if ok:
+            return result
+    raise result
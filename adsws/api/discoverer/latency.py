@@ -0,0 +1,100 @@
+"""
+Latency tracking of the proxied routes, and the timeouts derived from it
+"""
+
+import bisect
+import threading
+
+
+def _bucket_bounds(lowest=0.001, highest=600.0, ratio=1.2):
+    bounds = [lowest]
+    while bounds[-1] < highest:
+        bounds.append(bounds[-1] * ratio)
+    return bounds
+
+
+class LatencyHistogram(object):
+    """
+    Streaming histogram of latencies (in seconds) with logarithmic buckets,
+    so percentiles are accurate to ~20%. Counts are halved every
+    `half_life` observations so that it follows the recent behaviour of
+    the route.
+    """
+    BOUNDS = _bucket_bounds()
+
+    def __init__(self, half_life=1000):
+        self.half_life = half_life
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self._observed = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.BOUNDS, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self._observed += 1
+            if self.half_life and self._observed >= self.half_life:
+                self._observed = 0
+                self.counts = [c // 2 for c in self.counts]
+                self.count = sum(self.counts)
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket holding the p-th percentile (0 < p <= 1),
+        or None without observations
+        """
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return None
+        rank = p * count
+        seen = 0
+        for index, c in enumerate(counts):
+            seen += c
+            if seen >= rank:
+                break
+        return self.BOUNDS[min(index, len(self.BOUNDS) - 1)]
+
+
+class AdaptiveTimeout(object):
+    """
+    Timeout of a route: the one advertised by the service if any, otherwise
+    `factor` times the `percentile` latency of the route clamped to
+    [`minimum`, `maximum`], once `min_samples` latencies were observed
+
+    :param default: timeout used until enough latencies were observed (and
+        when adaptive timeouts are disabled, i.e. factor is None)
+    """
+
+    def __init__(self, default=60, advertised=None, factor=None,
+                 percentile=0.99, minimum=1, maximum=60, min_samples=100):
+        self.default = default
+        self.advertised = advertised
+        self.factor = factor
+        self.percentile = percentile
+        self.minimum = minimum
+        self.maximum = maximum
+        self.min_samples = min_samples
+        self.histogram = LatencyHistogram()
+
+    @classmethod
+    def from_config(cls, default, advertised=None, config=None):
+        """
+        :param config: REMOTE_PROXY_ADAPTIVE_TIMEOUT, e.g. {'factor': 3,
+            'percentile': 0.99, 'minimum': 1, 'maximum': 60,
+            'min_samples': 100}; None disables adaptive timeouts
+        """
+        return cls(default=default, advertised=advertised, **(config or {}))
+
+    def observe(self, seconds):
+        self.histogram.observe(seconds)
+
+    def get(self):
+        if self.advertised:
+            return self.advertised
+        if self.factor is None or self.histogram.count < self.min_samples:
+            return self.default
+        latency = self.histogram.percentile(self.percentile)
+        return max(self.minimum, min(self.maximum, latency * self.factor))
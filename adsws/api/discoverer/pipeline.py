@@ -0,0 +1,122 @@
+"""
+Per route request pipelines of the discovered views
+
+Instead of nesting a closure per decorator (headers, require_oauth,
+affinity, ratelimit, local app context) around every discovered view, each
+route gets one RoutePipeline that runs the same stages, in the same order,
+in a single loop over settings computed when the route is registered.
+"""
+
+from flask import make_response
+
+from adsws.modules.oauth2server.provider import oauth2
+from adsws.ext.ratelimiter import ratelimit
+from . import affinity
+
+
+class Stage(object):
+    """
+    Step of a pipeline: before() runs on the way in and may return a
+    response, which skips the inner stages and the view; after(rv) runs on
+    the way out and returns the (possibly new) response
+    """
+    before = None
+    after = None
+
+
+class HeadersStage(Stage):
+    """
+    Adds headers to the response (as flask-headers' headers decorator)
+    """
+
+    def __init__(self, headers):
+        self.headers = headers.items()
+
+    def after(self, rv):
+        resp = make_response(rv)
+        for header, value in self.headers:
+            resp.headers[header] = value
+        return resp
+
+
+class OAuthStage(Stage):
+    """
+    Requires an OAuth token with the scopes (as oauth2.require_oauth)
+    """
+
+    def __init__(self, scopes):
+        self.scopes = tuple(scopes)
+
+    def before(self):
+        return oauth2.check_oauth(*self.scopes)
+
+
+class RateLimitStage(Stage):
+    """
+    Checks the limits registered for the view (see
+    ADSLimiter.register_limit); raises RateLimitExceeded
+    """
+
+    def before(self):
+        ratelimit.check()
+
+
+class AffinityStage(Stage):
+    """
+    Solr route affinity of the user (as affinity.affinity_decorator)
+    """
+
+    def __init__(self, storage, name='sroute'):
+        self.storage = storage
+        self.name = name
+        self.prefix = 'token:{}:'.format(name)
+
+    def before(self):
+        affinity._apply_route(self.storage, self.prefix, self.name)
+
+    def after(self, rv):
+        user_token, _ = affinity._user_token()
+        affinity._store_route(self.storage, self.prefix, self.name, user_token,
+                              rv, affinity.ROUTE_REDIS_EXPIRATION_TIME)
+        return rv
+
+
+class RoutePipeline(object):
+    """
+    View function running `view` through `stages` (outermost first), under
+    the application context of `local_app` if given
+
+    It passes for the view it runs (name, module, attributes): the rate
+    limits are registered and looked up by view name.
+    """
+
+    def __init__(self, view, stages=(), local_app=None):
+        self.__dict__.update(getattr(view, '__dict__', {}))
+        self.__name__ = view.__name__
+        self.__module__ = view.__module__
+        self.__doc__ = view.__doc__
+        self.view = view
+        self.stages = tuple(stages)
+        self.local_app = local_app
+
+    def __call__(self, *args, **kwargs):
+        stages = self.stages
+        depth = 0
+        for stage in stages:
+            if stage.before is not None:
+                rv = stage.before()
+                if rv is not None:
+                    break
+            depth += 1
+        else:
+            if self.local_app is None:
+                rv = self.view(*args, **kwargs)
+            else:
+                with self.local_app.app_context():
+                    rv = self.view(*args, **kwargs)
+        # unwind the stages that were entered, innermost first
+        for i in xrange(depth - 1, -1, -1):
+            after = stages[i].after
+            if after is not None:
+                rv = after(rv)
+        return rv
@@ -0,0 +1,180 @@
+"""
+Process-wide registry of the HTTP sessions used to proxy remote services
+
+Every ProxyView of a service shares the session (and so the keep-alive
+connections) of its upstream host, instead of each resource having its own
+connection pool. TLS handshakes are counted per upstream.
+"""
+
+import threading
+from collections import Counter
+from urlparse import urlsplit
+
+import requests
+from requests.packages.urllib3.connection import HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPSConnectionPool
+
+
+class HandshakeCounter(object):
+    """
+    Number of TLS handshakes per (host, port)
+    """
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def increment(self, host, port):
+        with self._lock:
+            self._counts[(host, port)] += 1
+
+    def get(self, host, port):
+        return self._counts[(host, port)]
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+
+handshakes = HandshakeCounter()
+
+
+class CountingHTTPSConnection(HTTPSConnection):
+    """
+    Every (re)connection of an HTTPS connection is a full TLS handshake
+    """
+
+    def connect(self):
+        super(CountingHTTPSConnection, self).connect()
+        handshakes.increment(self.host, self.port)
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CountingHTTPSConnection
+
+
+class PooledHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTPAdapter whose HTTPS connections count their handshakes
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(PooledHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = dict(
+            self.poolmanager.pool_classes_by_scheme,
+            https=CountingHTTPSConnectionPool
+        )
+
+
+class PoolRegistry(object):
+    """
+    requests.Session instances keyed by upstream (scheme, host, port)
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(service_uri):
+        """
+        Upstream of the service; consul services are keyed by service name
+        (their adapter has a pool per resolved instance)
+        """
+        parts = urlsplit(service_uri)
+        port = parts.port
+        if port is None:
+            port = {'http': 80, 'https': 443}.get(parts.scheme)
+        return parts.scheme, parts.hostname, port
+
+    def get_session(self, service_uri, pool_connections=20, pool_maxsize=1000,
+                    max_retries=1, session=None):
+        """
+        Returns the session of the service's upstream, creating it (or
+        setting up the given one, e.g. of a ConsulService) the first time
+        """
+        key = self.key(service_uri)
+        with self._lock:
+            if key not in self._sessions:
+                if session is None:
+                    session = requests.Session()
+                # The maximum number of retries each connection should attempt: this
+                # applies only to failed DNS lookups, socket connections and connection timeouts,
+                # never to requests where data has made it to the server. By default,
+                # requests does not retry failed connections.
+                #   * If retries not set, we will generate 502 HTTP errors from
+                #   time to time due to "Resetting dropped connection", connections
+                #   being drop even if the Keep-alive was present (which it is for
+                #   requests sessions)
+                # http://docs.python-requests.org/en/latest/api/?highlight=max_retries#requests.adapters.HTTPAdapter
+                #
+                # Both schemes use it: https connections are kept alive too,
+                # sparing a TLS handshake per request
+                adapter = PooledHTTPAdapter(
+                    pool_connections=pool_connections,
+                    pool_maxsize=pool_maxsize,
+                    max_retries=max_retries,
+                    pool_block=False
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[key] = session
+            return self._sessions[key]
+
+    def stats(self):
+        """
+        Connections of every upstream host, e.g.
+        {'http://localhost:5005': {'idle': 2, 'active': 1, 'created': 3,
+        'requests': 120}}
+
+        idle: open connections waiting in the pool, active: connections
+        checked out of the pool, created: connections opened so far,
+        handshakes (https only): TLS handshakes so far, reconnections
+        included
+        """
+        with self._lock:
+            sessions = self._sessions.items()
+        stats = {}
+        for key, session in sessions:
+            for adapter in set(session.adapters.values()):
+                if not isinstance(adapter, requests.adapters.HTTPAdapter):
+                    continue
+                pools = adapter.poolmanager.pools
+                for pool_key in pools.keys():
+                    pool = pools.get(pool_key)
+                    if pool is None:
+                        continue
+                    name = '{0}://{1}:{2}'.format(pool.scheme, pool.host,
+                                                  pool.port)
+                    stats[name] = self.pool_stats(pool)
+        return stats
+
+    @staticmethod
+    def pool_stats(pool):
+        """
+        :param pool: urllib3 HTTPConnectionPool
+        """
+        idle = active = 0
+        queue = pool.pool
+        if queue is not None:
+            # free slots hold None, connections once they have been used
+            idle = len([c for c in list(queue.queue) if c is not None])
+            active = max(0, queue.maxsize - queue.qsize())
+        stats = {
+            'idle': idle,
+            'active': active,
+            'created': pool.num_connections,
+            'requests': pool.num_requests,
+        }
+        if pool.scheme == 'https':
+            stats['handshakes'] = handshakes.get(pool.host, pool.port)
+        return stats
+
+    def clear(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions.values(), {}
+        for session in sessions:
+            session.close()
+
+
+pool_registry = PoolRegistry()
@@ -0,0 +1,226 @@
+"""
+Refreshing of the routes of the remote services
+
+The routes are discovered when the app is created; the RouteRefresher then
+queries the remote services again every WEBSERVICES_REFRESH_INTERVAL
+seconds, so that the endpoints added, removed or changed (methods, scopes,
+rate_limit...) by a deploy of a service are picked up, as well as the
+services that were down when the app was created. The services found in
+the discovery snapshot are taken from it rather than queried: with a
+snapshot, the workers follow the snapshot regenerated out of band.
+
+The changes are built aside (url map, views, symbolic ratelimits) and
+swapped in at once: a request sees either the previous routes or the new
+ones.
+"""
+
+import os
+import time
+import threading
+import traceback
+
+from werkzeug.routing import Map
+
+from .utils import is_remote_service, advertised_routes, build_remote_route, \
+    fetch_remote_resources
+from .snapshot import load_snapshot
+
+
+def copy_url_map(url_map, exclude=()):
+    """
+    Returns a copy of the url map without the rules of the endpoints in
+    exclude
+    """
+    copy = Map(
+        default_subdomain=url_map.default_subdomain,
+        charset=url_map.charset,
+        strict_slashes=url_map.strict_slashes,
+        redirect_defaults=url_map.redirect_defaults,
+        converters=url_map.converters,
+        sort_parameters=url_map.sort_parameters,
+        sort_key=url_map.sort_key,
+        encoding_errors=url_map.encoding_errors,
+        host_matching=url_map.host_matching,
+    )
+    for rule in url_map.iter_rules():
+        if rule.endpoint in exclude:
+            continue
+        new_rule = rule.empty()
+        new_rule.provide_automatic_options = getattr(rule, 'provide_automatic_options', False)
+        copy.add(new_rule)
+    return copy
+
+
+def add_url_rule(app, url_map, route, methods):
+    """
+    Adds the rule of a route to url_map, the way app.add_url_rule does
+    """
+    methods = set(method.upper() for method in methods)
+    provide_automatic_options = 'OPTIONS' not in methods
+    if provide_automatic_options:
+        methods.add('OPTIONS')
+    rule = app.url_rule_class(route, methods=methods, endpoint=route)
+    rule.provide_automatic_options = provide_automatic_options
+    url_map.add(rule)
+
+
+def copy_symbolic_ratelimits(symbolic_ratelimits, exclude=()):
+    """
+    Returns a copy of the symbolic ratelimits without the routes in exclude;
+    the routes of a group keep sharing the (copied) group
+    """
+    groups = {}
+    copy = {}
+    for key, group in symbolic_ratelimits.iteritems():
+        if key in exclude:
+            continue
+        if id(group) not in groups:
+            groups[id(group)] = dict(group)
+        copy[key] = groups[id(group)]
+    return copy
+
+
+class RouteRefresher(object):
+    """
+    Re-discovers the routes of the remote services of the app, in a daemon
+    thread, every `interval` seconds (started by the first request the
+    process serves)
+    """
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self.refreshes = 0
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the thread, once per process: a process forked after the
+        start (whose thread did not survive the fork) starts its own
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self.run, name='route-refresher')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except:  # Keep refreshing, but log the traceback
+                self.app.logger.error(
+                    "Problem refreshing the routes: {traceback}"
+                    .format(traceback=traceback.format_exc())
+                )
+
+    def diff(self, service_uri, deploy_path, resource_json=None):
+        """
+        Compares the resources of the service (queried unless given) to the
+        registered ones
+
+        :return: (added, removed, changed) routes and the advertised
+            {route: (resource, properties)}, or None if the service could
+            not be queried
+        """
+        app = self.app
+        if resource_json is None:
+            resource_json = fetch_remote_resources(service_uri, app)
+        if resource_json is None:
+            return None
+
+        registered = app.extensions.get('remote_routes', {}).get(service_uri, {})
+        advertised = dict(
+            (route, (resource, properties)) for route, resource, properties
+            in advertised_routes(deploy_path, resource_json)
+        )
+        added = sorted(set(advertised) - set(registered))
+        removed = sorted(set(registered) - set(advertised))
+        changed = sorted(
+            route for route in set(advertised) & set(registered)
+            if advertised[route][1] != registered[route]
+        )
+        return added, removed, changed, advertised
+
+    def refresh(self):
+        """
+        Applies the changes of the resources advertised by the remote
+        services to the routes of the app
+
+        :return: {service_uri: (added, removed, changed)} of the services
+            whose routes changed
+        """
+        app = self.app
+        with self._lock:
+            changes = {}
+            snapshot = load_snapshot(app)
+            webservices = app.config.get('WEBSERVICES') or {}
+            for service_uri, deploy_path in sorted(webservices.iteritems()):
+                if not is_remote_service(service_uri):
+                    continue
+                diff = self.diff(service_uri, deploy_path, snapshot.get(service_uri))
+                if diff is not None and any(diff[:3]):
+                    changes[service_uri] = (deploy_path,) + diff
+            self.refreshes += 1
+            if not changes:
+                return {}
+
+            # the rules of the removed and changed routes are rebuilt
+            stale = set()
+            for _, _, removed, changed, _ in changes.itervalues():
+                stale.update(removed)
+                stale.update(changed)
+            url_map = copy_url_map(app.url_map, exclude=stale)
+            symbolic_ratelimits = copy_symbolic_ratelimits(
+                app.extensions['symbolic_ratelimits'], exclude=stale
+            )
+
+            views = {}
+            rate_limits = []
+            for service_uri, (deploy_path, added, _, changed, advertised) in sorted(changes.iteritems()):
+                for route in added + changed:
+                    resource, properties = advertised[route]
+                    view, methods = build_remote_route(
+                        service_uri, deploy_path, resource, properties, app,
+                        symbolic_ratelimits=symbolic_ratelimits
+                    )
+                    if not methods:
+                        continue
+                    add_url_rule(app, url_map, route, methods)
+                    views[route] = view
+                    for method in methods:
+                        rate_limits.append((
+                            app.extensions['remote_rate_limits'][(route, method)],
+                            properties['rate_limit']
+                        ))
+
+            # swap; the views of the removed routes are left in place for
+            # the requests matched against the previous url map
+            app.view_functions.update(views)
+            for rate_limit, value in rate_limits:
+                rate_limit[:] = value
+            app.url_map = url_map
+            app.extensions['symbolic_ratelimits'] = symbolic_ratelimits
+
+            registered = app.extensions.setdefault('remote_routes', {})
+            result = {}
+            for service_uri, (deploy_path, added, removed, changed, advertised) in sorted(changes.iteritems()):
+                registered[service_uri] = dict(
+                    (route, properties) for route, (_, properties) in advertised.iteritems()
+                )
+                result[service_uri] = (added, removed, changed)
+                app.logger.info(
+                    "Routes of {service} refreshed: added {added}, removed "
+                    "{removed}, changed {changed}".format(
+                        service=service_uri, added=added, removed=removed,
+                        changed=changed
+                    )
+                )
+            return result
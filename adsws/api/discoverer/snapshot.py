@@ -0,0 +1,179 @@
+"""
+Discovery snapshot: the resources advertised by the remote services, saved
+in a file (WEBSERVICES_DISCOVERY_SNAPSHOT, relative to the instance folder)
+
+The workers register the services found in the snapshot without querying
+them, so that their startup does not depend on the services being up; only
+the services missing from it are queried. The snapshot is (re)generated
+out of band by `manage.py api discovery_snapshot`, which queries every
+service and keeps the previous entry of the ones that could not be
+queried.
+
+The file is replaced atomically (written aside, then renamed) and every
+service entry carries the checksum of its resources: a truncated or edited
+entry is ignored rather than registered.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import traceback
+from datetime import datetime
+
+from .utils import is_remote_service, query_remote_resources, validate_resources
+
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotError(Exception):
+    """
+    The snapshot cannot be read or is of another version
+    """
+
+
+def checksum(resource_json):
+    """
+    Checksum of the resources of a service
+    """
+    data = json.dumps(resource_json, sort_keys=True, separators=(',', ':'))
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+def snapshot_path(app):
+    """
+    Path of the snapshot of the app, or None if WEBSERVICES_DISCOVERY_SNAPSHOT
+    is not set
+    """
+    path = app.config.get('WEBSERVICES_DISCOVERY_SNAPSHOT')
+    if not path:
+        return None
+    return os.path.join(app.instance_path, path)
+
+
+def read_snapshot(path):
+    """
+    Returns the snapshot {'version', 'generation', 'generated', 'services'},
+    without the services whose checksum does not match their resources
+
+    :raises SnapshotError: the file cannot be read, is not valid json or
+        is of another version
+    """
+    try:
+        with open(path, 'r') as f:
+            snapshot = json.load(f)
+    except (IOError, ValueError), e:
+        raise SnapshotError('Cannot read {0}: {1}'.format(path, e))
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        raise SnapshotError('{0} is not a version {1} snapshot'.format(path, SNAPSHOT_VERSION))
+
+    services = {}
+    for service_uri, entry in snapshot.get('services', {}).iteritems():
+        try:
+            if checksum(entry['resources']) != entry['checksum']:
+                raise ValueError('checksum mismatch')
+            validate_resources(entry['resources'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        services[service_uri] = entry
+    snapshot['services'] = services
+    return snapshot
+
+
+def write_snapshot(path, services, generation=1):
+    """
+    Writes the snapshot of the services {service_uri: resources}, replacing
+    the file atomically
+
+    :param generation: number of the snapshot, increased at every write
+    """
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'generation': generation,
+        'generated': datetime.utcnow().isoformat() + 'Z',
+        'services': dict(
+            (service_uri, {
+                'checksum': checksum(resources),
+                'resources': resources,
+            }) for service_uri, resources in services.iteritems()
+        ),
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.discovery', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f, sort_keys=True, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        # readable by the workers, whoever writes the snapshot
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+    return snapshot
+
+
+def load_snapshot(app):
+    """
+    Returns the resources {service_uri: resources} of the snapshot of the
+    app, or {} if there is none (or it cannot be read)
+    """
+    path = snapshot_path(app)
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        snapshot = read_snapshot(path)
+    except SnapshotError, e:
+        app.logger.error('Ignoring the discovery snapshot: {0}'.format(e))
+        return {}
+    app.logger.info('Loaded the discovery snapshot {0} (generation {1}, {2})'.format(
+        path, snapshot.get('generation'), snapshot.get('generated')))
+    return dict(
+        (service_uri, entry['resources'])
+        for service_uri, entry in snapshot['services'].iteritems()
+    )
+
+
+def write_discovery_snapshot(app):
+    """
+    Queries the remote services of the app and writes its snapshot; the
+    services that cannot be queried keep their previous entry (if any)
+
+    :return: the services that could not be queried
+    """
+    path = snapshot_path(app)
+    if not path:
+        raise SnapshotError('WEBSERVICES_DISCOVERY_SNAPSHOT is not set')
+
+    previous = {'generation': 0, 'services': {}}
+    if os.path.exists(path):
+        try:
+            previous = read_snapshot(path)
+        except SnapshotError, e:
+            app.logger.error('Replacing the discovery snapshot: {0}'.format(e))
+    services = dict(
+        (service_uri, entry['resources'])
+        for service_uri, entry in previous['services'].iteritems()
+    )
+    failed = []
+    for service_uri in sorted(app.config.get('WEBSERVICES') or {}):
+        if not is_remote_service(service_uri):
+            continue
+        try:
+            services[service_uri] = query_remote_resources(service_uri, app)
+        except Exception:
+            app.logger.error(
+                "Problem querying {service}, keeping its previous entry: "
+                "{traceback}".format(service=service_uri,
+                                     traceback=traceback.format_exc())
+            )
+            failed.append(service_uri)
+
+    # services no longer configured are dropped
+    configured = app.config.get('WEBSERVICES') or {}
+    write_snapshot(path, dict(
+        (service_uri, resources) for service_uri, resources in services.iteritems()
+        if service_uri in configured
+    ), generation=previous.get('generation', 0) + 1)
+    return failed
@@ -1,31 +1,27 @@
 import os
+import sys
+import time
+import threading
+from collections import deque
 import requests
 import json
 import re
 import Cookie
-from flask.ext.headers import headers
 from flask import request
-from views import ProxyView
-from adsws.modules.oauth2server.provider import oauth2
+from views import ProxyView, GeventProxyView
 from urlparse import urljoin
 import traceback
 from importlib import import_module
 from adsws.ext.ratelimiter import ratelimit, limit_func, scope_func, key_func
 from flask.ext.consulate import ConsulService
-from functools import wraps
-from .affinity import affinity_decorator
+from adsws.startup import profile
+from .pipeline import RoutePipeline, HeadersStage, OAuthStage, \
+    RateLimitStage, AffinityStage
+
+# seconds; timeout of the connection to a service queried for its resources,
+# and of every read of its answer
+QUERY_TIMEOUT = 5
 
-def local_app_context(local_app):
-    """
-    Ensure that an imported view is run under the correct application context
-    """
-    def real_local_app_context_decorator(f):
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
-            with local_app.app_context():
-                return f(*args, **kwargs)
-        return decorated_function
-    return real_local_app_context_decorator
 
 def bootstrap_local_module(service_uri, deploy_path, app):
     """
@@ -61,14 +57,18 @@ def bootstrap_local_module(service_uri, deploy_path, app):
         else:
             attr_base = view
 
-        # ensure the current_app matches local_app and not API app
-        view = local_app_context(local_app)(view)
+        # Stages of the route, outermost first
+        stages = []
 
-        if deploy_path in local_app.config.get('AFFINITY_ENHANCED_ENDPOINTS', []):
-            view = affinity_decorator(ratelimit._storage.storage, name=local_app.config['AFFINITY_ENHANCED_ENDPOINTS'].get(deploy_path))(view)
+        # Add cache-control headers
+        if app.config.get('API_PROXYVIEW_HEADERS'):
+            stages.append(HeadersStage(app.config['API_PROXYVIEW_HEADERS']))
 
+        # Require oauth
+        if hasattr(attr_base, 'scopes'):
+            stages.append(OAuthStage(attr_base.scopes))
 
-        # Decorate the view with ratelimit
+        # Ratelimit
         if hasattr(attr_base, 'rate_limit'):
 
             # collect symbolic ratelimits
@@ -76,21 +76,22 @@ def bootstrap_local_module(service_uri, deploy_path, app):
 
             # create local (default) ratelimits
             d = attr_base.rate_limit[0]
-            view = ratelimit.shared_limit_and_check(
+            ratelimit.register_limit(
+                view,
                 lambda counts=d, per_second=attr_base.rate_limit[1]: limit_func(counts, per_second),
+                shared=True,
                 scope=scope_func,
                 key_func=key_func,
                 methods=rule.methods,
                 per_method=False
-            )(view)
+            )
+            stages.append(RateLimitStage())
 
-        # Decorate the view with require_oauth
-        if hasattr(attr_base, 'scopes'):
-            view = oauth2.require_oauth(*attr_base.scopes)(view)
+        if deploy_path in local_app.config.get('AFFINITY_ENHANCED_ENDPOINTS', []):
+            stages.append(AffinityStage(ratelimit._storage.storage, name=local_app.config['AFFINITY_ENHANCED_ENDPOINTS'].get(deploy_path)))
 
-        # Add cache-control headers
-        if app.config.get('API_PROXYVIEW_HEADERS'):
-            view = headers(app.config['API_PROXYVIEW_HEADERS'])(view)
+        # ensure the current_app matches local_app and not API app
+        view = RoutePipeline(view, stages, local_app=local_app)
 
         # Let flask handle OPTIONS, which it will not do if we explicitly
         # add it to the url_map
@@ -113,6 +114,62 @@ def bootstrap_remote_service(service_uri, deploy_path, app):
     app.logger.debug(
         'Attempting bootstrap_remote_service [{0}]'.format(service_uri)
     )
+    resource_json = fetch_remote_resources(service_uri, app)
+    if resource_json is not None:
+        register_remote_service(service_uri, deploy_path, resource_json, app)
+
+
+def _resources_cache_path(service_uri, app):
+    """
+    Path of the cached resources of the service, or None if
+    WEBSERVICES_DISCOVERY_CACHE_DIR is not set
+    """
+    cache_key = service_uri.replace('/', '').replace('\\', '').replace('.', '')
+    cache_dir = app.config.get('WEBSERVICES_DISCOVERY_CACHE_DIR', '')
+    if not cache_dir:
+        return None
+    return os.path.join(cache_dir, cache_key)
+
+
+def validate_resources(resource_json):
+    """
+    Raises ValueError unless resource_json looks like the resources
+    advertised by a service: {resource: {'methods': [...], ...}}
+    """
+    if not isinstance(resource_json, dict):
+        raise ValueError('The resources are not an object')
+    for resource, properties in resource_json.iteritems():
+        if not isinstance(properties, dict) \
+                or not isinstance(properties.get('methods'), list):
+            raise ValueError('Resource {0} has no list of methods'.format(resource))
+
+
+def read_cached_resources(service_uri, app):
+    """
+    Returns the cached resources of the service, or None
+    """
+    cache_path = _resources_cache_path(service_uri, app)
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r') as cf:
+                resource_json = json.loads(cf.read())
+            validate_resources(resource_json)
+            return resource_json
+        except (IOError, ValueError), e:
+            app.logger.error('Cant read cached resource {0}: {1}'.format(cache_path, e))
+    app.logger.info('Could not discover {0}'.format(service_uri))
+    return None
+
+
+def query_remote_resources(service_uri, app):
+    """
+    Queries the resources advertised by a remote service (caching them in
+    WEBSERVICES_DISCOVERY_CACHE_DIR); raises the exceptions of requests,
+    or ValueError if the answer is not valid resources
+
+    It only reads the app config, so that the services can be queried
+    concurrently (see discover)
+    """
 
     if service_uri.startswith('consul://'):
         cs = ConsulService(
@@ -130,36 +187,127 @@ def bootstrap_remote_service(service_uri, deploy_path, app):
             app.config.get('WEBSERVICES_PUBLISH_ENDPOINT', '/')
         )
 
-    cache_key = service_uri.replace('/', '').replace('\\', '').replace('.', '')
-    cache_dir = app.config.get('WEBSERVICES_DISCOVERY_CACHE_DIR', '')
-    cache_path = os.path.join(cache_dir, cache_key)
-    resource_json = {}
+    cache_path = _resources_cache_path(service_uri, app)
+
+    # discover the ratelimits/urls/permissions from the service itself
+    r = requests.get(url, timeout=QUERY_TIMEOUT)
+    r.raise_for_status()
+    resource_json = r.json()
+    validate_resources(resource_json)
+    if cache_path:
+        try:
+            with open(cache_path, 'w') as cf:
+                cf.write(json.dumps(resource_json))
+        except IOError:
+            app.logger.error('Cant write cached resource {0}'.format(cache_path))
+    return resource_json
+
 
-    # discover the ratelimits/urls/permissions from the service itself;
-    # if not available, use a cached values (if any)
+def fetch_remote_resources(service_uri, app):
+    """
+    Queries the resources advertised by a remote service; if it is not
+    available or its answer is not valid, returns the cached ones (if any),
+    otherwise None.
+    """
     try:
-        r = requests.get(url, timeout=5)
-        resource_json = r.json()
-        if cache_dir:
-            try:
-                with open(cache_path, 'w') as cf:
-                    cf.write(json.dumps(resource_json))
-            except IOError:
-                app.logger.error('Cant write cached resource {0}'.format(cache_path))
-    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
-        if cache_dir and os.path.exists(cache_path):
-            with open(cache_path, 'r') as cf:
-                resource_json = json.loads(cf.read())
-        else:
-            app.logger.info('Could not discover {0}'.format(service_uri))
-            return
+        return query_remote_resources(service_uri, app)
+    except Exception, e:  # unreachable, error status, bad json, consul...
+        app.logger.warning('Could not query {0}: {1}'.format(service_uri, e))
+        return read_cached_resources(service_uri, app)
 
 
+def _timed_fetch(service_uri, app):
+    """
+    fetch_remote_resources run by the discovery threads, recorded as the
+    'fetch <service_uri>' startup phase
+    """
+    with profile.phase('fetch {0}'.format(service_uri)):
+        return fetch_remote_resources(service_uri, app)
 
-    # Start constructing the ProxyViews based on what we got when querying
-    # the /resources route.
-    # If any part of this procedure fails, log that we couldn't produce this
-    # ProxyView, but otherwise continue.
+
+class ResourceFetcher(object):
+    """
+    Fetches the resources of remote services concurrently, on `workers`
+    daemon threads, each picking the next service until none is left
+    """
+
+    def __init__(self, service_uris, app, workers):
+        self.app = app
+        self._pending = deque(service_uris)
+        self._results = {}
+        self._done = dict(
+            (service_uri, threading.Event()) for service_uri in service_uris
+        )
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._threads = []
+        for _ in range(max(1, min(len(service_uris), workers))):
+            thread = threading.Thread(target=self.run, name='discovery')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def run(self):
+        while True:
+            with self._lock:
+                if self._stopped or not self._pending:
+                    return
+                service_uri = self._pending.popleft()
+            try:
+                self._results[service_uri] = (_timed_fetch(service_uri, self.app), None)
+            except:
+                self._results[service_uri] = (None, sys.exc_info())
+            finally:
+                self._done[service_uri].set()
+
+    def __contains__(self, service_uri):
+        return service_uri in self._done
+
+    def get(self, service_uri, timeout):
+        """
+        Returns the resources of the service, waiting for them at most
+        `timeout` seconds; re-raises the error of the fetch, if any
+
+        :return: (fetched, resources)
+        """
+        if not self._done[service_uri].wait(timeout):
+            return False, None
+        resource_json, exc_info = self._results[service_uri]
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return True, resource_json
+
+    def stop(self, timeout):
+        """
+        Drops the fetches not started yet, and waits at most `timeout`
+        seconds for the running ones
+
+        :return: the number of fetches still running
+        """
+        with self._lock:
+            self._stopped = True
+        deadline = time.time() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.time()))
+        return len([thread for thread in self._threads if thread.is_alive()])
+
+
+def is_remote_service(service_uri):
+    """
+    Whether the service is queried over the network (rather than imported)
+    """
+    return any([
+        service_uri.startswith(prefix) for prefix in
+        ['http://', 'https://', 'consul://']
+    ])
+
+
+def advertised_routes(deploy_path, resource_json):
+    """
+    Returns the (route, resource, properties) of the resources advertised by
+    a remote service, with the default properties filled in
+    """
+    routes = []
     for resource, properties in resource_json.iteritems():
 
         properties.setdefault('rate_limit', [1000, 86400])
@@ -167,58 +315,118 @@ def bootstrap_remote_service(service_uri, deploy_path, app):
 
         if resource.startswith('/'):
             resource = resource[1:]
-        route = os.path.join(deploy_path, resource)
-        remote_route = urljoin(service_uri, resource)
-
-        # Make an instance of the ProxyView. We need to instantiate the class
-        # to save instance attributes, which will be necessary to re-construct
-        # the location to the third party resource (ProxyView.endpoint)
-        with app.app_context():
-            # app_context to allow config lookup via current_app in __init__
-            proxyview = ProxyView(remote_route, service_uri, deploy_path, route)
-
+        routes.append((os.path.join(deploy_path, resource), resource, properties))
+    return routes
 
-        _update_symbolic_ratelimits(app, route, properties)
 
+def build_remote_route(service_uri, deploy_path, resource, properties, app,
+                       symbolic_ratelimits=None):
+    """
+    Builds the view proxying one resource of a remote service, without
+    adding it to the url map (see register_remote_service, RouteRefresher)
 
+    The ratelimit of every (route, method) is registered once; its value
+    lives in app.extensions['remote_rate_limits'], so that it can be
+    changed afterwards.
 
-        for method in properties['methods']:
-            if method not in proxyview.methods:
-                app.logger.warning("Could not create a ProxyView for "
-                                   "method {meth} for {ep}"
-                                   .format(meth=method, ep=service_uri))
-                continue
+    :return: view, methods (no view and no methods if none of the advertised
+        methods can be proxied)
+    """
+    # Proxy engine: 'gevent' only makes sense with gevent workers
+    if app.config.get('REMOTE_PROXY_ENGINE', 'sync') == 'gevent':
+        proxyview_class = GeventProxyView
+    else:
+        proxyview_class = ProxyView
+
+    route = os.path.join(deploy_path, resource)
+    remote_route = urljoin(service_uri, resource)
+
+    # Make an instance of the ProxyView. We need to instantiate the class
+    # to save instance attributes, which will be necessary to re-construct
+    # the location to the third party resource (ProxyView.endpoint)
+    with app.app_context():
+        # app_context to allow config lookup via current_app in __init__
+        proxyview = proxyview_class(remote_route, service_uri, deploy_path, route,
+                                    timeout=properties.get('timeout'))
+
+    _update_symbolic_ratelimits(app, route, properties, symbolic_ratelimits)
+
+    methods = []
+    for method in properties['methods']:
+        if method not in proxyview.methods:
+            app.logger.warning("Could not create a ProxyView for "
+                               "method {meth} for {ep}"
+                               .format(meth=method, ep=service_uri))
+            continue
+        methods.append(method)
+    if not methods:
+        return None, []
+
+    # Stages of the route, outermost first
+    stages = []
+
+    # Add cache-control headers
+    if app.config.get('API_PROXYVIEW_HEADERS'):
+        stages.append(HeadersStage(app.config['API_PROXYVIEW_HEADERS']))
+
+    # Require the advertised oauth2 scopes
+    stages.append(OAuthStage(properties['scopes']))
+
+    if deploy_path in app.config.get('AFFINITY_ENHANCED_ENDPOINTS', []):
+        stages.append(AffinityStage(ratelimit._storage.storage, name=app.config['AFFINITY_ENHANCED_ENDPOINTS'].get(deploy_path)))
+
+    # Ratelimit
+    rate_limits = app.extensions.setdefault('remote_rate_limits', {})
+    for method in methods:
+        if (route, method) in rate_limits:
+            continue
+        rate_limit = rate_limits[(route, method)] = list(properties['rate_limit'])
+        ratelimit.register_limit(
+            proxyview.dispatcher,
+            lambda rate_limit=rate_limit: limit_func(rate_limit[0], rate_limit[1]),
+            shared=True,
+            scope=scope_func,
+            key_func=key_func,
+            methods=[method],
+            per_method=False
+        )
+    stages.append(RateLimitStage())
 
-            view = proxyview.dispatcher
+    return RoutePipeline(proxyview.dispatcher, stages), methods
 
-            # Decorate the view with ratelimit.
-            d = properties['rate_limit'][0]
-            view = ratelimit.shared_limit_and_check(
-                lambda counts=d, per_second=properties['rate_limit'][1]: limit_func(counts, per_second),
-                scope=scope_func,
-                key_func=key_func,
-                methods=[method],
-                per_method=False
-            )(view)
 
-            if deploy_path in app.config.get('AFFINITY_ENHANCED_ENDPOINTS', []):
-                view = affinity_decorator(ratelimit._storage.storage, name=app.config['AFFINITY_ENHANCED_ENDPOINTS'].get(deploy_path))(view)
+def register_remote_service(service_uri, deploy_path, resource_json, app):
+    """
+    Registers the views proxying the resources advertised by a remote
+    service
+    :param service_uri: the http url of the target application
+    :param deploy_path: the path on which to make the target app discoverable
+    :param resource_json: the resources advertised by the service
+    :param app: flask.Flask application instance
+    :return: None
+    """
+    # the registered properties of the routes, compared to the advertised
+    # ones by the RouteRefresher
+    registered = app.extensions.setdefault('remote_routes', {}).setdefault(service_uri, {})
 
-            # Decorate with the advertised oauth2 scopes
-            view = oauth2.require_oauth(*properties['scopes'])(view)
+    # Start constructing the ProxyViews based on what we got when querying
+    # the /resources route.
+    # If any part of this procedure fails, log that we couldn't produce this
+    # ProxyView, but otherwise continue.
+    for route, resource, properties in advertised_routes(deploy_path, resource_json):
 
-            # Add cache-control headers
-            if app.config.get('API_PROXYVIEW_HEADERS'):
-                view = headers(app.config['API_PROXYVIEW_HEADERS'])(view)
+        view, methods = build_remote_route(service_uri, deploy_path, resource, properties, app)
+        registered[route] = properties
+        if not methods:
+            continue
 
-            # Either make a new route with this view, or append the new method
-            # to an existing route if one exists with the same name
-            try:
-                rule = next(app.url_map.iter_rules(endpoint=route))
-                if method not in rule.methods:
-                    rule.methods.update([method])
-            except KeyError:
-                app.add_url_rule(route, route, view, methods=[method])
+        # Either make a new route with this view, or append the new methods
+        # to an existing route if one exists with the same name
+        try:
+            rule = next(app.url_map.iter_rules(endpoint=route))
+            rule.methods.update(methods)
+        except KeyError:
+            app.add_url_rule(route, route, view, methods=methods)
 
 
 def discover(app):
@@ -228,6 +436,14 @@ def discover(app):
     app's routes into the api app, either directly (local module) or via
     proxying to a remote endpoint
 
+    The remote services found in the discovery snapshot (see snapshot.py)
+    are not queried. The others are queried concurrently
+    (WEBSERVICES_DISCOVERY_WORKERS threads), within an overall deadline
+    (WEBSERVICES_DISCOVERY_DEADLINE seconds) past which the cached resources
+    of the late services are used. The routes are then registered in a
+    deterministic order: by deploy path, then service. No query outlives
+    discover(), the late ones are waited for (at most 2 * QUERY_TIMEOUT).
+
     :param app: flask.Flask application instance
     :return: None
     """
@@ -235,15 +451,46 @@ def discover(app):
     webservices = app.config.get('WEBSERVICES')
     if not webservices:
         webservices = {}
-    for service_uri, deploy_path in webservices.iteritems():
+    services = sorted(webservices.iteritems(), key=lambda item: (item[1], item[0]))
+    # imported here, snapshot depends on this module
+    from .snapshot import load_snapshot
+    snapshot = load_snapshot(app)
+    remote = [
+        service_uri for service_uri, _ in services
+        if is_remote_service(service_uri) and service_uri not in snapshot
+    ]
+
+    fetcher = None
+    if remote:
+        fetcher = ResourceFetcher(
+            remote, app, app.config.get('WEBSERVICES_DISCOVERY_WORKERS', 16)
+        )
+    deadline = time.time() + app.config.get('WEBSERVICES_DISCOVERY_DEADLINE', 15)
+
+    for service_uri, deploy_path in services:
         try:
-            if any([
-                    service_uri.startswith(prefix) for prefix in
-                    ['http://', 'https://', 'consul://']
-                    ]):
-                bootstrap_remote_service(service_uri, deploy_path, app)
-            else:
-                bootstrap_local_module(service_uri, deploy_path, app)
+            resource_json = None
+            if service_uri in snapshot:
+                resource_json = snapshot[service_uri]
+            elif fetcher is not None and service_uri in fetcher:
+                app.logger.debug(
+                    'Attempting bootstrap_remote_service [{0}]'.format(service_uri)
+                )
+                fetched, resource_json = fetcher.get(
+                    service_uri, max(0, deadline - time.time())
+                )
+                if not fetched:
+                    app.logger.warning(
+                        'Discovery deadline exceeded for {0}'.format(service_uri)
+                    )
+                    resource_json = read_cached_resources(service_uri, app)
+            # the queries are timed by the threads running them (waiting for
+            # them is not a phase of its own)
+            with profile.phase('bootstrap {0}'.format(service_uri)):
+                if not is_remote_service(service_uri):
+                    bootstrap_local_module(service_uri, deploy_path, app)
+                elif resource_json is not None:
+                    register_remote_service(service_uri, deploy_path, resource_json, app)
         except:  # Continue bootstrapping, but log the traceback
             app.logger.error(
                 "Problem discovering {service}, skipping this service "
@@ -253,17 +500,28 @@ def discover(app):
                 )
             )
 
+    if fetcher is not None:
+        # the app may be forked next (see prefork): no fetch must be left
+        # running, possibly holding the locks of logging or requests. The
+        # fetches not started yet are dropped, the late ones get the time
+        # of a query to finish (their result is not used anymore).
+        if fetcher.stop(2 * QUERY_TIMEOUT):
+            app.logger.warning(
+                'A discovery query is still running after the deadline'
+            )
+
 
-def _update_symbolic_ratelimits(app, route, properties):
+def _update_symbolic_ratelimits(app, route, properties, symbolic_ratelimits=None):
     """Build information about ratelimit groups; this data
     is used for ratelimiting endpoints that should share
     ratelimit counters.
 
     All the info is stored in the current application
-    (which is a global object)
+    (which is a global object), or in symbolic_ratelimits if given
     """
 
-    symbolic_ratelimits = app.extensions['symbolic_ratelimits'] #fail if not properly initiated
+    if symbolic_ratelimits is None:
+        symbolic_ratelimits = app.extensions['symbolic_ratelimits'] #fail if not properly initiated
 
     if route in symbolic_ratelimits:
         return # already there
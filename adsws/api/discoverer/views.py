@@ -1,16 +1,87 @@
-from flask import request, current_app
+from flask import request, current_app, Response
 from flask.ext.restful import Resource
 from flask.ext.consulate import ConsulService
 from flask_login import current_user
+from werkzeug.datastructures import Headers
+from werkzeug.http import unquote_etag, parse_date
 from urlparse import urljoin
 import requests
+from requests.packages.urllib3.exceptions import HTTPError as UpstreamError
 import json
+import time
+import random
+import hashlib
+import logging
+
+from .pools import pool_registry
+from .breaker import breakers
+from .latency import AdaptiveTimeout
+from .hedging import hedge_budgets, first_response
+from .cache import CachedResponse, ResponseCache, response_caches
+from .coalescing import single_flight
+
+try:
+    import gevent
+    from gevent import monkey
+    from gevent.lock import BoundedSemaphore
+except ImportError:
+    gevent = None
+
+logger = logging.getLogger(__name__)
+
+
+def consul_instances(cs):
+    """
+    Base urls of the instances of a consul service (e.g.
+    ['http://10.0.0.1:8080', 'http://10.0.0.2:8080'])
+
+    flask-consulate only resolves them in the private
+    ConsulService._resolve (flask-consulate==0.1.2, see requirements.txt);
+    without it, only the instance picked by base_url is known.
+    """
+    resolve = getattr(cs, '_resolve', None)
+    if resolve is None:
+        return [cs.base_url]
+    return resolve()
+
+
+class StreamedBody(object):
+    """
+    File-like wrapper of the WSGI input stream; it tells requests the length
+    of the body, so that it is sent with the client's Content-Length
+    instead of chunked
+    """
+
+    def __init__(self, stream, length, chunk_size=65536):
+        self.stream = stream
+        self.length = length
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def __iter__(self):
+        return iter(lambda: self.stream.read(self.chunk_size), b'')
 
 
 class ProxyView(Resource):
     """Proxies a request to a remote webservice"""
 
-    def __init__(self, endpoint, service_uri, deploy_path, route):
+    # forwarded whatever REMOTE_PROXY_ALLOWED_HEADERS says, so that clients
+    # can make conditional requests
+    VALIDATOR_HEADERS = ['ETag', 'Last-Modified']
+    # request headers telling apart otherwise identical GETs (coalescing)
+    COALESCE_KEY_HEADERS = ['Accept', 'Accept-Encoding', 'Range', 'If-None-Match', 'If-Modified-Since']
+
+    def __init__(self, endpoint, service_uri, deploy_path, route, timeout=None):
+        """
+        :param timeout: request timeout advertised by the service for this
+            route, if any (otherwise it adapts to the observed latency when
+            REMOTE_PROXY_ADAPTIVE_TIMEOUT is set)
+        """
         self.endpoint = endpoint
         self.service_uri = service_uri
         self.deploy_path = deploy_path
@@ -21,36 +92,79 @@ class ProxyView(Resource):
             self.pool_connections = current_app.config.get("REQUESTS_POOL_CONNECTIONS", 20)
             self.pool_maxsize = current_app.config.get("REQUESTS_POOL_MAXSIZE", 1000)
             self.max_retries = current_app.config.get("REQUESTS_MAX_RETRIES", 1)
+            self.stream_always = deploy_path in current_app.config.get("REMOTE_PROXY_STREAM_DEPLOY_PATHS", [])
+            self.stream_min_content_length = current_app.config.get("REMOTE_PROXY_STREAM_MIN_CONTENT_LENGTH", None)
+            self.stream_chunk_size = current_app.config.get("REMOTE_PROXY_STREAM_CHUNK_SIZE", 65536)
+            self.stream_request_min_content_length = current_app.config.get("REMOTE_PROXY_STREAM_REQUEST_MIN_CONTENT_LENGTH", None)
+            self.breaker_config = current_app.config.get("REMOTE_PROXY_CIRCUIT_BREAKER", None)
+            self.breaker_error_statuses = current_app.config.get("REMOTE_PROXY_CIRCUIT_BREAKER_ERROR_STATUSES", [502, 503, 504])
+            self.adaptive_timeout_config = current_app.config.get("REMOTE_PROXY_ADAPTIVE_TIMEOUT", None)
+            self.hedge = deploy_path in current_app.config.get("REMOTE_PROXY_HEDGE_DEPLOY_PATHS", [])
+            self.hedge_config = current_app.config.get("REMOTE_PROXY_HEDGING", {})
+            self.cache_config = current_app.config.get("REMOTE_PROXY_CACHE", None)
+            self.cache_vary = current_app.config.get("REMOTE_PROXY_CACHE_DEPLOY_PATHS", {}).get(deploy_path)
+            self.weak_etag = current_app.config.get("REMOTE_PROXY_WEAK_ETAG", False)
+            self.coalesce = deploy_path in current_app.config.get("REMOTE_PROXY_COALESCE_DEPLOY_PATHS", [])
         except RuntimeError:
             # Unit testing fails: "RuntimeError: Working outside of application context."
             self.default_request_timeout = 60
             self.pool_connections = 20
             self.pool_maxsize = 1000
             self.max_retries = 1
+            self.stream_always = False
+            self.stream_min_content_length = None
+            self.stream_chunk_size = 65536
+            self.stream_request_min_content_length = None
+            self.breaker_config = None
+            self.breaker_error_statuses = [502, 503, 504]
+            self.adaptive_timeout_config = None
+            self.hedge = False
+            self.hedge_config = {}
+            self.cache_config = None
+            self.cache_vary = None
+            self.weak_etag = False
+            self.coalesce = False
+        self.timeout = AdaptiveTimeout.from_config(
+            self.default_request_timeout, advertised=timeout,
+            config=self.adaptive_timeout_config
+        )
+        # GET responses of the configured deploy paths are cached (the
+        # cache is shared by all the views of the process)
+        self.cache = None
+        if self.cache_config is not None and self.cache_vary is not None:
+            self.cache = response_caches.get(**self.cache_config)
+        # one circuit breaker per service, shared by all its views
+        self.breaker = None
+        if self.breaker_config is not None:
+            self.breaker = breakers.get(service_uri, **self.breaker_config)
+        # responses might be streamed to the client instead of buffered
+        self.stream = self.stream_always or self.stream_min_content_length is not None
+        # HTTP connection pools are shared by all the views of an upstream
+        # host (see pools.PoolRegistry)
         if service_uri.startswith('consul://'):
             self.cs = ConsulService(
                 service_uri,
                 nameservers=[current_app.config.get("CONSUL_DNS", "172.17.42.1")]
             )
+            self.cs.session = pool_registry.get_session(
+                service_uri, self.pool_connections, self.pool_maxsize,
+                self.max_retries, session=self.cs.session
+            )
             self.session = self.cs
+            # hedged GETs (see hedged_get), with a budget per deploy path
+            if self.hedge:
+                self.hedge_percentile = self.hedge_config.get('percentile', 0.95)
+                self.hedge_min_samples = self.hedge_config.get('min_samples', 100)
+                self.hedge_budget = hedge_budgets.get(
+                    deploy_path,
+                    ratio=self.hedge_config.get('budget', 0.05),
+                    burst=self.hedge_config.get('burst', 10)
+                )
         else:
-            self.session = requests.Session()
-            # HTTP connection pool
-            # - The maximum number of retries each connection should attempt: this
-            #   applies only to failed DNS lookups, socket connections and connection timeouts,
-            #   never to requests where data has made it to the server. By default,
-            #   requests does not retry failed connections.
-            #   * If retries not set, we will generate 502 HTTP errors from
-            #   time to time due to "Resetting dropped connection", connections
-            #   being drop even if the Keep-alive was present (which it is for
-            #   requests sessions)
-            # http://docs.python-requests.org/en/latest/api/?highlight=max_retries#requests.adapters.HTTPAdapter
-            #
-            http_adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_connections, \
-                                                         pool_maxsize=self.pool_maxsize, \
-                                                         max_retries=self.max_retries, \
-                                                         pool_block=False)
-            self.session.mount('http://', http_adapter)
+            self.session = pool_registry.get_session(
+                service_uri, self.pool_connections, self.pool_maxsize,
+                self.max_retries
+            )
 
     @staticmethod
     def get_body_data(request):
@@ -67,6 +181,94 @@ class ProxyView(Resource):
 
         return request.get_data()
 
+    def get_body(self, request):
+        """
+        Returns the payload to forward: large bodies are read from the WSGI
+        input stream while they are sent upstream (if nothing has read them
+        yet, see adsws.factory.cache_data_stream), anything else is
+        forwarded from memory.
+
+        Consul services are left out: flask-consulate retries failed
+        connections, which cannot replay a consumed stream.
+        """
+        length = request.content_length
+        if self.stream_request_min_content_length is not None \
+                and self.cs is None \
+                and length is not None \
+                and length >= self.stream_request_min_content_length \
+                and getattr(request, '_cached_data', None) is None:
+            return StreamedBody(request.stream, length, self.stream_chunk_size)
+        return ProxyView.get_body_data(request)
+
+    def should_stream(self, resp):
+        """
+        Decides whether the upstream response is passed through chunk by
+        chunk: always for the configured deploy paths, otherwise when it is
+        larger than REMOTE_PROXY_STREAM_MIN_CONTENT_LENGTH (or of unknown
+        length)
+        """
+        if self.stream_always:
+            return True
+        if self.stream_min_content_length is None:
+            return False
+        try:
+            return int(resp.headers['Content-Length']) >= self.stream_min_content_length
+        except (KeyError, ValueError):
+            return True
+
+    def reader(self, buffered=False):
+        """
+        Returns the function reading the upstream response once its headers
+        are in (every response is fetched lazily, stream=True): it is left
+        unread if it is to be streamed to the client (see should_stream),
+        otherwise it is read into a CachedResponse. A compressed body the
+        client accepts is kept compressed, so that it is not decompressed
+        to be compressed again (see compression.py).
+
+        :param buffered: never stream, e.g. a response shared by coalesced
+            requests
+        """
+        accept_encodings = request.accept_encodings
+
+        def read(resp):
+            if not buffered and self.stream and self.should_stream(resp):
+                return resp
+            encoding = resp.headers.get('Content-Encoding')
+            passthrough = bool(encoding) and accept_encodings[encoding] > 0
+            return CachedResponse.read(resp, decode_content=not passthrough)
+        return read
+
+    @staticmethod
+    def accepted_encodings():
+        """
+        Content codings the client accepts; part of the cache key, a cached
+        body may be compressed
+        """
+        return ','.join(sorted(value for value, quality in request.accept_encodings if quality > 0))
+
+    def iter_content(self, resp, ep, logger, decode_content=True):
+        """
+        Yields the upstream body and releases the connection at the end;
+        the decoded body is forwarded (so Content-Length/Encoding are not)
+        unless decode_content is False, i.e. the client accepts the
+        Content-Encoding of the upstream body.
+
+        It runs after the request context is gone, hence the logger argument
+        """
+        if decode_content:
+            chunks = resp.iter_content(chunk_size=self.stream_chunk_size)
+        else:
+            chunks = resp.raw.stream(self.stream_chunk_size, decode_content=False)
+        try:
+            for chunk in chunks:
+                yield chunk
+        except (requests.exceptions.RequestException, UpstreamError), e:
+            # let the server abort the connection, a truncated body must not
+            # look like a complete one
+            logger.error("Error streaming response from endpoint '{}': {}".format(ep, e))
+            raise
+        finally:
+            resp.close()
 
 
     def dispatcher(self, **kwargs):
@@ -87,7 +289,39 @@ class ProxyView(Resource):
         else:
             current_app.logger.info("Dispatching '{}' request to endpoint '{}'".format(request.method, ep))
         current_app.logger.info("Dispatching '{}' request to endpoint '{}'".format(request.method, ep))
-        resp = self.__getattribute__(request.method.lower())(ep, request)
+
+        cache_key = entry = None
+        if self.cache is not None and request.method == 'GET':
+            cache_key = self.cache.key(self.route, path, self.vary_values(self.cache_vary) + [self.accepted_encodings()])
+            entry = self.cache.get(cache_key)
+            if entry is not None and entry.is_fresh() \
+                    and 'no-cache' not in request.headers.get('Cache-Control', ''):
+                current_app.logger.info("Serving response of endpoint '{}' from the cache".format(ep))
+                return self.make_response(entry, ep)
+            if entry is not None and entry.etag:
+                # revalidate the stale entry instead of fetching it again
+                request.headers = Headers(request.headers)
+                request.headers.set('If-None-Match', entry.etag)
+
+        ticket = None
+        if self.breaker is not None:
+            ticket = self.breaker.allow()
+            if ticket is None:
+                current_app.logger.warning("Circuit open for '{}', not dispatching to endpoint '{}'".format(self.service_uri, ep))
+                return b'503 Service Unavailable', 503
+
+        success = False
+        start = time.time()
+        try:
+            resp = self.__getattribute__(request.method.lower())(ep, request)
+            # timeouts and connection errors come back as (text, 504)
+            success = not isinstance(resp, tuple) and resp.status_code not in self.breaker_error_statuses
+        finally:
+            # timed out calls count as well: the timeout grows back if the
+            # route gets slower
+            self.timeout.observe(time.time() - start)
+            if self.breaker is not None:
+                self.breaker.record(success, ticket)
 
         if isinstance(resp, tuple):
             if len(resp) == 2:
@@ -96,22 +330,167 @@ class ProxyView(Resource):
                 current_app.logger.info("Received response from endpoint '{}' with status code '{}'".format(ep, status_code))
                 return text, status_code
 
+        if cache_key is not None:
+            resp = self.store_response(cache_key, entry, resp)
+        return self.make_response(resp, ep)
+
+    def make_response(self, resp, ep):
+        """
+        Flask response of the upstream response (or cached response),
+        keeping the headers in REMOTE_PROXY_ALLOWED_HEADERS
+        """
         headers = {}
         if resp.headers:
-            [headers.update({key: resp.headers[key]}) for key in current_app.config['REMOTE_PROXY_ALLOWED_HEADERS'] if key in resp.headers]
+            [headers.update({key: resp.headers[key]}) for key in current_app.config['REMOTE_PROXY_ALLOWED_HEADERS'] + self.VALIDATOR_HEADERS if key in resp.headers]
 
         current_app.logger.info("Received response from endpoint '{}' with status code '{}'".format(ep, resp.status_code))
+        if self.stream and not isinstance(resp, CachedResponse) and self.should_stream(resp):
+            # a compressed body the client accepts goes through as it is
+            encoding = resp.headers.get('Content-Encoding')
+            passthrough = bool(encoding) and request.accept_encodings[encoding] > 0
+            if passthrough:
+                headers['Content-Encoding'] = encoding
+                if 'Content-Length' in resp.headers:
+                    headers['Content-Length'] = resp.headers['Content-Length']
+            return Response(self.iter_content(resp, ep, current_app.logger, decode_content=not passthrough),
+                            status=resp.status_code, headers=headers)
+        if isinstance(resp, CachedResponse) and 'Content-Encoding' in resp.headers:
+            headers['Content-Encoding'] = resp.headers['Content-Encoding']
+        if resp.status_code == 200 and request.method in ('GET', 'HEAD'):
+            if self.weak_etag and 'ETag' not in headers:
+                headers['ETag'] = 'W/"{}"'.format(hashlib.sha1(resp.content).hexdigest())
+            if self.not_modified(headers):
+                current_app.logger.info("Response of endpoint '{}' not modified".format(ep))
+                return b'', 304, headers
         if headers:
             return resp.content, resp.status_code, headers
         else:
             return resp.content, resp.status_code
 
+    @staticmethod
+    def not_modified(headers):
+        """
+        Whether the validators of the response (ETag, Last-Modified) match
+        the conditional headers of the client's request, i.e. a 304 is due.
+
+        They are read from the WSGI environ: request.headers may have been
+        changed to revalidate a cached response.
+        """
+        if request.if_none_match:
+            etag = headers.get('ETag')
+            return etag is not None and request.if_none_match.contains_weak(unquote_etag(etag)[0])
+        if request.if_modified_since and 'Last-Modified' in headers:
+            last_modified = parse_date(headers['Last-Modified'])
+            return last_modified is not None and last_modified <= request.if_modified_since
+        return False
+
+    def vary_values(self, vary):
+        """
+        Values of a vary set (e.g. of the route in
+        REMOTE_PROXY_CACHE_DEPLOY_PATHS) that are part of a cache key:
+        'user', 'client' and 'scopes' of the request, or the value of a
+        request header
+        """
+        oauth = getattr(request, 'oauth', None)
+        values = []
+        for name in vary:
+            if name == 'user':
+                values.append(current_user.get_id())
+            elif name == 'client':
+                values.append(oauth.client.client_id if oauth else None)
+            elif name == 'scopes':
+                values.append(' '.join(sorted(oauth.scopes or [])) if oauth else None)
+            else:
+                values.append(request.headers.get(name))
+        return values
+
+    def store_response(self, key, entry, resp):
+        """
+        Caches the upstream response if it is cacheable; a 304 to the
+        revalidation of a stale entry refreshes it. Returns the response to
+        send to the client.
+        """
+        authorized = 'Authorization' in request.headers
+        if resp.status_code == 304 and entry is not None:
+            entry = entry.revalidated(resp.headers)
+            ttl = self.cache.ttl(entry, self.cache_vary, authorized)
+            if ttl is not None:
+                entry = entry._replace(expires=time.time() + ttl)
+                self.cache.set(key, entry)
+            return entry
+        if self.stream and not isinstance(resp, CachedResponse) and self.should_stream(resp):
+            return resp
+        ttl = self.cache.ttl(resp, self.cache_vary, authorized)
+        if ttl is not None:
+            self.cache.set(key, CachedResponse.from_response(resp, ttl))
+        return resp
+
+    def send(self, method, ep, session=None, read=None, **kwargs):
+        """
+        Sends the request to the remote endpoint (overridden by the
+        alternative proxy engines); the response is fetched lazily
+
+        :param session: requests.Session to use instead of self.session,
+            e.g. to call a given instance of a consul service
+        :param read: function reading the response (see reader), None
+            returns it unread
+        """
+        resp = getattr(session or self.session, method)(ep, stream=True, **kwargs)
+        if read is None:
+            return resp
+        return read(resp)
+
+    def hedged_get(self, ep, **kwargs):
+        """
+        GET from one instance of the consul service and, if it has not
+        answered within the route's p95 latency (REMOTE_PROXY_HEDGING), from
+        another one as well: the first response wins. Hedges are limited by
+        the budget of the deploy path, and only sent once enough latencies
+        of the route were observed.
+        """
+        self.hedge_budget.deposit()
+        histogram = self.timeout.histogram
+        if histogram.count < self.hedge_min_samples:
+            return self.send('get', ep, **kwargs)
+        instances = consul_instances(self.cs)
+        if len(instances) < 2:
+            return self.send('get', ep, **kwargs)
+
+        def call(base_url):
+            url = urljoin(base_url, ep)
+            return lambda: self.send('get', url, session=self.cs.session, **kwargs)
+
+        primary, secondary = random.sample(instances, 2)
+        return first_response(
+            call(primary), call(secondary),
+            delay=histogram.percentile(self.hedge_percentile),
+            budget=self.hedge_budget,
+            close=lambda resp: resp.close()
+        )
+
     def get(self, ep, request):
         """
         Proxy to remote GET endpoint, should be invoked via self.dispatcher()
+
+        Identical concurrent GETs of the deploy paths in
+        REMOTE_PROXY_COALESCE_DEPLOY_PATHS share one upstream call (whatever
+        their user: the services behind those paths must not tell users
+        apart); responses setting cookies are not shared. Coalesced
+        responses are never streamed, whatever REMOTE_PROXY_STREAM_* say:
+        they are read once and served to every waiting request.
         """
+        read = self.reader(buffered=self.coalesce)
+
+        def fetch():
+            if self.hedge and self.cs is not None:
+                return self.hedged_get(ep, headers=request.headers, timeout=self.timeout.get(), read=read)
+            return self.send('get', ep, headers=request.headers, timeout=self.timeout.get(), read=read)
+
         try:
-            return self.session.get(ep, headers=request.headers, timeout=self.default_request_timeout)
+            if self.coalesce:
+                key = ResponseCache.key(self.route, ep, self.vary_values(self.COALESCE_KEY_HEADERS))
+                return single_flight.do(key, fetch, shareable=lambda resp: 'Set-Cookie' not in resp.headers)
+            return fetch()
         except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             return b'504 Gateway Timeout', 504
 
@@ -121,7 +500,7 @@ class ProxyView(Resource):
         """
 
         try:
-            return self.session.post(ep, data=ProxyView.get_body_data(request), headers=request.headers, timeout=self.default_request_timeout)
+            return self.send('post', ep, data=self.get_body(request), headers=request.headers, timeout=self.timeout.get(), read=self.reader())
         except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             return b'504 Gateway Timeout', 504
 
@@ -131,7 +510,7 @@ class ProxyView(Resource):
         """
 
         try:
-            return self.session.put(ep, data=ProxyView.get_body_data(request), headers=request.headers, timeout=self.default_request_timeout)
+            return self.send('put', ep, data=self.get_body(request), headers=request.headers, timeout=self.timeout.get(), read=self.reader())
         except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             return b'504 Gateway Timeout', 504
 
@@ -141,6 +520,48 @@ class ProxyView(Resource):
         """
 
         try:
-            return self.session.delete(ep, data=ProxyView.get_body_data(request), headers=request.headers, timeout=self.default_request_timeout)
+            return self.send('delete', ep, data=self.get_body(request), headers=request.headers, timeout=self.timeout.get(), read=self.reader())
         except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             return b'504 Gateway Timeout', 504
+
+
+class GeventProxyView(ProxyView):
+    """
+    ProxyView for gevent workers (e.g. gunicorn -k gevent, which patches
+    the sockets): waiting on the remote service only suspends the greenlet
+    of the request, so that a worker can hold thousands of proxied calls.
+
+    Their number is bounded per process (REMOTE_PROXY_MAX_INFLIGHT) and
+    every call gets an overall deadline of the route's timeout, waiting for
+    a slot included (the requests timeout only applies to each socket
+    operation).
+    """
+
+    inflight = None  # semaphore shared by all the views of the process
+
+    def __init__(self, endpoint, service_uri, deploy_path, route, timeout=None):
+        if gevent is None:
+            raise RuntimeError("The gevent proxy engine requires gevent")
+        super(GeventProxyView, self).__init__(endpoint, service_uri, deploy_path, route, timeout)
+        if GeventProxyView.inflight is None:
+            try:
+                max_inflight = current_app.config.get("REMOTE_PROXY_MAX_INFLIGHT", 5000)
+            except RuntimeError:
+                max_inflight = 5000
+            if not monkey.is_module_patched('socket'):
+                # there may be no app context (e.g. unit tests)
+                logger.warning("The gevent proxy engine is used without monkey patching: upstream calls will block the worker")
+            GeventProxyView.inflight = BoundedSemaphore(max_inflight)
+
+    def send(self, method, ep, **kwargs):
+        timeout = kwargs.get('timeout', self.default_request_timeout)
+        deadline = gevent.Timeout(
+            timeout,
+            requests.exceptions.Timeout("No response from '{}' within {}s".format(ep, timeout))
+        )
+        deadline.start()
+        try:
+            with GeventProxyView.inflight:
+                return super(GeventProxyView, self).send(method, ep, **kwargs)
+        finally:
+            deadline.cancel()
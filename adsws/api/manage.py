@@ -0,0 +1,40 @@
+"""
+Management commands of the API
+"""
+
+import time
+
+from flask.ext.script import Manager
+
+from adsws.api import create_app
+from adsws.api.discoverer.snapshot import write_discovery_snapshot
+
+# the API app is only created by the commands that need it: creating it
+# discovers the remote services
+api_manager = Manager(create_app)
+api_manager.__doc__ = __doc__  # Overwrite default docstring
+
+
+@api_manager.command
+def discovery_snapshot(app_override=None, interval=0):
+    """
+    Queries the remote services and writes the discovery snapshot
+    (WEBSERVICES_DISCOVERY_SNAPSHOT) loaded by the workers at startup;
+    the services that cannot be queried keep their previous entry
+
+    :param app_override: flask.app instance to use instead of the API app
+    :param interval: if not 0, keeps regenerating the snapshot every
+        `interval` seconds
+    :return: None
+    """
+
+    app = create_app() if app_override is None else app_override
+    interval = int(interval)
+
+    while True:
+        failed = write_discovery_snapshot(app)
+        app.logger.info('Wrote the discovery snapshot, {0} services could not '
+                        'be queried: {1}'.format(len(failed), failed))
+        if not interval:
+            return
+        time.sleep(interval)
@@ -2,6 +2,12 @@ from adsws.modules.oauth2server.provider import oauth2
 from flask.ext.restful import Resource
 from adsws.core import user_manipulator
 from flask import current_app, request, abort
+from discoverer.pools import pool_registry
+from discoverer.breaker import breakers
+from discoverer.hedging import hedge_budgets
+from discoverer.cache import response_caches
+from discoverer.coalescing import single_flight
+from adsws.ext.sqlalchemy import engines
 
 
 class ProtectedView(Resource):
@@ -27,6 +33,60 @@ class StatusView(Resource):
         }, 200
 
 
+class ConnectionPoolsView(Resource):
+    """
+    Returns the statistics of the connection pools to the remote services
+    """
+    decorators = [oauth2.require_oauth('adsws:internal')]
+    def get(self):
+        return pool_registry.stats(), 200
+
+
+class DatabasePoolsView(Resource):
+    """
+    Returns the occupancy of the connection pools to the databases
+    """
+    decorators = [oauth2.require_oauth('adsws:internal')]
+    def get(self):
+        return engines.status(), 200
+
+
+class CircuitBreakersView(Resource):
+    """
+    Returns the state of the circuit breakers of the remote services
+    """
+    decorators = [oauth2.require_oauth('adsws:internal')]
+    def get(self):
+        return breakers.status(), 200
+
+
+class HedgingView(Resource):
+    """
+    Returns the requests and hedges sent per deploy path
+    """
+    decorators = [oauth2.require_oauth('adsws:internal')]
+    def get(self):
+        return hedge_budgets.status(), 200
+
+
+class ResponseCacheView(Resource):
+    """
+    Returns the statistics of the cache of the remote services responses
+    """
+    decorators = [oauth2.require_oauth('adsws:internal')]
+    def get(self):
+        return response_caches.status(), 200
+
+
+class CoalescingView(Resource):
+    """
+    Returns the upstream GETs sent and the ones coalesced into them
+    """
+    decorators = [oauth2.require_oauth('adsws:internal')]
+    def get(self):
+        return single_flight.status(), 200
+
+
 class UserResolver(Resource):
     """
     Resolves an email or uid into a string formatted user object
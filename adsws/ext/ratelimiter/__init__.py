@@ -33,13 +33,11 @@ class ADSLimiter(Limiter):
         kwargs.update({'shared': True})
         return self._limit_and_check(*args, **kwargs)
 
-    def _limit_and_check(self, *args, **kwargs):
+    def register_limit(self, func, *args, **kwargs):
         """
-        auto_check should be False or Flask Limiter 0.9.5.1 will be run before OAuth
-        plugin, but then this method should be used as decorator to trigger
-        the actual check when the requests is treated.
-
-        https://github.com/alisaifee/flask-limiter/issues/67
+        Registers the limit of the view function without decorating it:
+        self.check() has to be called when the view runs (see
+        adsws.api.discoverer.pipeline.RateLimitStage)
         """
         kwargs.setdefault('key_func', None)
         kwargs.setdefault('shared', False)
@@ -48,9 +46,19 @@ class ADSLimiter(Limiter):
         kwargs.setdefault('methods', None)
         kwargs.setdefault('error_message', None)
         kwargs.setdefault('exempt_when', None)
+        self._Limiter__limit_decorator(*args, **kwargs)(func)
+
+    def _limit_and_check(self, *args, **kwargs):
+        """
+        auto_check should be False or Flask Limiter 0.9.5.1 will be run before OAuth
+        plugin, but then this method should be used as decorator to trigger
+        the actual check when the requests is treated.
+
+        https://github.com/alisaifee/flask-limiter/issues/67
+        """
         def inner(func):
             # register for check
-            self._Limiter__limit_decorator(*args, **kwargs)(func)
+            self.register_limit(func, *args, **kwargs)
 
             @wraps(func)
             def check(*args, **kwargs):
@@ -1,8 +1,202 @@
+"""
+SQLAlchemy extension
+
+Every app created by adsws.factory.create_app initializes the same
+Flask-SQLAlchemy instance, and Flask-SQLAlchemy gives each app its own
+engine (and so its own connection pool), even when they all connect to the
+same database. The engines are instead kept in the process-wide `engines`
+registry, keyed by database url: the apps of a process share one pool per
+database. The pool is sized by the settings of the app creating it
+(SQLALCHEMY_POOL_SIZE, SQLALCHEMY_MAX_OVERFLOW, SQLALCHEMY_POOL_RECYCLE,
+SQLALCHEMY_POOL_TIMEOUT, SQLALCHEMY_POOL_PRE_PING).
+
+In-memory sqlite databases are not shared: such a database lives in its
+connection, each app keeps its own.
+"""
+
+import threading
+
+import sqlalchemy
+from flask import g, has_app_context, current_app
 from flask_registry import RegistryProxy, ModuleAutoDiscoveryRegistry
-from flask_sqlalchemy import SQLAlchemy as FlaskSQLAlchemy
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy, _EngineConnector, \
+    _EngineDebuggingSignalEvents, _record_queries
+from sqlalchemy import event, exc, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+
+def ping_connection(connection, branch):
+    """
+    Checks the connection before it is used (SQLALCHEMY_POOL_PRE_PING),
+    reconnecting if the database dropped it, as per
+    http://docs.sqlalchemy.org/en/rel_1_1/core/pooling.html#disconnect-handling-pessimistic
+    """
+    if branch:
+        # a sub-connection of an already checked connection
+        return
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError, e:
+        # the pool is invalidated by a disconnect, the retry reconnects
+        if e.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+class EngineRegistry(object):
+    """
+    SQLAlchemy engines keyed by database url, shared by the apps of the
+    process
+    """
+
+    def __init__(self):
+        self._engines = {}
+        self._apps = {}
+        self._lock = threading.Lock()
+
+    def get_engine(self, url, options, app_name=None):
+        """
+        Returns the engine of the database url, creating it with the given
+        create_engine options the first time
+
+        :param url: sqlalchemy.engine.url.URL of the database
+        :param options: create_engine options (plus 'pool_pre_ping')
+        :param app_name: name of the app using the engine
+        """
+        key = str(url)
+        with self._lock:
+            if key not in self._engines:
+                options = dict(options)
+                pre_ping = options.pop('pool_pre_ping', False)
+                engine = sqlalchemy.create_engine(url, **options)
+                if pre_ping:
+                    event.listen(engine, "engine_connect", ping_connection)
+                self._engines[key] = engine
+                self._apps[key] = []
+            if app_name is not None and app_name not in self._apps[key]:
+                self._apps[key].append(app_name)
+            return self._engines[key]
+
+    def dispose(self):
+        """
+        Closes the connections of every pool, e.g. after a fork
+        """
+        with self._lock:
+            engines = self._engines.values()
+        for engine in engines:
+            engine.dispose()
+
+    def clear(self):
+        self.dispose()
+        with self._lock:
+            self._engines.clear()
+            self._apps.clear()
+
+    def status(self):
+        """
+        Occupancy of the pool of every database (password hidden), e.g.
+        {'postgresql://adsws:***@db/adsws': {'apps': ['adsws.api',
+        'adsws.accounts'], 'pool': 'QueuePool', 'size': 5, 'max_overflow': 10,
+        'checked_in': 2, 'checked_out': 1, 'overflow': -2}}
+        size: connections kept in the pool, checked_in: open connections
+        waiting in the pool, checked_out: connections in use, overflow:
+        connections opened beyond size (negative while the pool is not
+        full yet)
+        """
+        with self._lock:
+            engines = self._engines.items()
+            apps = dict((key, list(names)) for key, names in self._apps.iteritems())
+        status = {}
+        for key, engine in engines:
+            pool = engine.pool
+            entry = {
+                'apps': apps[key],
+                'pool': type(pool).__name__,
+            }
+            if isinstance(pool, QueuePool):
+                entry.update(
+                    size=pool.size(),
+                    max_overflow=pool._max_overflow,
+                    checked_in=pool.checkedin(),
+                    checked_out=pool.checkedout(),
+                    overflow=pool.overflow(),
+                )
+            status[repr(engine.url)] = entry
+        return status
+
+
+#: process-wide registry of the engines
+engines = EngineRegistry()
+
+
+class QueryRecorder(_EngineDebuggingSignalEvents):
+    """
+    Records the queries of one app (SQLALCHEMY_RECORD_QUERIES, see
+    flask_sqlalchemy.get_debug_queries) on an engine it may share with
+    other apps
+    """
+
+    def __init__(self, engine, app):
+        super(QueryRecorder, self).__init__(engine, app.import_name)
+        self.app = app
+
+    def after_cursor_execute(self, *args):
+        if has_app_context() and current_app._get_current_object() is self.app:
+            super(QueryRecorder, self).after_cursor_execute(*args)
+
+
+class EngineConnector(_EngineConnector):
+    """
+    Engine connector of an app, taking the engine from the registry
+
+    It overrides a private class of Flask-SQLAlchemy, hence the version
+    pinned in requirements.txt.
+    """
+
+    def get_engine(self):
+        with self._lock:
+            uri = self.get_uri()
+            echo = self._app.config['SQLALCHEMY_ECHO']
+            if (uri, echo) == self._connected_for:
+                return self._engine
+            info = make_url(uri)
+            options = {'convert_unicode': True}
+            self._sa.apply_pool_defaults(self._app, options)
+            rv = self._sa.apply_driver_hacks(self._app, info, options)
+            if rv is not None:
+                # Flask-SQLAlchemy >= 2.4 returns them instead
+                info, options = rv
+            if echo:
+                options['echo'] = echo
+            if info.drivername == 'sqlite' and info.database in (None, '', ':memory:'):
+                self._engine = sqlalchemy.create_engine(info, **options)
+            else:
+                if self._app.config.get('SQLALCHEMY_POOL_PRE_PING'):
+                    options['pool_pre_ping'] = True
+                self._engine = engines.get_engine(info, options, self._app.name)
+            if _record_queries(self._app):
+                QueryRecorder(self._engine, self._app).register()
+            self._connected_for = (uri, echo)
+            return self._engine
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """
+    Flask-SQLAlchemy whose apps share the engines of the registry
+    """
+
+    def make_connector(self, app=None, bind=None):
+        return EngineConnector(self, self.get_app(app), bind)
+
 
 #: Flask-SQLAlchemy extension instance
-db = FlaskSQLAlchemy()
+db = SQLAlchemy()
 
 models = RegistryProxy('models', ModuleAutoDiscoveryRegistry, 'models')
 
@@ -18,19 +212,51 @@ def setup_app(app):
     ## pysqlite driver breaks transactions, we have to apply some hacks as per
     ## http://docs.sqlalchemy.org/en/rel_0_9/dialects/sqlite.html#pysqlite-serializable
     if 'sqlite:' in app.config.get('SQLALCHEMY_DATABASE_URI'):
-        from sqlalchemy import event
+        # the engine may be shared with an app already set up
         engine = db.get_engine(app)
-        
-        @event.listens_for(engine, "connect")
-        def do_connect(dbapi_connection, connection_record):
-            # disable pysqlite's emitting of the BEGIN statement entirely.
-            # also stops it from emitting COMMIT before any DDL.
-            dbapi_connection.isolation_level = None
+        if not event.contains(engine, "connect", _sqlite_connect):
+            event.listen(engine, "connect", _sqlite_connect)
+        if not event.contains(engine, "begin", _sqlite_begin):
+            event.listen(engine, "begin", _sqlite_begin)
+
+    if app.config.get('SQLALCHEMY_COUNT_STATEMENTS', False):
+        count_statements(app)
+
+    return app
+
+
+def _sqlite_connect(dbapi_connection, connection_record):
+    # disable pysqlite's emitting of the BEGIN statement entirely.
+    # also stops it from emitting COMMIT before any DDL.
+    dbapi_connection.isolation_level = None
+
+
+def _sqlite_begin(conn):
+    # emit our own BEGIN
+    conn.execute("BEGIN EXCLUSIVE")
+
+
+def count_statements(app):
+    """Count the SQL statements issued while serving a request; the number
+    is returned to the client in the X-Adsws-Sql-Statements header (it is
+    meant for tests and debugging, to catch extra round trips to the db)
+    """
+    engine = db.get_engine(app)
+    if not event.contains(engine, "before_cursor_execute", _count_statement):
+        event.listen(engine, "before_cursor_execute", _count_statement)
+
+    @app.before_request
+    def reset_statement_count():
+        g.sql_statements = 0
 
-        @event.listens_for(engine, "begin")
-        def do_begin(conn):
-            # emit our own BEGIN
-            conn.execute("BEGIN EXCLUSIVE")
+    @app.after_request
+    def report_statement_count(response):
+        response.headers['X-Adsws-Sql-Statements'] = \
+            str(g.get('sql_statements', 0))
+        return response
 
 
-    return app
\ No newline at end of file
+def _count_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    if has_app_context():
+        g.sql_statements = g.get('sql_statements', 0) + 1
\ No newline at end of file
@@ -25,6 +25,7 @@ from flask_registry import Registry, ExtensionRegistry, \
 from adsmutils import ADSFlask
 
 from .middleware import HTTPMethodOverrideMiddleware
+from .startup import profile
 
 
 def create_app(app_name=None, instance_path=None, static_path=None,
@@ -41,6 +42,16 @@ def create_app(app_name=None, instance_path=None, static_path=None,
     # Flask application name
     app_name = app_name or '.'.join(__name__.split('.')[0:-1])
 
+    with profile.phase(app_name):
+        return _create_app(app_name, instance_path, static_path,
+                           static_folder, **config)
+
+
+def _create_app(app_name, instance_path, static_path, static_folder, **config):
+    """
+    create_app, whose phases are recorded in adsws.startup.profile
+    """
+
     # Force instance folder to always be located one level above adsws
     instance_path = instance_path or os.path.realpath(os.path.join(
         os.path.dirname(__file__), '../instance'
@@ -65,7 +76,8 @@ def create_app(app_name=None, instance_path=None, static_path=None,
     # Handle both URLs with and without trailing slashes by Flask.
     app.url_map.strict_slashes = False
 
-    load_config(app, config)
+    with profile.phase('load_config'):
+        load_config(app, config)
 
     # Ensure SECRET_KEY has a value in the application configuration
     register_secret_key(app)
@@ -75,22 +87,28 @@ def create_app(app_name=None, instance_path=None, static_path=None,
     # ====================
     # Initialize application registry, used for discovery and loading of
     # configuration, extensions and Invenio packages
-    Registry(app=app)
+    with profile.phase('Registry'):
+        Registry(app=app)
 
-    app.extensions['registry'].update(
-        # Register packages listed in config
-        packages=PackageRegistry(app))
+        app.extensions['registry'].update(
+            # Register packages listed in config
+            packages=PackageRegistry(app))
 
-    app.extensions['registry'].update(
+    with profile.phase('ExtensionRegistry'):
         # Register extensions listed in config
-        extensions=ExtensionRegistry(app),
+        extensions = ExtensionRegistry(app)
+    with profile.phase('BlueprintAutoDiscoveryRegistry'):
         # Register blueprints
-        blueprints=BlueprintAutoDiscoveryRegistry(app=app),
+        blueprints = BlueprintAutoDiscoveryRegistry(app=app)
+    app.extensions['registry'].update(
+        extensions=extensions,
+        blueprints=blueprints,
     )
 
     # Extend application config with configuration from packages (app config
     # takes precedence)
-    ConfigurationRegistry(app)
+    with profile.phase('ConfigurationRegistry'):
+        ConfigurationRegistry(app)
 
     configure_a_more_verbose_log_exception(app)
 
@@ -251,6 +269,9 @@ def set_translations():
     g._ = _
 
 
+FORM_MIMETYPES = ('application/x-www-form-urlencoded', 'multipart/form-data')
+
+
 def cache_data_stream():
     """Workaround for remembering the input stream data (i.e. input stream
     will be saved/cached and can be retrieved.
@@ -264,9 +285,15 @@ def cache_data_stream():
           called first
         - if you call request.form, the stream is read and it can
           never be retrieved again (it is a socked)
+
+    Only form data is parsed by request.form, so other payloads (e.g. json
+    uploads) are left in the stream: they are read once, when needed, and
+    can be proxied without a copy in memory.
           
     Important detail: always set MAX_CONTENT_LENGTH
     """
+    if request.mimetype not in FORM_MIMETYPES:
+        return
     cl = request.content_length
     ml = current_app.config.get('MAX_CONTENT_LENGTH', 1024*1024*5)
     if ml is None or ml > cl:
@@ -22,4 +22,8 @@ class GlobalResourcesView(Resource):
     decorators = [ratelimit.shared_limit_and_check("100/86400 second", scope=scope_func)]
 
     def get(self):
-        return current_app.config['resources']
+        resources = current_app.config['resources']
+        # computed at request time by the lazily mounted deployments
+        if callable(resources):
+            resources = resources()
+        return resources
@@ -6,7 +6,10 @@
     middleware module
 """
 
+import threading
+
 from werkzeug import url_decode
+from werkzeug.wsgi import DispatcherMiddleware
 
 
 class HTTPMethodOverrideMiddleware(object):
@@ -56,3 +59,48 @@ class HTTPMethodOverrideMiddleware(object):
             environ['CONTENT_LENGTH'] = '0'
 
         return self.app(environ, start_response)
+
+
+class LazyApplication(object):
+    """WSGI application created by `factory` when it is first needed: at
+    its first request, or at the first access to one of its attributes
+    (which are those of the created application).
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._app = None
+        self._lock = threading.Lock()
+
+    @property
+    def app(self):
+        if self._app is None:
+            with self._lock:
+                if self._app is None:
+                    self._app = self.factory()
+        return self._app
+
+    @property
+    def created(self):
+        return self._app is not None
+
+    def __getattr__(self, name):
+        return getattr(self.app, name)
+
+    def __call__(self, environ, start_response):
+        return self.app(environ, start_response)
+
+
+class LazyDispatcherMiddleware(DispatcherMiddleware):
+    """DispatcherMiddleware taking factories of the applications instead of
+    the applications: each one is created when its mount point gets its
+    first request (see LazyApplication), so that a process only builds the
+    applications it serves.
+    """
+
+    def __init__(self, app_factory, mounts=None):
+        super(LazyDispatcherMiddleware, self).__init__(
+            LazyApplication(app_factory),
+            dict((prefix, LazyApplication(factory))
+                 for prefix, factory in (mounts or {}).iteritems())
+        )
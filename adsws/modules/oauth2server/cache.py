@@ -0,0 +1,574 @@
+# -*- coding: utf-8 -*-
+
+"""
+Cache of resolved OAuth access tokens
+
+Every request to the API has to resolve its bearer token into the token,
+the client (ratelimit) and the user (id, email). The cache keeps an
+immutable snapshot of those three records so that the database is not
+contacted again until the entry expires or is explicitly invalidated.
+
+Each worker process has its own LRU; optionally it is backed by redis, which
+is shared by all the workers (and pods), remembers unknown tokens for a
+short while and broadcasts invalidations to the other workers.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import calendar
+import threading
+from datetime import datetime, timedelta
+from collections import OrderedDict, namedtuple
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+UNKNOWN_TOKEN = object()
+""" Returned by TokenCache.get for tokens known not to exist """
+
+
+def token_digest(access_token):
+    """
+    Access tokens are credentials: only their digest is ever sent to redis
+    """
+    if isinstance(access_token, unicode):
+        access_token = access_token.encode('utf-8')
+    return hashlib.sha256(access_token).hexdigest()
+
+
+class ClientSnapshot(namedtuple('ClientSnapshot', [
+        'client_id', 'user_id', 'name', 'ratelimit', 'is_confidential',
+        'is_internal'])):
+    """
+    Read-only copy of the OAuthClient attributes used during a request
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_client(cls, client):
+        return cls(
+            client_id=client.client_id,
+            user_id=client.user_id,
+            name=client.name,
+            ratelimit=client.ratelimit,
+            is_confidential=client.is_confidential,
+            is_internal=client.is_internal,
+        )
+
+
+class RoleSnapshot(namedtuple('RoleSnapshot', ['id', 'name'])):
+    """
+    Read-only copy of a Role (flask-security only needs its name)
+    """
+    __slots__ = ()
+
+
+class UserSnapshot(namedtuple('UserSnapshot', [
+        'id', 'email', 'active', 'ratelimit_level', 'roles'])):
+    """
+    Read-only copy of the User attributes used during a request; any
+    other attribute is looked up on the User model (like OAuthUserProxy
+    does)
+
+    It implements the flask-login user interface, so it can be logged in
+    without loading the User model again.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(
+            id=user.id,
+            email=user.email,
+            active=user.active,
+            ratelimit_level=user.ratelimit_level,
+            roles=tuple(RoleSnapshot(r.id, r.name) for r in user.roles),
+        )
+
+    def get_id(self):
+        return unicode(self.id)
+
+    def is_active(self):
+        return bool(self.active)
+
+    def is_authenticated(self):
+        return True
+
+    def is_anonymous(self):
+        return False
+
+    def has_role(self, role):
+        return getattr(role, 'name', role) in [r.name for r in self.roles]
+
+    def __getattr__(self, name):
+        """ Pass any undefined attribute to the underlying object """
+        if name.startswith('__'):
+            raise AttributeError(name)
+        from adsws.core import user_manipulator
+        return getattr(user_manipulator.get(self.id), name)
+
+
+class TokenSnapshot(namedtuple('TokenSnapshot', [
+        'id', 'access_token', 'token_type', 'client_id', 'user_id',
+        'expires_at', 'sliding_expiry', 'scopes', 'is_personal',
+        'is_internal', 'client', 'user'])):
+    """
+    Read-only copy of an OAuthToken (together with its client and user);
+    it quacks like the model as far as flask-oauthlib is concerned
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_token(cls, token, sliding_expiry=None):
+        """
+        :param token: OAuthToken instance
+        :param sliding_expiry: if set, the token expires that many seconds
+            after it was last used (instead of at token.expires)
+        """
+        return cls(
+            id=token.id,
+            access_token=token.access_token,
+            token_type=token.token_type,
+            client_id=token.client_id,
+            user_id=token.user_id,
+            expires_at=token.expires,
+            sliding_expiry=sliding_expiry,
+            scopes=tuple(token.scopes),
+            is_personal=token.is_personal,
+            is_internal=token.is_internal,
+            client=token.client and ClientSnapshot.from_client(token.client),
+            user=token.user and UserSnapshot.from_user(token.user),
+        )
+
+    @property
+    def expires(self):
+        """
+        With a sliding expiry the token is being used right now, so it
+        expires `sliding_expiry` seconds from now; this is computed in memory
+        and never written back to the database
+        """
+        if self.sliding_expiry is not None:
+            return datetime.utcnow() + timedelta(seconds=self.sliding_expiry)
+        return self.expires_at
+
+    def dumps(self):
+        """
+        Compact serialized form (a JSON list of the values, positionally);
+        the access token itself is not included
+        """
+        client, user = self.client, self.user
+        return json.dumps([
+            self.id, self.token_type, self.client_id, self.user_id,
+            self.expires_at and calendar.timegm(self.expires_at.timetuple()),
+            self.sliding_expiry, ' '.join(self.scopes),
+            self.is_personal, self.is_internal,
+            client and [client.user_id, client.name, client.ratelimit,
+                        client.is_confidential, client.is_internal],
+            user and [user.email, user.active, user.ratelimit_level,
+                      [list(r) for r in user.roles]],
+        ], separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, access_token, data):
+        """
+        Inverse of dumps()
+        """
+        (id, token_type, client_id, user_id, expires_at, sliding_expiry,
+         scopes, is_personal, is_internal, client, user) = json.loads(data)
+        return cls(
+            id=id,
+            access_token=access_token,
+            token_type=token_type,
+            client_id=client_id,
+            user_id=user_id,
+            expires_at=expires_at and datetime.utcfromtimestamp(expires_at),
+            sliding_expiry=sliding_expiry,
+            scopes=tuple(scopes.split()),
+            is_personal=is_personal,
+            is_internal=is_internal,
+            client=client and ClientSnapshot(client_id, *client),
+            user=user and UserSnapshot(
+                user_id, user[0], user[1], user[2],
+                tuple(RoleSnapshot(*r) for r in user[3])),
+        )
+
+
+class RedisTokenStore(object):
+    """
+    Token cache shared through redis
+
+    Entries are stored under the digest of the access token; unknown tokens
+    are stored too (as an empty string, with a shorter expiration). Sets
+    indexed by client and by user allow to drop all the entries of a client
+    or a user. Invalidations are published on `channel` so that the workers
+    can evict their own copies.
+
+    Redis is an optimization: every error is logged and treated as a miss.
+    """
+    UNKNOWN = ''
+
+    def __init__(self, connection, prefix='oauth2token', ttl=300,
+                 negative_ttl=30):
+        self.redis = connection
+        self.prefix = prefix
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.channel = '{0}:invalidate'.format(prefix)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        return cls(redis.StrictRedis.from_url(url), **kwargs)
+
+    def _key(self, *parts):
+        return ':'.join([self.prefix] + [unicode(p) for p in parts])
+
+    def get(self, access_token):
+        """
+        Returns the snapshot, UNKNOWN_TOKEN or None
+        """
+        try:
+            data = self.redis.get(self._key(token_digest(access_token)))
+        except redis.RedisError, e:
+            logger.warning("Could not read token from redis: {0}".format(e))
+            return None
+        if data is None:
+            return None
+        if data == self.UNKNOWN:
+            return UNKNOWN_TOKEN
+        return TokenSnapshot.loads(access_token, data)
+
+    def set(self, access_token, snapshot):
+        key = self._key(token_digest(access_token))
+        try:
+            pipe = self.redis.pipeline()
+            pipe.set(key, snapshot.dumps(), ex=self.ttl)
+            for index in (self._key('client', snapshot.client_id),
+                          self._key('user', snapshot.user_id)):
+                pipe.sadd(index, key)
+                pipe.expire(index, self.ttl)
+            pipe.execute()
+        except redis.RedisError, e:
+            logger.warning("Could not store token in redis: {0}".format(e))
+
+    def set_unknown(self, access_token):
+        if not self.negative_ttl:
+            return
+        try:
+            self.redis.set(self._key(token_digest(access_token)),
+                           self.UNKNOWN, ex=self.negative_ttl)
+        except redis.RedisError, e:
+            logger.warning("Could not store token in redis: {0}".format(e))
+
+    def invalidate(self, *access_tokens):
+        digests = [token_digest(t) for t in access_tokens]
+        self._delete([self._key(d) for d in digests], {'tokens': digests})
+
+    def invalidate_client(self, client_id):
+        self._delete_index(self._key('client', client_id),
+                           {'client_id': client_id})
+
+    def invalidate_user(self, user_id):
+        self._delete_index(self._key('user', user_id), {'user_id': user_id})
+
+    def _delete_index(self, index, message):
+        try:
+            keys = list(self.redis.smembers(index))
+        except redis.RedisError, e:
+            logger.warning("Could not invalidate tokens in redis: {0}"
+                           .format(e))
+            keys = []
+        self._delete(keys + [index], message)
+
+    def _delete(self, keys, message):
+        try:
+            pipe = self.redis.pipeline()
+            if keys:
+                pipe.delete(*keys)
+            pipe.publish(self.channel, json.dumps(message))
+            pipe.execute()
+        except redis.RedisError, e:
+            logger.warning("Could not invalidate tokens in redis: {0}"
+                           .format(e))
+
+    def listen(self, callback):
+        """
+        Blocks, passing every invalidation message to callback
+        """
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        for message in pubsub.listen():
+            if message['type'] == 'message':
+                callback(json.loads(message['data']))
+
+
+class TokenCache(object):
+    """
+    Bounded LRU cache with a time-to-live, keyed by the access token
+
+    It is shared by all the threads (and applications) of a worker
+    process; a size of 0 disables the cache. Unknown tokens are remembered
+    in a separate LRU (`negative_size`, `negative_ttl`), so that garbage
+    tokens cannot evict the valid ones. If a `store` (RedisTokenStore) is
+    set, it is consulted on local misses and kept in sync on invalidations.
+    """
+    RESUBSCRIBE_DELAY = 5
+
+    def __init__(self, size=10000, ttl=60, store=None, negative_size=10000,
+                 negative_ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self.store = store
+        self.negative_size = negative_size
+        self.negative_ttl = negative_ttl
+        # {access_token: (deadline, snapshot, digest)}
+        self._data = OrderedDict()
+        # {access_token: (deadline, digest)}
+        self._unknown = OrderedDict()
+        # {digest: access_token} of both, for the invalidations published
+        # by the other workers (see on_invalidation)
+        self._digests = {}
+        self._unknown_digests = {}
+        self._lock = threading.Lock()
+        self._listener = None
+        self._settings = None
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        """
+        Configures the cache from the settings of the app
+
+        The cache is shared by the applications of the process, so it is
+        configured once, by the first app, and never cleared: the apps set
+        up afterwards (possibly while others are serving) must have the
+        same settings, or they get a warning and the cache as it is.
+        """
+        settings = dict(
+            size=app.config.get('OAUTH2_TOKEN_CACHE_SIZE', self.size),
+            ttl=app.config.get('OAUTH2_TOKEN_CACHE_TTL', self.ttl),
+            negative_size=app.config.get('OAUTH2_TOKEN_CACHE_NEGATIVE_SIZE',
+                                         self.negative_size),
+            negative_ttl=app.config.get('OAUTH2_TOKEN_CACHE_NEGATIVE_TTL',
+                                        self.negative_ttl),
+            redis_url=app.config.get('OAUTH2_TOKEN_CACHE_REDIS_URL'),
+            redis_prefix=app.config.get('OAUTH2_TOKEN_CACHE_REDIS_PREFIX',
+                                        'oauth2token'),
+            redis_ttl=app.config.get('OAUTH2_TOKEN_CACHE_REDIS_TTL', 300),
+        )
+        with self._lock:
+            if self._settings is not None:
+                if settings != self._settings:
+                    app.logger.warning(
+                        "The token cache is shared with another app, ignoring "
+                        "the OAUTH2_TOKEN_CACHE_* settings of {0}"
+                        .format(app.name))
+                return
+            self._settings = settings
+
+        self.size = settings['size']
+        self.ttl = settings['ttl']
+        self.negative_size = settings['negative_size']
+        self.negative_ttl = settings['negative_ttl']
+        if settings['redis_url']:
+            self.store = RedisTokenStore.from_url(
+                settings['redis_url'],
+                prefix=settings['redis_prefix'],
+                ttl=settings['redis_ttl'],
+                negative_ttl=self.negative_ttl,
+            )
+        else:
+            self.store = None
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, access_token):
+        return access_token in self._data
+
+    def get(self, access_token):
+        """
+        Returns the cached snapshot, UNKNOWN_TOKEN if the token is known not
+        to exist, or None
+        """
+        snapshot = self._get_local(access_token)
+        if snapshot is None and self._is_unknown(access_token):
+            return UNKNOWN_TOKEN
+        if snapshot is None and self.store is not None:
+            self._listen()
+            snapshot = self.store.get(access_token)
+            if isinstance(snapshot, TokenSnapshot):
+                self._set_local(access_token, snapshot)
+            elif snapshot is UNKNOWN_TOKEN:
+                self._set_unknown_local(access_token)
+        return snapshot
+
+    def _get_local(self, access_token):
+        """
+        Returns the snapshot cached by this process or None (expired entries
+        are dropped)
+        """
+        if not self.size:
+            return None
+        with self._lock:
+            entry = self._pop(access_token)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            # re-insert to mark the entry as the most recently used
+            self._data[access_token] = entry
+            self._digests[entry[2]] = access_token
+            self.hits += 1
+            return entry[1]
+
+    def set(self, access_token, snapshot):
+        self._set_local(access_token, snapshot)
+        if self.store is not None:
+            self.store.set(access_token, snapshot)
+
+    def set_unknown(self, access_token):
+        """ Remembers that the token doesn't exist """
+        self._set_unknown_local(access_token)
+        if self.store is not None:
+            self.store.set_unknown(access_token)
+
+    def _set_local(self, access_token, snapshot):
+        if not self.size:
+            return
+        digest = token_digest(access_token)
+        with self._lock:
+            self._pop(access_token)
+            self._data[access_token] = (time.time() + self.ttl, snapshot, digest)
+            self._digests[digest] = access_token
+            while len(self._data) > self.size:
+                self._pop(next(iter(self._data)))
+
+    def _pop(self, access_token):
+        """ Drops the entry of the token and returns it (lock held) """
+        entry = self._data.pop(access_token, None)
+        if entry is not None:
+            del self._digests[entry[2]]
+        return entry
+
+    def _pop_unknown(self, access_token):
+        """ Forgets that the token doesn't exist (lock held) """
+        entry = self._unknown.pop(access_token, None)
+        if entry is not None:
+            del self._unknown_digests[entry[1]]
+        return entry
+
+    def _is_unknown(self, access_token):
+        if not self.negative_size:
+            return False
+        with self._lock:
+            entry = self._unknown.get(access_token)
+            if entry is None:
+                return False
+            if entry[0] < time.time():
+                self._pop_unknown(access_token)
+                return False
+            return True
+
+    def _set_unknown_local(self, access_token):
+        if not self.negative_size or not self.negative_ttl:
+            return
+        digest = token_digest(access_token)
+        with self._lock:
+            # entries all have the same ttl: the oldest come first
+            self._pop_unknown(access_token)
+            self._unknown[access_token] = (time.time() + self.negative_ttl, digest)
+            self._unknown_digests[digest] = access_token
+            while len(self._unknown) > self.negative_size:
+                self._pop_unknown(next(iter(self._unknown)))
+
+    def invalidate(self, *access_tokens):
+        with self._lock:
+            for access_token in access_tokens:
+                self._pop(access_token)
+                self._pop_unknown(access_token)
+        if self.store is not None and access_tokens:
+            self.store.invalidate(*access_tokens)
+
+    def invalidate_client(self, client_id):
+        """ Drops every token issued to the given client """
+        self._invalidate_where(lambda s: s.client_id == client_id)
+        if self.store is not None:
+            self.store.invalidate_client(client_id)
+
+    def invalidate_user(self, user_id):
+        """ Drops every token that belongs to the given user """
+        self._invalidate_where(lambda s: s.user_id == user_id)
+        if self.store is not None:
+            self.store.invalidate_user(user_id)
+
+    def on_invalidation(self, message):
+        """
+        Applies an invalidation published by another worker
+        """
+        if 'tokens' in message:
+            with self._lock:
+                for digest in message['tokens']:
+                    access_token = self._digests.get(digest)
+                    if access_token is not None:
+                        self._pop(access_token)
+                    access_token = self._unknown_digests.get(digest)
+                    if access_token is not None:
+                        self._pop_unknown(access_token)
+        if 'client_id' in message:
+            self._invalidate_where(
+                lambda s: s.client_id == message['client_id'])
+        if 'user_id' in message:
+            self._invalidate_where(lambda s: s.user_id == message['user_id'])
+
+    def _listen(self):
+        """
+        Makes sure this process is subscribed to the invalidations (the
+        thread is started lazily, so that it is started after a fork and
+        restarted if the connection was lost)
+        """
+        listener = self._listener
+        if listener is not None and listener.pid == os.getpid() and (
+                listener.is_alive() or
+                listener.started > time.time() - self.RESUBSCRIBE_DELAY):
+            return
+        with self._lock:
+            if self._listener is not listener:
+                return
+            listener = threading.Thread(target=self._run_listener,
+                                        args=(self.store,),
+                                        name='token-cache-invalidations')
+            listener.daemon = True
+            listener.pid = os.getpid()
+            listener.started = time.time()
+            self._listener = listener
+        # entries cached while we were not subscribed might be stale
+        self._invalidate_where(lambda s: True)
+        listener.start()
+
+    def _run_listener(self, store):
+        try:
+            store.listen(self.on_invalidation)
+        except Exception, e:
+            logger.warning("Stopped listening to token invalidations: {0}"
+                           .format(e))
+
+    def _invalidate_where(self, predicate):
+        with self._lock:
+            for access_token, (_, snapshot, _) in self._data.items():
+                if predicate(snapshot):
+                    self._pop(access_token)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._unknown.clear()
+            self._digests.clear()
+            self._unknown_digests.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+token_cache = TokenCache()
@@ -16,6 +16,13 @@ OAUTH2_PROVIDER_GRANT_EXPIRES_IN = 100
 OAUTH2_PROVIDER_TOKEN_EXPIRES_IN = 3600
 """ Life time of an access token """
 
+OAUTH2_PERSONAL_TOKEN_VIRTUAL_EXPIRY = True
+"""
+Personal access tokens expire OAUTH2_PROVIDER_TOKEN_EXPIRES_IN seconds after
+their last use; when True that expiry is only computed in memory, otherwise
+it is set on the token row every time the token is loaded
+"""
+
 OAUTH2_CLIENT_ID_SALT_LEN = 40
 """ Length of client id """
 
@@ -25,6 +32,36 @@ OAUTH2_CLIENT_SECRET_SALT_LEN = 60
 OAUTH2_TOKEN_PERSONAL_SALT_LEN = 60
 """ Length of the personal access token """
 
+OAUTH2_TOKEN_CACHE_SIZE = 10000
+""" Max number of access tokens cached by each worker (0 disables the cache) """
+
+OAUTH2_TOKEN_CACHE_TTL = 60
+""" Seconds for which a cached access token is trusted without the database """
+
+OAUTH2_TOKEN_CACHE_NEGATIVE_SIZE = 10000
+""" Max number of unknown access tokens remembered by each worker """
+
+OAUTH2_TOKEN_CACHE_NEGATIVE_TTL = 30
+""" Seconds for which an unknown access token is remembered """
+
+OAUTH2_TOKEN_FAST_REJECT = True
+"""
+Reject the access tokens that couldn't have been issued by adsws (wrong
+length or characters, see the *_SALT_LEN settings) without any lookup
+"""
+
+OAUTH2_TOKEN_CACHE_REDIS_URL = None
+"""
+Redis shared by all the workers as a second level token cache, e.g. the
+RATELIMIT_STORAGE_URL instance (None keeps the cache per worker)
+"""
+
+OAUTH2_TOKEN_CACHE_REDIS_PREFIX = 'oauth2token'
+""" Prefix of the redis keys (and invalidation channel) of the token cache """
+
+OAUTH2_TOKEN_CACHE_REDIS_TTL = 300
+""" Seconds for which an access token is kept in redis """
+
 OAUTH2_DEFAULT_SCOPES = {
     'user:email': 'Read access to user email only.',
     'user': 'Any user operation'
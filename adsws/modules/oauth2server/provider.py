@@ -4,19 +4,49 @@
 Configuration of flask-oauthlib provider
 """
 
+import re
 from datetime import datetime, timedelta
 
-from flask import current_app, request
+from flask import current_app, request, abort
 from flask.ext.login import current_user
 from flask_oauthlib.provider import OAuth2Provider
 from flask_oauthlib.utils import extract_params
 from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.attributes import NEVER_SET, NO_VALUE
 
-from adsws.core import db, user_manipulator
+from adsws.core import db, user_manipulator, User
 from .models import OAuthToken, OAuthClient, OAuthGrant
+from .cache import token_cache, TokenSnapshot, UNKNOWN_TOKEN
 from functools import wraps
 
 class OAuth2bProvider(OAuth2Provider):
+    def check_oauth(self, *scopes):
+        """
+        The check of require_oauth, for callers that are not decorated
+        (see adsws.api.discoverer.pipeline.OAuthStage): returns None if the
+        request is authorized (setting request.oauth), or the response to
+        send otherwise.
+        """
+        for func in self._before_request_funcs:
+            func()
+
+        if hasattr(request, 'oauth') and request.oauth:
+            return None
+
+        valid, req = self.verify_request(scopes)
+
+        for func in self._after_request_funcs:
+            valid, req = func(valid, req)
+
+        if not valid:
+            if self._invalid_response:
+                return self._invalid_response(req)
+            return abort(401)
+        request.oauth = req
+        return None
+
     def optional_oauth(self, *scopes):
         """Protect resource with specified scopes."""
         def wrapper(f):
@@ -45,6 +75,29 @@ class OAuth2bProvider(OAuth2Provider):
 
 oauth2 = OAuth2bProvider()
 
+TOKEN_ALPHABET = re.compile(r'^[A-Za-z0-9]+$')
+""" Characters of the tokens generated by oauthlib and werkzeug's gen_salt """
+
+OAUTHLIB_TOKEN_LEN = 30
+""" Length of the tokens generated by oauthlib.common.generate_token """
+
+
+def is_well_formed(access_token):
+    """
+    Cheap check that the access token could have been issued by us: all the
+    tokens are alphanumeric and as long as the oauthlib tokens, or the
+    personal/client tokens (see OAUTH2_*_SALT_LEN)
+    """
+    if not current_app.config.get('OAUTH2_TOKEN_FAST_REJECT', True):
+        return True
+    lengths = (
+        OAUTHLIB_TOKEN_LEN,
+        current_app.config.get('OAUTH2_CLIENT_ID_SALT_LEN', 40),
+        current_app.config.get('OAUTH2_TOKEN_PERSONAL_SALT_LEN', 60),
+    )
+    return min(lengths) <= len(access_token) <= max(lengths) \
+        and TOKEN_ALPHABET.match(access_token) is not None
+
 @oauth2.clientgetter
 def load_client(client_id):
     """
@@ -105,18 +158,46 @@ def load_token(access_token=None, refresh_token=None):
     """
     Load an access token
 
-    Add support for personal access tokens compared to flask-oauthlib
+    Add support for personal access tokens compared to flask-oauthlib;
+    access tokens are served from the token cache whenever possible (the
+    token, its client, its user and the user's roles are loaded in one
+    query otherwise). Malformed tokens are rejected without any lookup and
+    unknown ones are remembered by the cache.
     """
     if access_token:
-        t = OAuthToken.query.filter_by(access_token=access_token).first()
-        if t and t.is_personal:
-            t.expires = datetime.utcnow() + timedelta(
-                seconds=int(current_app.config.get(
-                    'OAUTH2_PROVIDER_TOKEN_EXPIRES_IN',
-                    3600
-                ))
-            )
-        return t
+        if not is_well_formed(access_token):
+            return None
+        snapshot = token_cache.get(access_token)
+        if snapshot is UNKNOWN_TOKEN:
+            return None
+        if snapshot is not None:
+            return snapshot
+
+        t = OAuthToken.query.options(
+            db.joinedload('client'),
+            db.joinedload('user').joinedload('roles'),
+        ).filter_by(access_token=access_token).first()
+        if t is None:
+            token_cache.set_unknown(access_token)
+            return None
+
+        # personal tokens don't expire as long as they are used
+        sliding_expiry = None
+        if t.is_personal:
+            lifetime = int(current_app.config.get(
+                'OAUTH2_PROVIDER_TOKEN_EXPIRES_IN',
+                3600
+            ))
+            if current_app.config.get('OAUTH2_PERSONAL_TOKEN_VIRTUAL_EXPIRY',
+                                      True):
+                # computed in memory; the row stays clean, so the request
+                # doesn't end with an UPDATE (or a rollback)
+                sliding_expiry = lifetime
+            else:
+                t.expires = datetime.utcnow() + timedelta(seconds=lifetime)
+        snapshot = TokenSnapshot.from_token(t, sliding_expiry=sliding_expiry)
+        token_cache.set(access_token, snapshot)
+        return snapshot
     elif refresh_token:
         return OAuthToken.query.filter_by(
             refresh_token=refresh_token, is_personal=False,
@@ -162,3 +243,72 @@ def save_token(token, request, *args, **kwargs):
     db.session.add(tok)
     db.session.commit()
     return tok
+
+
+def _defer_invalidation(target, invalidation):
+    """
+    Invalidates the cached tokens once the transaction is committed; doing
+    it at flush time would let another worker cache the old values again
+    before the commit
+    """
+    session = object_session(target)
+    if session is None:
+        invalidation()
+    else:
+        session.info.setdefault('token_cache_invalidations', []).append(
+            invalidation)
+
+
+@event.listens_for(OAuthToken, 'after_update')
+@event.listens_for(OAuthToken, 'after_delete')
+def invalidate_token(mapper, connection, target):
+    """
+    Drops the cached token whenever it changes (e.g. its scopes) or is
+    deleted
+    """
+    access_token = target.access_token
+    _defer_invalidation(target, lambda: token_cache.invalidate(access_token))
+
+
+@event.listens_for(OAuthToken.access_token, 'set', active_history=True)
+def invalidate_replaced_token(target, value, oldvalue, initiator):
+    """
+    A regenerated access token drops the one it replaces
+    """
+    if oldvalue in (None, NO_VALUE, NEVER_SET) or oldvalue == value:
+        return
+    _defer_invalidation(target, lambda: token_cache.invalidate(oldvalue))
+
+
+@event.listens_for(OAuthClient, 'after_update')
+@event.listens_for(OAuthClient, 'after_delete')
+def invalidate_client_tokens(mapper, connection, target):
+    """
+    Cached tokens carry a copy of their client (e.g. the ratelimit); drop
+    them whenever the client changes
+    """
+    client_id = target.client_id
+    _defer_invalidation(target,
+                        lambda: token_cache.invalidate_client(client_id))
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_user_tokens(mapper, connection, target):
+    """
+    Cached tokens carry a copy of their user (e.g. the email); drop them
+    whenever the user changes
+    """
+    user_id = target.id
+    _defer_invalidation(target, lambda: token_cache.invalidate_user(user_id))
+
+
+@event.listens_for(Session, 'after_commit')
+def run_token_invalidations(session):
+    for invalidation in session.info.pop('token_cache_invalidations', []):
+        invalidation()
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_token_invalidations(session):
+    session.info.pop('token_cache_invalidations', None)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import time
+from datetime import datetime
+from unittest import TestCase
+
+import mock
+import redis
+
+from ..cache import TokenCache, TokenSnapshot, ClientSnapshot, UserSnapshot, \
+    RoleSnapshot, RedisTokenStore, UNKNOWN_TOKEN, token_digest
+
+
+def make_snapshot(access_token, client_id='client', user_id=1):
+    return TokenSnapshot(
+        id=1,
+        access_token=access_token,
+        token_type='bearer',
+        client_id=client_id,
+        user_id=user_id,
+        expires_at=datetime(2500, 1, 1),
+        sliding_expiry=None,
+        scopes=('api',),
+        is_personal=False,
+        is_internal=False,
+        client=ClientSnapshot(client_id, user_id, 'name', 1.0, True, False),
+        user=UserSnapshot(user_id, 'user@adslabs.org', True, None,
+                          (RoleSnapshot(1, 'admin'),)),
+    )
+
+
+class TokenCacheTestCase(TestCase):
+
+    def test_get_set(self):
+        cache = TokenCache(size=10, ttl=60)
+        self.assertIsNone(cache.get('foo'))
+        cache.set('foo', make_snapshot('foo'))
+        self.assertEqual(cache.get('foo').access_token, 'foo')
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_lru_eviction(self):
+        cache = TokenCache(size=2, ttl=60)
+        cache.set('a', make_snapshot('a'))
+        cache.set('b', make_snapshot('b'))
+        cache.get('a')  # 'b' becomes the least recently used
+        cache.set('c', make_snapshot('c'))
+        self.assertEqual(len(cache), 2)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+
+    def test_ttl(self):
+        cache = TokenCache(size=10, ttl=60)
+        cache.set('foo', make_snapshot('foo'))
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertIsNone(cache.get('foo'))
+        self.assertNotIn('foo', cache)
+
+    def test_disabled(self):
+        cache = TokenCache(size=0)
+        cache.set('foo', make_snapshot('foo'))
+        self.assertIsNone(cache.get('foo'))
+
+    def test_invalidate(self):
+        cache = TokenCache(size=10, ttl=60)
+        cache.set('a', make_snapshot('a', client_id='c1', user_id=1))
+        cache.set('b', make_snapshot('b', client_id='c2', user_id=1))
+        cache.set('c', make_snapshot('c', client_id='c3', user_id=2))
+        cache.set('d', make_snapshot('d', client_id='c4', user_id=3))
+
+        cache.invalidate('d', 'unknown')
+        self.assertNotIn('d', cache)
+
+        cache.invalidate_client('c3')
+        self.assertNotIn('c', cache)
+        self.assertIn('a', cache)
+
+        cache.invalidate_user(1)
+        self.assertEqual(len(cache), 0)
+
+    def test_unknown_tokens(self):
+        cache = TokenCache(size=10, ttl=60, negative_size=2, negative_ttl=30)
+        cache.set_unknown('a')
+        cache.set_unknown('b')
+        self.assertIs(cache.get('a'), UNKNOWN_TOKEN)
+        # bounded, and kept apart from the valid tokens
+        cache.set_unknown('c')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+        with mock.patch('time.time', return_value=time.time() + 31):
+            self.assertIsNone(cache.get('c'))
+
+        cache.set_unknown('b')
+        cache.invalidate('b')
+        self.assertIsNone(cache.get('b'))
+
+    def test_init_app(self):
+        from flask import Flask
+        cache = TokenCache()
+        api = Flask('api')
+        api.config.update(OAUTH2_TOKEN_CACHE_SIZE=5, OAUTH2_TOKEN_CACHE_TTL=10)
+        cache.init_app(api)
+        cache.set('foo', make_snapshot('foo'))
+
+        # the cache is configured once, and never cleared by the other apps
+        accounts = Flask('accounts')
+        accounts.config.update(OAUTH2_TOKEN_CACHE_SIZE=50)
+        with mock.patch.object(Flask, 'logger', new_callable=mock.PropertyMock) as logger:
+            cache.init_app(accounts)
+            self.assertTrue(logger.return_value.warning.called)
+        cache.init_app(api)
+        self.assertEqual((cache.size, cache.ttl), (5, 10))
+        self.assertIn('foo', cache)
+
+    def test_sliding_expiry(self):
+        snapshot = make_snapshot('foo')
+        self.assertEqual(snapshot.expires, datetime(2500, 1, 1))
+
+        snapshot = snapshot._replace(expires_at=None, sliding_expiry=3600)
+        self.assertGreater(snapshot.expires, datetime.utcnow())
+        first = snapshot.expires
+        time.sleep(0.01)
+        self.assertGreater(snapshot.expires, first)
+
+    def test_snapshot_is_immutable(self):
+        snapshot = make_snapshot('foo')
+        with self.assertRaises(AttributeError):
+            snapshot.expires = None
+        with self.assertRaises(AttributeError):
+            snapshot.client.ratelimit = 2.0
+
+
+class RedisTokenStoreTestCase(TestCase):
+
+    def setUp(self):
+        self.redis = mock.MagicMock()
+        self.store = RedisTokenStore(self.redis, prefix='t', ttl=300,
+                                     negative_ttl=30)
+        self.cache = TokenCache(size=10, ttl=60, store=self.store)
+        # don't subscribe to the invalidations
+        self.cache._listen = lambda: None
+
+    def test_serialization(self):
+        snapshot = make_snapshot(u'foo')
+        self.assertEqual(TokenSnapshot.loads(u'foo', snapshot.dumps()),
+                         snapshot)
+        self.assertNotIn('foo', snapshot.dumps())
+
+        snapshot = snapshot._replace(expires_at=None, sliding_expiry=3600,
+                                     user=None)
+        self.assertEqual(TokenSnapshot.loads(u'foo', snapshot.dumps()),
+                         snapshot)
+
+    def test_get_from_redis(self):
+        snapshot = make_snapshot('foo')
+        self.redis.get.return_value = snapshot.dumps()
+        self.assertEqual(self.cache.get('foo'), snapshot)
+        self.redis.get.assert_called_with('t:' + token_digest('foo'))
+        # now served by the process
+        self.assertIn('foo', self.cache)
+
+    def test_unknown_token(self):
+        self.cache.set_unknown('foo')
+        self.redis.set.assert_called_with('t:' + token_digest('foo'), '',
+                                          ex=30)
+        self.redis.get.return_value = ''
+        self.assertIs(self.cache.get('foo'), UNKNOWN_TOKEN)
+
+    def test_invalidation(self):
+        self.cache.set('foo', make_snapshot('foo', client_id='c1'))
+        self.cache.invalidate_client('c1')
+        self.assertNotIn('foo', self.cache)
+        self.redis.smembers.assert_called_with('t:client:c1')
+        self.redis.pipeline().publish.assert_called_with(
+            't:invalidate', '{"client_id": "c1"}')
+
+        # invalidations published by the other workers
+        self.cache.set('foo', make_snapshot('foo'))
+        self.cache.set('bar', make_snapshot('bar', user_id=2))
+        self.cache.on_invalidation({'tokens': [token_digest('foo')]})
+        self.assertNotIn('foo', self.cache)
+        self.cache.on_invalidation({'user_id': 2})
+        self.assertEqual(len(self.cache), 0)
+        self.cache.set_unknown('baz')
+        self.cache.on_invalidation({'tokens': [token_digest('baz')]})
+        self.assertFalse(self.cache._is_unknown('baz'))
+
+    def test_redis_errors(self):
+        self.redis.get.side_effect = redis.ConnectionError
+        self.redis.pipeline.side_effect = redis.ConnectionError
+        self.assertIsNone(self.cache.get('foo'))
+        self.cache.set('foo', make_snapshot('foo'))
+        self.assertIsNotNone(self.cache.get('foo'))
+        self.cache.invalidate('foo')
+        self.assertNotIn('foo', self.cache)
@@ -4,6 +4,7 @@ from __future__ import absolute_import, print_function
 
 import os
 import logging
+from datetime import datetime
 from unittest import skip
 
 from flask import url_for
@@ -556,6 +557,82 @@ class OAuth2ProviderTestCase(FlaskAppTestCase):
         self.assert200(r)
         self.assertEqual(r.json, dict(ping='pong'))
 
+    def test_personal_token_expiry_not_written(self):
+        from ..cache import token_cache
+        from ..models import OAuthToken
+        access_token = self.personal_token.access_token
+
+        r = self.client.get('/oauth/ping',
+                            query_string="access_token=%s" % access_token)
+        self.assert200(r)
+
+        # the expiry slides in memory only...
+        self.assertGreater(token_cache.get(access_token).expires,
+                           datetime.utcnow())
+        # ...and the database row is left untouched
+        self.assertIsNone(
+            db.session.query(OAuthToken.expires)
+            .filter_by(access_token=access_token).scalar()
+        )
+
+    def test_token_cache(self):
+        from ..cache import token_cache
+        access_token = self.personal_token.access_token
+
+        r = self.client.get('/oauth/ping',
+                            query_string="access_token=%s" % access_token)
+        self.assert200(r)
+        self.assertIn(access_token, token_cache)
+        self.assertEqual(token_cache.get(access_token).user_id, 1)
+
+        # changing the client (e.g. its ratelimit) drops the cached token
+        self.personal_token.client.ratelimit = 2.0
+        db.session.commit()
+        self.assertNotIn(access_token, token_cache)
+
+        r = self.client.get('/oauth/ping',
+                            query_string="access_token=%s" % access_token)
+        self.assert200(r)
+        self.assertEqual(token_cache.get(access_token).client.ratelimit, 2.0)
+
+        # so does changing the token itself (e.g. its scopes)
+        self.personal_token._scopes = 'test:scope'
+        db.session.commit()
+        self.assertNotIn(access_token, token_cache)
+
+        r = self.client.get('/oauth/ping',
+                            query_string="access_token=%s" % access_token)
+        self.assert200(r)
+        self.assertIn(access_token, token_cache)
+
+        # deleted tokens are no longer accepted
+        db.session.delete(self.personal_token)
+        db.session.commit()
+        r = self.client.get('/oauth/ping',
+                            query_string="access_token=%s" % access_token)
+        self.assert401(r)
+
+    def test_unknown_tokens(self):
+        from ..cache import token_cache, UNKNOWN_TOKEN
+        from ..provider import is_well_formed
+
+        self.assertTrue(is_well_formed(self.personal_token.access_token))
+        for access_token in ('short', 'x' * 100, 'a' * 39 + '!'):
+            self.assertFalse(is_well_formed(access_token))
+
+        # malformed tokens are rejected without a lookup...
+        r = self.client.get('/oauth/ping', query_string="access_token=short")
+        self.assert401(r)
+        self.assertNotIn('short', token_cache)
+        self.assertIsNone(token_cache.get('short'))
+
+        # ...and unknown ones are remembered
+        access_token = 'a' * 40
+        r = self.client.get('/oauth/ping',
+                            query_string="access_token=%s" % access_token)
+        self.assert401(r)
+        self.assertIs(token_cache.get(access_token), UNKNOWN_TOKEN)
+
     @skip("Settings not yet implemented")
     def test_settings_index(self):
         # Create a remote account (linked account)
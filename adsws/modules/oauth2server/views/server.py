@@ -17,6 +17,7 @@ from flask_login import current_user
 from oauthlib.oauth2.rfc6749.errors import OAuth2Error
 
 from ..provider import oauth2
+from ..cache import token_cache
 from ..models import OAuthClient, OAuthUserProxy, Scope
 from ..registry import scopes
 
@@ -40,6 +41,10 @@ def setup_app():
     # Initialize OAuth2 provider
     oauth2.init_app(current_app)
 
+    # Size/lifetime of the cache of resolved access tokens (shared by the
+    # apps of the process, configured by the first one)
+    token_cache.init_app(current_app)
+
     # Register default scopes (note, each module will)
     for scope, options in current_app.config['OAUTH2_DEFAULT_SCOPES'].items():
         if scope not in scopes:
@@ -66,9 +71,16 @@ def setup_app():
 def login_oauth2_user(valid, oauth):
     """
     Login a user after having been verified
+
+    The user was already resolved together with the token (see load_token)
+    so it is logged in as is; only when flask-security tracks logins we
+    need the model, because the login writes into the user's row
     """
     if valid:
-        valid = login_user(user_manipulator.first(id=oauth.user.id))
+        user = oauth.user
+        if current_app.config.get('SECURITY_TRACKABLE', False):
+            user = user_manipulator.get(user.id)
+        valid = login_user(user)
     return valid, oauth
 
 
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+    adsws.prefork
+    ~~~~~~~~~~~~~
+
+    Pre-fork initialization of the applications
+
+    Creating the apps already discovers the remote services and builds their
+    views, but part of the setup is left to the first request that each
+    process serves (before_first_request functions: OAuth2 provider setup,
+    registration of the default scopes...), and the url maps are only
+    sorted when the first url is matched. initialize() does all of it at
+    once, so that a pre-forking server loading the apps in its master (e.g.
+    gunicorn --preload) hands fully initialized apps to its workers.
+
+    What must not be shared between processes is reset by post_fork(), to
+    be called by every worker; gunicorn.conf.py does it from its post_fork
+    hook.
+"""
+
+from adsws.ext.sqlalchemy import db
+from adsws.startup import profile
+
+
+def initialize_app(app):
+    """
+    Runs the setup the app would otherwise do lazily in each process
+    :param app: flask.Flask application instance
+    :return: None
+    """
+    with app.app_context():
+        app.try_trigger_before_first_request_functions()
+    # sorts the rules, done at the first match otherwise
+    app.url_map.update()
+
+
+def initialize(*apps):
+    """
+    Pre-fork initialization of the apps
+    :param apps: flask.Flask application instances
+    :return: None
+    """
+    for app in apps:
+        with profile.phase('prefork {0}'.format(app.name)):
+            initialize_app(app)
+        app.logger.debug('Initialized {0} before forking'.format(app.name))
+
+
+def post_fork(*apps):
+    """
+    Drops the state a worker must not share with the master: the database
+    connections opened before the fork
+    :param apps: flask.Flask application instances
+    :return: None
+    """
+    for app in apps:
+        if 'sqlalchemy' in app.extensions:
+            with app.app_context():
+                db.engine.dispose()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+    adsws.startup
+    ~~~~~~~~~~~~~
+
+    Profiling of the startup of the applications
+
+    The factory, the discovery and the pre-fork initialization record the
+    wall time of their phases in `profile`; the phases nest (e.g. the
+    load_config of adsws.api is 'adsws.api > load_config'). Every thread has
+    its own stack of phases (e.g. lazily mounted apps are created by
+    concurrent requests). Recording costs two time.time() calls per phase:
+    it is always on.
+
+    Run as a script (`python -m adsws.startup <output file>`, which
+    `manage.py profile_startup` does), it times the imports and the
+    creation of the wsgi applications in a fresh interpreter and writes the
+    phases as JSON, to be checked against a budget.
+"""
+
+import sys
+import json
+import time
+import threading
+import importlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+SEPARATOR = ' > '
+
+# seconds; a key applies to the phase of that name, or to every phase whose
+# last component is that name ('total' is the whole startup)
+DEFAULT_BUDGET = {
+    'total': 60,
+    'imports': 15,
+    'load_config': 1,
+    'discover': 20,
+}
+
+# the modules imported by wsgi.py
+IMPORTS = ['adsws.feedback', 'adsws.accounts', 'adsws.api', 'adsws.frontend',
+           'adsws.benchmark']
+
+
+class StartupProfile(object):
+    """
+    Wall time of the (nested) startup phases, recorded by the threads
+    creating the applications
+    """
+
+    def __init__(self):
+        # {phase: seconds} in the order the phases started; summed if a
+        # phase runs several times
+        self.phases = OrderedDict()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def _stack(self):
+        """ Phases the current thread is in """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def phase(self, name):
+        stack = self._stack
+        stack.append(name)
+        name = SEPARATOR.join(stack)
+        with self._lock:
+            self.phases.setdefault(name, 0.0)
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] += time.time() - start
+            stack.pop()
+
+    def reset(self):
+        with self._lock:
+            self.phases.clear()
+
+    def totals(self):
+        with self._lock:
+            return OrderedDict(self.phases)
+
+    def report(self, totals=None):
+        """
+        Text report of the phases, indented by depth
+        """
+        totals = self.totals() if totals is None else totals
+        lines = ['{0:>9}  {1}'.format('seconds', 'phase')]
+        for name, seconds in totals.iteritems():
+            parts = name.split(SEPARATOR)
+            lines.append('{0:>9.3f}  {1}{2}'.format(seconds, '  ' * (len(parts) - 1), parts[-1]))
+        return '\n'.join(lines)
+
+
+profile = StartupProfile()
+
+
+def check_budget(totals, budget=None):
+    """
+    Compares the seconds of the phases to the budget
+
+    :param totals: {phase: seconds}, with a 'total' entry for the whole
+        startup (see StartupProfile.totals)
+    :param budget: {phase or last component of phases: seconds}
+    :return: the [(phase, seconds, budget)] over budget
+    """
+    budget = DEFAULT_BUDGET if budget is None else budget
+    overruns = []
+    for name, seconds in totals.iteritems():
+        limit = budget.get(name, budget.get(name.split(SEPARATOR)[-1]))
+        if limit is not None and seconds > limit:
+            overruns.append((name, seconds, limit))
+    return overruns
+
+
+def profile_wsgi():
+    """
+    Imports the modules of wsgi.py then wsgi.py itself (creating the
+    applications), and returns the {phase: seconds}
+
+    It is meant for a fresh interpreter: what is already imported is not
+    timed.
+    """
+    start = time.time()
+    with profile.phase('imports'):
+        for name in IMPORTS:
+            with profile.phase(name):
+                importlib.import_module(name)
+    with profile.phase('wsgi'):
+        importlib.import_module('wsgi')
+    totals = profile.totals()
+    totals['total'] = time.time() - start
+    return totals
+
+
+if __name__ == '__main__':
+    # the instrumented code records in adsws.startup, not in __main__
+    from adsws.startup import profile_wsgi as run
+    totals = run()
+    with open(sys.argv[1], 'w') as f:
+        json.dump(totals, f)
@@ -10,6 +10,7 @@ from adsws.accounts import utils
 from adsws.accounts.emails import PasswordResetEmail, VerificationEmail
 from adsws.modules.oauth2server.models import OAuthClient, OAuthToken
 from sqlalchemy import func
+from werkzeug.security import gen_salt
 import testing.postgresql
 
 from unittest import TestCase as UnitTestCase
@@ -161,8 +162,8 @@ class TestAccounts(AccountsSetup):
         token = OAuthToken(
                 client_id=client_id,
                 user_id=user_id,
-                access_token='access token %s' % random.random(),
-                refresh_token='refresh token %s' % random.random(),
+                access_token=gen_salt(40),
+                refresh_token=gen_salt(40),
                 expires=datetime.datetime(2500, 1, 1),
                 _scopes=scopes,
                 is_personal=False,
@@ -45,6 +45,7 @@ class ApiTestCase(_APITestCase):
             SECURITY_POST_LOGIN_VIEW='/postlogin',
             SECURITY_REGISTER_BLUEPRINT=True,
             SHOULD_NOT_OVERRIDE="parent",
+            SQLALCHEMY_COUNT_STATEMENTS=True,
             RATELIMIT_KEY_PREFIX='unittest.LocalDiscoverer.{}'.format(
                 time.time()),
         )
@@ -87,6 +88,24 @@ class ApiTestCase(_APITestCase):
         r = self.open('GET', url_for('protectedview'))
         self.assertStatus(r, 200)
 
+    def test_sql_statements_per_request(self):
+        """
+        Test that an authenticated request resolves the token, its client and
+        its user in a single statement, and that it doesn't touch the
+        database at all once the token is cached
+        """
+        # no session cookie: behave like an API client
+        client = self.app.test_client(use_cookies=False)
+        headers = {"Authorization": "Bearer {0}".format(self.token)}
+
+        r = client.get(url_for('protectedview'), headers=headers)
+        self.assertStatus(r, 200)
+        self.assertEqual(r.headers['X-Adsws-Sql-Statements'], '1')
+
+        r = client.get(url_for('protectedview'), headers=headers)
+        self.assertStatus(r, 200)
+        self.assertEqual(r.headers['X-Adsws-Sql-Statements'], '0')
+
     def test_emailresolver(self):
         """
         Test that the email resolver correctly resolves a user
@@ -0,0 +1,84 @@
+from unittest import TestCase
+from adsws.api import compression
+import flask
+import gzip
+import json
+from StringIO import StringIO
+
+
+class CompressionTestCase(TestCase):
+    """
+    Tests the compression of the responses
+    """
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config.update(
+            RESPONSE_COMPRESSION=True,
+            RESPONSE_COMPRESSION_ENCODINGS=['br', 'gzip'],
+            RESPONSE_COMPRESSION_MIMETYPES=['application/json'],
+            RESPONSE_COMPRESSION_MIN_SIZE=100,
+        )
+        self.body = json.dumps({'docs': [{'bibcode': '2015ApJ...800...1A'}] * 100})
+
+        @app.route('/json')
+        def json_view():
+            return self.body, 200, {'Content-Type': 'application/json', 'ETag': '"v1"'}
+
+        @app.route('/small')
+        def small_view():
+            return '{}', 200, {'Content-Type': 'application/json'}
+
+        @app.route('/text')
+        def text_view():
+            return self.body, 200, {'Content-Type': 'text/plain'}
+
+        @app.route('/stream')
+        def stream_view():
+            return flask.Response((self.body[i:i + 10] for i in range(0, len(self.body), 10)),
+                                  mimetype='application/json')
+
+        @app.route('/compressed')
+        def compressed_view():
+            return 'already compressed', 200, {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+
+        app.after_request(compression.compress_response)
+        self.app = app.test_client()
+
+    @staticmethod
+    def gunzip(data):
+        return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+    def test_gzip(self):
+        rv = self.app.get('/json', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', rv.headers['Vary'])
+        self.assertLess(len(rv.data), len(self.body) / 5)
+        self.assertEqual(int(rv.headers['Content-Length']), len(rv.data))
+        self.assertEqual(self.gunzip(rv.data), self.body)
+        self.assertEqual(rv.headers['ETag'], 'W/"v1"')
+
+        rv = self.app.get('/stream', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', rv.headers)
+        self.assertEqual(self.gunzip(rv.data), self.body)
+
+    def test_not_compressed(self):
+        # not accepted by the client, too small, not a compressible type
+        for path, encoding in [('/json', None), ('/json', 'identity'),
+                               ('/small', 'gzip'), ('/text', 'gzip')]:
+            headers = {'Accept-Encoding': encoding} if encoding else {}
+            rv = self.app.get(path, headers=headers)
+            self.assertNotIn('Content-Encoding', rv.headers)
+
+        # already compressed upstream: passed through
+        rv = self.app.get('/compressed', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.data, 'already compressed')
+
+    def test_brotli(self):
+        rv = self.app.get('/json', headers={'Accept-Encoding': 'gzip, br'})
+        if compression.brotli is None:
+            self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        else:
+            self.assertEqual(rv.headers['Content-Encoding'], 'br')
+            self.assertEqual(compression.brotli.decompress(rv.data), self.body)
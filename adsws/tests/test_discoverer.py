@@ -1,4 +1,4 @@
-from flask import current_app, g
+from flask import Flask, current_app, g, request
 from flask.ext.login import login_user, current_user
 from adsws.core import user_manipulator, db
 from api_base import ApiTestCase
@@ -8,11 +8,16 @@ import os
 import time
 from sample_microservice import Stubdata
 import mock
+import json
+import requests
 from datetime import datetime
 from unittest import TestCase
 from requests.exceptions import ConnectionError
 from adsws.modules.oauth2server.models import OAuthClient
 import unittest
+import threading
+import tempfile
+import shutil
 
 LIVESERVER_WAIT_SECONDS = 2.5
 
@@ -528,6 +533,18 @@ class DiscoverConsulServiceTestCase(ApiTestCase, DiscovererTestCase):
 
 
 import adsws.api.discoverer.utils as discovery_utils
+import adsws.api.discoverer.views as discovery_views
+import adsws.api.discoverer.refresh as discovery_refresh
+import adsws.api.discoverer.snapshot as discovery_snapshot
+from adsws.api.discoverer.views import ProxyView, GeventProxyView, StreamedBody
+from adsws.api.discoverer.breaker import CircuitBreaker, breakers
+from adsws.api.discoverer.cache import CachedResponse, ResponseCache, cache_ttl, response_caches
+from adsws.api.discoverer.coalescing import SingleFlight
+from adsws.api.discoverer.hedging import HedgeBudget, hedge_budgets, first_response
+from adsws.api.discoverer.pipeline import RoutePipeline, Stage
+from adsws.api.discoverer.refresh import RouteRefresher
+from adsws.api.discoverer.latency import LatencyHistogram, AdaptiveTimeout
+from adsws.api.discoverer.pools import PoolRegistry, CountingHTTPSConnectionPool, HTTPSConnection
 class TestUnitTests(TestCase):
 
     @mock.patch.object(discovery_utils, 'requests')
@@ -588,5 +605,699 @@ class TestUnitTests(TestCase):
             m_os.path.exists.called_with('/tmp/http:foobar-us-east-1com:8980tee')
             m_json.loads.assert_called_with('{"hey": {"methods": ["IGNORE"]}}')
 
+    @mock.patch.object(discovery_utils, 'read_cached_resources')
+    @mock.patch.object(discovery_utils, 'register_remote_service')
+    @mock.patch.object(discovery_utils, 'bootstrap_local_module')
+    @mock.patch.object(discovery_utils, 'fetch_remote_resources')
+    def test_parallel_discovery(self, fetch, bootstrap_local, register, read_cached):
+        finished = []
+
+        def fetch_resources(service_uri, app):
+            time.sleep(1 if 'slow' in service_uri else 0.2)
+            finished.append(service_uri)
+            if 'down' in service_uri:
+                return None
+            return {'service': service_uri}
+
+        fetch.side_effect = fetch_resources
+        read_cached.return_value = {'cached': True}
+        app = mock.Mock()
+        app.config = {
+            'WEBSERVICES': {
+                'http://b.foo/': '/b',
+                'http://slow.foo/': '/c',
+                'http://down.foo/': '/d',
+                'http://a.foo/': '/a',
+                'adsws.local.app': '/aa',
+            },
+            'WEBSERVICES_DISCOVERY_DEADLINE': 0.5,
+        }
+        start = time.time()
+        discovery_utils.discover(app)
+        # the services are queried concurrently, the slow one is not waited
+        # for (its cached resources are used) but it is not left running
+        self.assertLess(time.time() - start, 1.5)
+        self.assertIn('http://slow.foo/', finished)
+        self.assertEqual(fetch.call_count, 4)
+        read_cached.assert_called_once_with('http://slow.foo/', app)
+        # registered by deploy path
+        self.assertEqual(register.call_args_list, [
+            mock.call('http://a.foo/', '/a', {'service': 'http://a.foo/'}, app),
+            mock.call('http://b.foo/', '/b', {'service': 'http://b.foo/'}, app),
+            mock.call('http://slow.foo/', '/c', {'cached': True}, app),
+        ])
+        bootstrap_local.assert_called_once_with('adsws.local.app', '/aa', app)
+
+    @mock.patch.object(discovery_views, 'current_user')
+    def test_proxy_streaming(self, current_user):
+        app = Flask(__name__)
+        app.config.update(
+            REMOTE_PROXY_ALLOWED_HEADERS=['Content-Type'],
+            REMOTE_PROXY_STREAM_MIN_CONTENT_LENGTH=1024,
+            REMOTE_PROXY_STREAM_CHUNK_SIZE=2,
+        )
+        current_user.get_id.return_value = None
+        upstream = mock.Mock(status_code=200)
+        upstream.iter_content.return_value = iter(['ab', 'cd'])
+        upstream.content = 'abcd'
+
+        with app.test_request_context('/foo/export'):
+            proxyview = ProxyView('http://foo.bar/export', 'http://foo.bar/', '/foo', '/foo/export')
+            self.assertTrue(proxyview.stream)
+            proxyview.session = mock.Mock()
+            proxyview.session.get.return_value = upstream
+
+            # small responses are still buffered
+            upstream.headers = {'Content-Type': 'text/csv', 'Content-Length': '4', 'X-Secret': 'foo'}
+            self.assertEqual(proxyview.dispatcher(), ('abcd', 200, {'Content-Type': 'text/csv'}))
+            proxyview.session.get.assert_called_with('http://foo.bar/export', headers=mock.ANY, timeout=60, stream=True)
+            self.assertTrue(upstream.close.called)
+            upstream.close.reset_mock()
+
+            # large (or chunked) ones are streamed
+            upstream.headers = {'Content-Type': 'text/csv', 'X-Secret': 'foo'}
+            r = proxyview.dispatcher()
+            self.assertEqual(r.headers['Content-Type'], 'text/csv')
+            self.assertNotIn('X-Secret', r.headers)
+            self.assertFalse(upstream.close.called)
+            self.assertEqual(list(r.response), ['ab', 'cd'])
+            upstream.iter_content.assert_called_with(chunk_size=2)
+            self.assertTrue(upstream.close.called)
+
+        # compressed bodies the client accepts are streamed as they are
+        upstream.headers = {'Content-Type': 'text/csv', 'Content-Encoding': 'gzip', 'Content-Length': '2048'}
+        upstream.raw.stream.return_value = iter(['\x1f\x8b', '..'])
+        with app.test_request_context('/foo/export', headers={'Accept-Encoding': 'gzip'}):
+            r = proxyview.dispatcher()
+            self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(r.headers['Content-Length'], '2048')
+            self.assertEqual(list(r.response), ['\x1f\x8b', '..'])
+            upstream.raw.stream.assert_called_with(2, decode_content=False)
+
+    @mock.patch.object(discovery_views, 'current_user')
+    def test_proxy_compressed_passthrough(self, current_user):
+        app = Flask(__name__)
+        app.config.update(REMOTE_PROXY_ALLOWED_HEADERS=['Content-Type'])
+        current_user.get_id.return_value = None
+        upstream = mock.Mock(status_code=200, content='{"decoded": true}')
+        upstream.headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        upstream.raw.read.return_value = '\x1f\x8b...'
+
+        with app.test_request_context('/foo/search', headers={'Accept-Encoding': 'gzip'}):
+            proxyview = ProxyView('http://foo.bar/search', 'http://foo.bar/', '/foo', '/foo/search')
+            self.assertFalse(proxyview.stream)
+            proxyview.session = mock.Mock()
+            proxyview.session.get.return_value = upstream
+            # the compressed body is not decoded
+            self.assertEqual(proxyview.dispatcher(), ('\x1f\x8b...', 200, {
+                'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}))
+            upstream.raw.read.assert_called_with(decode_content=False)
+            self.assertTrue(upstream.close.called)
+
+        with app.test_request_context('/foo/search'):
+            self.assertEqual(proxyview.dispatcher(), ('{"decoded": true}', 200, {
+                'Content-Type': 'application/json'}))
+
+    def test_proxy_streamed_request_body(self):
+        app = Flask(__name__)
+        app.config['REMOTE_PROXY_STREAM_REQUEST_MIN_CONTENT_LENGTH'] = 10
+        payload = json.dumps({'bibcode': ['x' * 19] * 10})
+
+        with app.test_request_context('/foo/upload', method='POST', data=payload,
+                                      content_type='application/json'):
+            proxyview = ProxyView('http://foo.bar/upload', 'http://foo.bar/', '/foo', '/foo/upload')
+            # oauth2 looks at the form, which leaves json in the stream
+            self.assertEqual(request.form.to_dict(), {})
+            body = proxyview.get_body(request)
+            self.assertIsInstance(body, StreamedBody)
+            self.assertEqual(len(body), len(payload))
+            self.assertEqual(''.join(body), payload)
+
+        with app.test_request_context('/foo/upload', method='POST', data='{}',
+                                      content_type='application/json'):
+            self.assertEqual(proxyview.get_body(request), '{}')
+
+    @mock.patch.object(discovery_views, 'current_user')
+    def test_gevent_proxy_deadline(self, current_user):
+        import gevent
+        app = Flask(__name__)
+        app.config.update(DEFAULT_REQUEST_TIMEOUT=0.1, REMOTE_PROXY_ALLOWED_HEADERS=[])
+        current_user.get_id.return_value = None
+
+        with app.test_request_context('/foo/slow'):
+            proxyview = GeventProxyView('http://foo.bar/slow', 'http://foo.bar/', '/foo', '/foo/slow')
+            proxyview.session = mock.Mock()
+            proxyview.session.get.side_effect = lambda *args, **kwargs: gevent.sleep(1)
+            start = time.time()
+            self.assertEqual(proxyview.dispatcher(), (b'504 Gateway Timeout', 504))
+            self.assertLess(time.time() - start, 0.5)
+
+        # built without an app context (nor monkey patching)
+        GeventProxyView.inflight = None
+        GeventProxyView('http://foo.bar/slow', 'http://foo.bar/', '/foo', '/foo/slow')
+        self.assertIsNotNone(GeventProxyView.inflight)
+
+    def test_shared_connection_pools(self):
+        registry = PoolRegistry()
+        self.assertEqual(registry.key('http://foo.bar/'), registry.key('http://foo.bar:80/tee'))
+        self.assertNotEqual(registry.key('http://foo.bar/'), registry.key('http://foo.bar:8080/'))
+
+        session = registry.get_session('http://foo.bar/', pool_maxsize=5)
+        self.assertIs(registry.get_session('http://foo.bar:80/tee'), session)
+        self.assertIsNot(registry.get_session('http://foo.bar:8080/'), session)
+        self.assertEqual(registry.stats(), {})
+
+        pool = session.get_adapter('http://foo.bar/').get_connection('http://foo.bar/')
+        conn = pool._get_conn()
+        self.assertEqual(registry.stats(), {'http://foo.bar:80': {'idle': 0, 'active': 1, 'created': 1, 'requests': 0}})
+        pool._put_conn(conn)
+        self.assertEqual(registry.stats()['http://foo.bar:80']['idle'], 1)
+        self.assertEqual(registry.stats()['http://foo.bar:80']['active'], 0)
+
+    def test_https_connection_pools(self):
+        registry = PoolRegistry()
+        session = registry.get_session('https://foo.bar/', max_retries=2)
+        adapter = session.get_adapter('https://foo.bar/')
+        self.assertIs(adapter, session.get_adapter('http://foo.bar/'))
+        self.assertEqual(adapter.max_retries.total, 2)
+
+        pool = adapter.get_connection('https://foo.bar/')
+        self.assertIsInstance(pool, CountingHTTPSConnectionPool)
+        conn = pool._get_conn()
+        with mock.patch.object(HTTPSConnection, 'connect'):
+            conn.connect()
+            conn.connect()
+        pool._put_conn(conn)
+        self.assertEqual(registry.stats()['https://foo.bar:443']['handshakes'], 2)
+        self.assertEqual(registry.stats()['https://foo.bar:443']['idle'], 1)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker('http://foo.bar/', window=10, min_calls=4, failure_ratio=0.5, open_seconds=5)
+        now = time.time()
+        with mock.patch('time.time', return_value=now):
+            slow = breaker.allow()
+            for success in (True, True, False):
+                breaker.record(success)
+            self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+            breaker.record(False)
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+            self.assertFalse(breaker.allow())
+
+        # failures older than the window are forgotten
+        other = CircuitBreaker('x', window=10, min_calls=2, failure_ratio=0.5)
+        with mock.patch('time.time', return_value=now):
+            other.record(False)
+        with mock.patch('time.time', return_value=now + 11):
+            other.record(True)
+            self.assertEqual(other.status()['calls'], 1)
+            self.assertEqual(other.state, CircuitBreaker.CLOSED)
+
+        # half-open: a single probe goes through
+        with mock.patch('time.time', return_value=now + 6):
+            probe = breaker.allow()
+            self.assertTrue(probe)
+            self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+            self.assertFalse(breaker.allow())
+            # a call started before the circuit opened is not the probe
+            breaker.record(True, slow)
+            self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+            breaker.record(False, probe)
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with mock.patch('time.time', return_value=now + 12):
+            probe = breaker.allow()
+            self.assertTrue(probe)
+            breaker.record(False, slow)
+            self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+            breaker.record(True, probe)
+            self.assertEqual(breaker.status(), {'state': 'closed', 'calls': 0, 'failures': 0, 'opened_at': None})
+            self.assertTrue(breaker.allow())
+
+    @mock.patch.object(discovery_views, 'current_user')
+    def test_proxy_circuit_breaker(self, current_user):
+        app = Flask(__name__)
+        app.config.update(
+            REMOTE_PROXY_ALLOWED_HEADERS=[],
+            REMOTE_PROXY_CIRCUIT_BREAKER={'min_calls': 2, 'open_seconds': 60},
+        )
+        current_user.get_id.return_value = None
+        breakers.clear()
+
+        with app.test_request_context('/foo/hang'):
+            proxyview = ProxyView('http://foo.bar/hang', 'http://foo.bar/', '/foo', '/foo/hang')
+            proxyview.session = mock.Mock()
+            proxyview.session.get.side_effect = requests.exceptions.Timeout
+            self.assertEqual(proxyview.dispatcher()[1], 504)
+            self.assertEqual(proxyview.dispatcher()[1], 504)
+            self.assertEqual(proxyview.dispatcher()[1], 503)
+            self.assertEqual(proxyview.session.get.call_count, 2)
+            self.assertEqual(breakers.status()['http://foo.bar/']['state'], 'open')
+
+    def test_adaptive_timeout(self):
+        histogram = LatencyHistogram(half_life=0)
+        self.assertIsNone(histogram.percentile(0.99))
+        for i in range(99):
+            histogram.observe(0.1)
+        histogram.observe(2)
+        self.assertAlmostEqual(histogram.percentile(0.5), 0.1, delta=0.02)
+        self.assertAlmostEqual(histogram.percentile(0.99), 0.1, delta=0.02)
+        self.assertAlmostEqual(histogram.percentile(1), 2, delta=0.4)
+
+        timeout = AdaptiveTimeout(default=60, factor=3, minimum=1, maximum=30, min_samples=10)
+        for i in range(9):
+            timeout.observe(0.1)
+        self.assertEqual(timeout.get(), 60)
+        timeout.observe(0.1)
+        self.assertEqual(timeout.get(), 1)  # clamped
+        for i in range(100):
+            timeout.observe(2)
+        self.assertAlmostEqual(timeout.get(), 6, delta=1.2)
+        for i in range(1000):
+            timeout.observe(20)
+        self.assertEqual(timeout.get(), 30)  # clamped
+
+        # advertised by the service
+        self.assertEqual(AdaptiveTimeout.from_config(60, advertised=5, config={'factor': 3}).get(), 5)
+        # disabled
+        timeout = AdaptiveTimeout.from_config(60)
+        for i in range(1000):
+            timeout.observe(0.1)
+        self.assertEqual(timeout.get(), 60)
+
+
+    def test_first_response(self):
+        budget = HedgeBudget(ratio=0.5, burst=1)
+        closed = []
+
+        def slow():
+            time.sleep(0.5)
+            return 'slow'
+
+        def fail():
+            raise requests.exceptions.ConnectionError
+
+        # no budget yet: the primary is waited for, in the calling thread
+        with mock.patch('threading.Thread') as thread:
+            self.assertEqual(first_response(slow, lambda: 'fast', 0.01, budget), 'slow')
+            self.assertEqual(first_response(fail, lambda: 'fast', 0.01, budget), 'fast')
+            self.assertFalse(thread.called)
+        budget.deposit()
+        budget.deposit()
+        self.assertEqual(first_response(slow, lambda: 'fast', 0.01, budget, closed.append), 'fast')
+        self.assertEqual(budget.status()['hedges'], 1)
+        # a failed primary is retried on the other instance, budget or not
+        self.assertEqual(first_response(fail, lambda: 'fast', 1, budget), 'fast')
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            first_response(fail, fail, 1, budget)
+        # the loser of the race gets released
+        time.sleep(0.6)
+        self.assertEqual(closed, ['slow'])
+
+    @mock.patch.object(discovery_views, 'current_user')
+    def test_proxy_hedging(self, current_user):
+        app = Flask(__name__)
+        app.config.update(
+            REMOTE_PROXY_ALLOWED_HEADERS=[],
+            REMOTE_PROXY_CIRCUIT_BREAKER=None,
+            REMOTE_PROXY_HEDGE_DEPLOY_PATHS=['/foo'],
+            REMOTE_PROXY_HEDGING={'budget': 1, 'burst': 1, 'min_samples': 10},
+        )
+        current_user.get_id.return_value = None
+        hedge_budgets.clear()
+
+        def get(url, **kwargs):
+            if url.startswith('http://10.0.0.1'):
+                time.sleep(0.3)
+            return mock.Mock(status_code=200, content=url, headers={})
+
+        with app.test_request_context('/foo/search'):
+            proxyview = ProxyView('search', 'consul://foo.service', '/foo', '/foo/search')
+            proxyview.cs._resolve = mock.Mock(return_value=['http://10.0.0.1:80', 'http://10.0.0.2:80'])
+            proxyview.cs.session = mock.Mock()
+            proxyview.cs.session.get.side_effect = get
+            for i in range(10):
+                proxyview.timeout.observe(0.01)
+            start = time.time()
+            for i in range(4):
+                self.assertEqual(proxyview.dispatcher(), ('http://10.0.0.2:80/search', 200))
+            self.assertLess(time.time() - start, 0.3)
+            self.assertEqual(hedge_budgets.status()['/foo']['requests'], 4)
+
+
+
+    def test_response_cache(self):
+        self.assertEqual(cache_ttl(200, {'Cache-Control': 'public, max-age=600'}), 600)
+        self.assertEqual(cache_ttl(200, {}, default_ttl=30), 30)
+        self.assertIsNone(cache_ttl(404, {}))
+        self.assertIsNone(cache_ttl(200, {'Cache-Control': 'private'}))
+        self.assertIsNone(cache_ttl(200, {'Cache-Control': 'no-store'}))
+        self.assertIsNone(cache_ttl(200, {'Cache-Control': 'no-cache'}))
+        self.assertEqual(cache_ttl(200, {'Cache-Control': 'no-cache', 'ETag': '"1"'}), 0)
+        self.assertIsNone(cache_ttl(200, {'Set-Cookie': 'sroute=1'}))
+        self.assertIsNone(cache_ttl(200, {'Vary': 'Accept'}))
+        self.assertEqual(cache_ttl(200, {'Vary': 'Accept'}, vary=['accept']), 60)
+        # responses to authorized requests are shared only if they say so
+        self.assertIsNone(cache_ttl(200, {'Cache-Control': 'max-age=600'}, authorized=True))
+        self.assertEqual(cache_ttl(200, {'Cache-Control': 'public, max-age=600'}, authorized=True), 600)
+        self.assertEqual(cache_ttl(200, {'Cache-Control': 's-maxage=60'}, authorized=True), 60)
+        self.assertEqual(cache_ttl(200, {}, vary=['user'], authorized=True), 60)
+
+        cache = ResponseCache(size=2, max_bytes=25)
+        entry = lambda content: CachedResponse(200, {}, content, time.time() + 60)
+        cache.set('a', entry('0123456789'))
+        cache.set('b', entry('0123456789'))
+        cache.get('a')
+        cache.set('c', entry('0123456789'))  # too many entries: b goes
+        self.assertIsNone(cache.get('b'))
+        cache.set('d', entry('01234567890123456789'))  # too many bytes
+        self.assertEqual(cache.status()['entries'], 1)
+        self.assertEqual(cache.status()['bytes'], 20)
+        # expired entries are only kept if they can be revalidated
+        cache.set('e', CachedResponse(200, {}, '', time.time() - 1))
+        cache.set('f', CachedResponse(200, {'ETag': '"1"'}, '', time.time() - 1))
+        self.assertIsNone(cache.get('e'))
+        self.assertFalse(cache.get('f').is_fresh())
+
+    @mock.patch.object(discovery_views, 'current_user')
+    def test_proxy_response_cache(self, current_user):
+        app = Flask(__name__)
+        app.config.update(
+            REMOTE_PROXY_ALLOWED_HEADERS=['ETag'],
+            REMOTE_PROXY_CIRCUIT_BREAKER=None,
+            REMOTE_PROXY_CACHE={'default_ttl': 0},
+            REMOTE_PROXY_CACHE_DEPLOY_PATHS={'/foo': ['user']},
+        )
+        current_user.get_id.return_value = 'user1'
+        response_caches.clear()
+
+        def get(url, headers, **kwargs):
+            if headers.get('If-None-Match') == '"1"':
+                return mock.Mock(status_code=304, content='', headers={'Cache-Control': 'max-age=60'})
+            return mock.Mock(status_code=200, content='abstract', headers={'ETag': '"1"'})
+
+        with app.test_request_context('/foo/abs?bibcode=1'):
+            proxyview = ProxyView('http://foo.bar/abs', 'http://foo.bar/', '/foo', '/foo/abs')
+            proxyview.session = mock.Mock()
+            proxyview.session.get.side_effect = get
+            # fetched, then revalidated (default_ttl=0), then fresh
+            for i in range(3):
+                self.assertEqual(proxyview.dispatcher(), ('abstract', 200, {'ETag': '"1"'}))
+            self.assertEqual(proxyview.session.get.call_count, 2)
+            self.assertEqual(proxyview.session.get.call_args[1]['headers']['If-None-Match'], '"1"')
+
+        # other users and queries are not served the cached response
+        current_user.get_id.return_value = 'user2'
+        with app.test_request_context('/foo/abs?bibcode=1'):
+            proxyview.dispatcher()
+        with app.test_request_context('/foo/abs?bibcode=2'):
+            proxyview.dispatcher()
+        self.assertEqual(proxyview.session.get.call_count, 4)
+        self.assertEqual(response_caches.status()[0]['hits'], 1)
+
+
+
+    @mock.patch.object(discovery_views, 'current_user')
+    def test_proxy_conditional_requests(self, current_user):
+        app = Flask(__name__)
+        app.config.update(
+            REMOTE_PROXY_ALLOWED_HEADERS=['Content-Type'],
+            REMOTE_PROXY_CIRCUIT_BREAKER=None,
+        )
+        current_user.get_id.return_value = None
+        upstream_headers = {'Content-Type': 'application/json', 'ETag': '"v1"',
+                            'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+
+        with app.app_context():
+            proxyview = ProxyView('http://foo.bar/abs', 'http://foo.bar/', '/foo', '/foo/abs')
+        proxyview.session = mock.Mock()
+        proxyview.session.get.return_value = mock.Mock(status_code=200, content='{}', headers=upstream_headers)
+
+        # validators are forwarded both ways
+        with app.test_request_context('/foo/abs'):
+            self.assertEqual(proxyview.dispatcher(), ('{}', 200, upstream_headers))
+        with app.test_request_context('/foo/abs', headers={'If-None-Match': '"v1"'}):
+            self.assertEqual(proxyview.dispatcher()[1:], (304, upstream_headers))
+            self.assertEqual(proxyview.session.get.call_args[1]['headers']['If-None-Match'], '"v1"')
+        with app.test_request_context('/foo/abs', headers={'If-None-Match': '"v0"'}):
+            self.assertEqual(proxyview.dispatcher()[1], 200)
+        with app.test_request_context('/foo/abs', headers={'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'}):
+            self.assertEqual(proxyview.dispatcher()[1], 304)
+
+        # weak ETag over the body when the service has none
+        proxyview.weak_etag = True
+        proxyview.session.get.return_value = mock.Mock(status_code=200, content='{}', headers={})
+        with app.test_request_context('/foo/abs'):
+            etag = proxyview.dispatcher()[2]['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        with app.test_request_context('/foo/abs', headers={'If-None-Match': etag}):
+            self.assertEqual(proxyview.dispatcher(), (b'', 304, {'ETag': etag}))
+
+
+
+    def test_single_flight(self):
+        flight = SingleFlight()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            time.sleep(0.2)
+            return len(calls)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('key', fn))) for i in range(5)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(results, [1] * 5)
+        self.assertEqual(flight.status(), {'in_flight': 0, 'calls': 1, 'coalesced': 4})
+
+        # results that cannot be shared are fetched again
+        calls[:] = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('key', fn, shareable=lambda r: False))) for i in range(2)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(len(calls), 2)
+
+        def fail():
+            time.sleep(0.2)
+            raise requests.exceptions.Timeout
+
+        errors = []
+
+        def call():
+            try:
+                flight.do('key', fail)
+            except requests.exceptions.Timeout:
+                errors.append(1)
+
+        threads = [threading.Thread(target=call) for i in range(3)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(len(errors), 3)
+
+    @mock.patch.object(discovery_views, 'current_user')
+    def test_proxy_coalescing(self, current_user):
+        app = Flask(__name__)
+        app.config.update(
+            REMOTE_PROXY_ALLOWED_HEADERS=[],
+            REMOTE_PROXY_CIRCUIT_BREAKER=None,
+            REMOTE_PROXY_COALESCE_DEPLOY_PATHS=['/foo'],
+            # coalesced responses are buffered anyway
+            REMOTE_PROXY_STREAM_MIN_CONTENT_LENGTH=1,
+        )
+        current_user.get_id.return_value = None
+
+        def get(url, **kwargs):
+            time.sleep(0.2)
+            return mock.Mock(status_code=200, content=url, headers={})
+
+        with app.app_context():
+            proxyview = ProxyView('http://foo.bar/abs', 'http://foo.bar/', '/foo', '/foo/abs')
+        proxyview.session = mock.Mock()
+        proxyview.session.get.side_effect = get
+        results = []
+
+        def dispatch(path):
+            with app.test_request_context(path):
+                results.append(proxyview.dispatcher())
+
+        paths = ['/foo/abs?q=1'] * 4 + ['/foo/abs?q=2']
+        threads = [threading.Thread(target=dispatch, args=(p,)) for p in paths]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(proxyview.session.get.call_count, 2)
+        self.assertEqual(sorted(results), [('http://foo.bar/abs?q=1', 200)] * 4 + [('http://foo.bar/abs?q=2', 200)])
+
+
+
+    def test_route_pipeline(self):
+        calls = []
+
+        class Recorder(Stage):
+            def __init__(self, name, response=None):
+                self.name = name
+                self.response = response
+
+            def before(self):
+                calls.append(self.name + ' in')
+                return self.response
+
+            def after(self, rv):
+                calls.append(self.name + ' out')
+                return rv + (self.name,)
+
+        def view(x):
+            """doc"""
+            calls.append('view')
+            self.assertEqual(current_app.name, 'local')
+            return (x,)
+
+        view.rate_limit = [10, 60]
+        local_app = Flask('local')
+        pipeline = RoutePipeline(view, [Recorder('a'), Stage(), Recorder('b')], local_app=local_app)
+        self.assertEqual((pipeline.__name__, pipeline.__doc__, pipeline.rate_limit), ('view', 'doc', [10, 60]))
+        self.assertEqual(pipeline.__module__, view.__module__)
+        self.assertEqual(pipeline(1), (1, 'b', 'a'))
+        self.assertEqual(calls, ['a in', 'b in', 'view', 'b out', 'a out'])
+
+        # a stage answering skips the inner stages and the view
+        del calls[:]
+        pipeline = RoutePipeline(view, [Recorder('a'), Recorder('b', response=(401,)), Recorder('c')])
+        self.assertEqual(pipeline(1), (401, 'a'))
+        self.assertEqual(calls, ['a in', 'b in', 'a out'])
+
+
+    @mock.patch.object(discovery_refresh, 'fetch_remote_resources')
+    def test_route_refresher(self, fetch):
+        app = Flask('refresher')
+        app.extensions['symbolic_ratelimits'] = {}
+        app.config.update(
+            WEBSERVICES={'http://a.foo/': '/a', 'http://b.foo/': '/b'},
+            RATELIMIT_GROUPS={'group': {'patterns': ['/a/x'], 'limits': [5, 60]}},
+        )
+        discovery_utils.register_remote_service('http://a.foo/', '/a', {
+            '/x': {'methods': ['GET'], 'rate_limit': [10, 60]},
+            '/y': {'methods': ['GET']},
+        }, app)
+        x_view = app.view_functions['/a/x']
+        x_limit = app.extensions['remote_rate_limits'][('/a/x', 'GET')]
+        symbolic = app.extensions['symbolic_ratelimits']
+        self.assertIs(symbolic['/a/x'], symbolic['group'])
+
+        # b was down at boot, a drops /y, changes /x and adds /z
+        advertised = {
+            'http://a.foo/': {
+                '/x': {'methods': ['GET', 'POST'], 'rate_limit': [20, 60], 'scopes': ['user']},
+                '/z': {'methods': ['GET']},
+            },
+            'http://b.foo/': {'/w': {'methods': ['GET']}},
+        }
+        fetch.side_effect = lambda service_uri, app: json.loads(json.dumps(advertised[service_uri]))
+        refresher = RouteRefresher(app, 60)
+        self.assertEqual(refresher.refresh(), {
+            'http://a.foo/': (['/a/z'], ['/a/y'], ['/a/x']),
+            'http://b.foo/': (['/b/w'], [], []),
+        })
+
+        adapter = app.url_map.bind('localhost')
+        self.assertEqual(adapter.match('/a/x', method='POST')[0], '/a/x')
+        self.assertEqual(adapter.match('/a/z')[0], '/a/z')
+        self.assertEqual(adapter.match('/b/w')[0], '/b/w')
+        with self.assertRaises(Exception):
+            adapter.match('/a/y')
+        self.assertIsNot(app.view_functions['/a/x'], x_view)
+        self.assertEqual(x_limit, [20, 60])
+        # the group was copied, not changed in place
+        self.assertIs(app.extensions['symbolic_ratelimits']['/a/x'],
+                      app.extensions['symbolic_ratelimits']['group'])
+        self.assertIsNot(app.extensions['symbolic_ratelimits']['group'], symbolic['group'])
+
+        # nothing changed, or the service is down: the routes are kept
+        self.assertEqual(refresher.refresh(), {})
+        fetch.side_effect = lambda service_uri, app: None
+        self.assertEqual(refresher.refresh(), {})
+        self.assertEqual(app.url_map.bind('localhost').match('/b/w')[0], '/b/w')
+
+        # one thread per process
+        with mock.patch.object(discovery_refresh.threading, 'Thread') as thread, \
+                mock.patch.object(discovery_refresh.os, 'getpid') as getpid:
+            getpid.return_value = 1
+            refresher.start()
+            refresher.start()
+            self.assertEqual(thread.call_count, 1)
+            getpid.return_value = 2
+            refresher.start()
+            self.assertEqual(thread.call_count, 2)
+
+    @mock.patch.object(discovery_snapshot, 'query_remote_resources')
+    def test_discovery_snapshot(self, query):
+        instance_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, instance_path)
+        app = Flask('snapshot', instance_path=instance_path)
+        app.config.update(
+            WEBSERVICES={'http://a.foo/': '/a', 'http://b.foo/': '/b', 'adsws.sample': '/c'},
+            WEBSERVICES_DISCOVERY_SNAPSHOT='snapshot.json',
+        )
+        path = os.path.join(instance_path, 'snapshot.json')
+        a_resources = {'/x': {'methods': ['GET']}}
+        b_resources = {'/y': {'methods': ['GET']}}
+
+        def unavailable(service):
+            def query_resources(service_uri, app):
+                if service_uri == service:
+                    raise ValueError('No JSON object could be decoded')
+                return a_resources if service_uri == 'http://a.foo/' else b_resources
+            return query_resources
+
+        # b is down: left out
+        query.side_effect = unavailable('http://b.foo/')
+        self.assertEqual(discovery_snapshot.write_discovery_snapshot(app), ['http://b.foo/'])
+        self.assertEqual(discovery_snapshot.load_snapshot(app), {'http://a.foo/': a_resources})
+
+        # a is down: keeps its previous entry
+        query.side_effect = unavailable('http://a.foo/')
+        self.assertEqual(discovery_snapshot.write_discovery_snapshot(app), ['http://a.foo/'])
+        snapshot = discovery_snapshot.read_snapshot(path)
+        self.assertEqual(snapshot['generation'], 2)
+        self.assertEqual(discovery_snapshot.load_snapshot(app),
+                         {'http://a.foo/': a_resources, 'http://b.foo/': b_resources})
+        self.assertEqual(os.listdir(instance_path), ['snapshot.json'])
+
+        # the workers register the services of the snapshot without querying them
+        with mock.patch.object(discovery_utils, 'fetch_remote_resources') as fetch, \
+                mock.patch.object(discovery_utils, 'register_remote_service') as register, \
+                mock.patch.object(discovery_utils, 'bootstrap_local_module'):
+            discovery_utils.discover(app)
+            self.assertFalse(fetch.called)
+            self.assertEqual([c[0][:3] for c in register.call_args_list], [
+                ('http://a.foo/', '/a', a_resources), ('http://b.foo/', '/b', b_resources)
+            ])
+
+        # an entry not matching its checksum is ignored, and so is a
+        # snapshot that cannot be read
+        with open(path) as f:
+            data = json.load(f)
+        data['services']['http://a.foo/']['resources']['/z'] = {'methods': ['GET']}
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        self.assertEqual(discovery_snapshot.load_snapshot(app), {'http://b.foo/': b_resources})
+        with open(path, 'w') as f:
+            f.write('{"version": 1, "serv')
+        self.assertEqual(discovery_snapshot.load_snapshot(app), {})
+
+    @mock.patch.object(discovery_utils, 'read_cached_resources')
+    @mock.patch.object(discovery_utils, 'requests')
+    def test_bootstrap_invalid_resources(self, requests, read_cached):
+        app = mock.Mock()
+        app.config = {}
+        read_cached.return_value = {'cached': {'methods': ['GET']}}
+        for answer in [ValueError('No JSON object could be decoded'), ['/x'], {'/x': {}}]:
+            if isinstance(answer, Exception):
+                requests.get.return_value.json.side_effect = answer
+            else:
+                requests.get.return_value.json.side_effect = None
+                requests.get.return_value.json.return_value = answer
+            self.assertEqual(discovery_utils.fetch_remote_resources('http://a.foo/', app),
+                             {'cached': {'methods': ['GET']}})
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,6 +1,7 @@
 from adsws.testsuite import make_test_suite, \
     run_test_suite, FlaskAppTestCase
 from flask import session
+from adsws import prefork
 import os 
 import inspect
 import tempfile
@@ -71,9 +72,28 @@ class FactoryTestSecretKeyNonHex(FlaskAppTestCase):
     def test_custom_config(self):
         self.assertEqual(self.app.config.get('SECRET_KEY'), 'X73696768')
 
+
+
+class FactoryTestPrefork(FlaskAppTestCase):
+
+    def test_initialize(self):
+        calls = []
+        self.app.before_first_request(lambda: calls.append('setup'))
+        self.app.add_url_rule('/prefork', 'prefork', lambda: 'ok')
+
+        prefork.initialize(self.app)
+        self.assertEqual(calls, ['setup'])
+
+        # the workers do not run the setup again
+        self.assertEqual(self.client.get('/prefork').data, 'ok')
+        self.assertEqual(calls, ['setup'])
+
+        prefork.post_fork(self.app)
+        self.assertEqual(self.client.get('/prefork').data, 'ok')
+
         
 TEST_SUITE = make_test_suite(FactoryTest, FactoryTestCustomInstanceDir, FactoryTestSecretKey,
-                             FactoryTestSecretKeyNonHex)
+                             FactoryTestSecretKeyNonHex, FactoryTestPrefork)
 
 
 if __name__ == "__main__":
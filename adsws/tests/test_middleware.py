@@ -0,0 +1,47 @@
+from unittest import TestCase
+from adsws.middleware import LazyApplication, LazyDispatcherMiddleware
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+import flask
+
+
+class LazyDispatcherTestCase(TestCase):
+    """
+    Tests the dispatcher creating the applications at their first request
+    """
+
+    def setUp(self):
+        self.created = []
+
+    def factory(self, name):
+        def create_app():
+            self.created.append(name)
+            app = flask.Flask(name)
+            app.add_url_rule('/', 'index', lambda: name)
+            return app
+        return create_app
+
+    def test_lazy_dispatch(self):
+        application = LazyDispatcherMiddleware(self.factory('frontend'), {
+            '/v1': self.factory('api'),
+            '/v1/accounts': self.factory('accounts'),
+        })
+        self.assertEqual(self.created, [])
+        client = Client(application, BaseResponse)
+
+        self.assertEqual(client.get('/v1/').data, 'api')
+        self.assertEqual(client.get('/v1/').data, 'api')
+        self.assertEqual(self.created, ['api'])
+        self.assertFalse(application.mounts['/v1/accounts'].created)
+
+        self.assertEqual(client.get('/v1/accounts/').data, 'accounts')
+        self.assertEqual(client.get('/').data, 'frontend')
+        self.assertEqual(self.created, ['api', 'accounts', 'frontend'])
+
+    def test_lazy_application(self):
+        app = LazyApplication(self.factory('api'))
+        self.assertFalse(app.created)
+        # attributes are those of the created app
+        self.assertEqual(app.name, 'api')
+        self.assertEqual([r.rule for r in app.url_map.iter_rules() if r.endpoint == 'index'], ['/'])
+        self.assertEqual(self.created, ['api'])
@@ -0,0 +1,81 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+import flask
+from flask_sqlalchemy import get_debug_queries
+from adsws.ext.sqlalchemy import db, engines, setup_app, ping_connection
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+
+class EngineRegistryTestCase(TestCase):
+    """
+    Tests the engines shared by the apps of the process
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.uri = 'sqlite:///' + os.path.join(self.path, 'adsws.sqlite')
+        engines.clear()
+
+    def tearDown(self):
+        engines.clear()
+        shutil.rmtree(self.path)
+
+    def create_app(self, name, **config):
+        app = flask.Flask(name)
+        app.config.update(SQLALCHEMY_DATABASE_URI=self.uri,
+                          SQLALCHEMY_TRACK_MODIFICATIONS=False, **config)
+        setup_app(app)
+        return app
+
+    def test_shared_engine(self):
+        # sqlite files are not pooled by default
+        engine = engines.get_engine(make_url(self.uri), {
+            'poolclass': QueuePool, 'pool_size': 2, 'max_overflow': 1,
+            'pool_pre_ping': True,
+        })
+        api = self.create_app('api')
+        accounts = self.create_app('accounts')
+        self.assertIs(db.get_engine(api), engine)
+        self.assertIs(db.get_engine(accounts), engine)
+        self.assertTrue(event.contains(engine, "engine_connect", ping_connection))
+
+        connection = engine.connect()
+        status = engines.status()
+        self.assertEqual(status.keys(), [self.uri])
+        self.assertEqual(status[self.uri]['apps'], ['api', 'accounts'])
+        self.assertEqual(status[self.uri]['size'], 2)
+        self.assertEqual(status[self.uri]['max_overflow'], 1)
+        self.assertEqual(status[self.uri]['checked_out'], 1)
+        connection.close()
+        self.assertEqual(engines.status()[self.uri]['checked_out'], 0)
+        self.assertEqual(engines.status()[self.uri]['checked_in'], 1)
+
+        # the sqlite hooks are set up once
+        with api.app_context():
+            db.session.execute('SELECT 1')
+            db.session.commit()
+        with accounts.app_context():
+            db.session.execute('SELECT 1')
+            db.session.commit()
+
+    def test_record_queries(self):
+        api = self.create_app('api', SQLALCHEMY_RECORD_QUERIES=True)
+        accounts = self.create_app('accounts', SQLALCHEMY_RECORD_QUERIES=True)
+        self.assertIs(db.get_engine(api), db.get_engine(accounts))
+        # recorded once, for the app running the query
+        for app in (api, accounts):
+            with app.app_context():
+                db.get_engine(app).execute('SELECT 1')
+                self.assertEqual(len(get_debug_queries()), 1)
+
+    def test_in_memory_database(self):
+        self.uri = 'sqlite://'
+        api = self.create_app('api')
+        accounts = self.create_app('accounts')
+        self.assertIsNot(db.get_engine(api), db.get_engine(accounts))
+        self.assertEqual(engines.status(), {})
@@ -0,0 +1,77 @@
+from unittest import TestCase
+from adsws.testsuite import make_test_suite, run_test_suite
+from adsws.startup import StartupProfile, check_budget, profile
+from adsws.factory import create_app
+import threading
+import time
+
+
+class StartupProfileTestCase(TestCase):
+    """
+    Tests the recording of the startup phases
+    """
+
+    def test_phases(self):
+        p = StartupProfile()
+        with p.phase('app'):
+            with p.phase('load_config'):
+                time.sleep(0.01)
+            for _ in range(2):
+                with p.phase('discover'):
+                    time.sleep(0.01)
+        self.assertEqual(list(p.totals()), ['app', 'app > load_config', 'app > discover'])
+        self.assertGreaterEqual(p.totals()['app > discover'], 0.02)
+        self.assertGreaterEqual(p.totals()['app'], 0.03)
+        self.assertIn('    discover', p.report())
+
+        p.reset()
+        self.assertEqual(p.totals(), {})
+
+    def test_threads(self):
+        p = StartupProfile()
+
+        def create_app(name):
+            with p.phase(name):
+                with p.phase('load_config'):
+                    time.sleep(0.01)
+
+        # e.g. lazily mounted apps created by concurrent requests
+        with p.phase('adsws.api'):
+            thread = threading.Thread(target=create_app, args=('adsws.accounts',))
+            thread.start()
+            thread.join()
+        self.assertEqual(sorted(p.totals()), ['adsws.accounts', 'adsws.accounts > load_config', 'adsws.api'])
+
+    def test_budget(self):
+        totals = {'total': 3.0, 'app > load_config': 1.5, 'app > discover': 0.5}
+        self.assertEqual(check_budget(totals, {'total': 5, 'load_config': 1}),
+                         [('app > load_config', 1.5, 1)])
+        # a full name takes precedence
+        self.assertEqual(check_budget(totals, {'load_config': 1, 'app > load_config': 2}), [])
+
+
+class StartupBudgetTestCase(TestCase):
+    """
+    Startup regressions of the factory
+    """
+
+    BUDGET = {
+        'adsws': 10,
+        'load_config': 1,
+    }
+
+    def test_factory_budget(self):
+        profile.reset()
+        create_app(SQLALCHEMY_DATABASE_URI='sqlite://')
+        totals = profile.totals()
+        for phase in ['load_config', 'Registry', 'ExtensionRegistry',
+                      'BlueprintAutoDiscoveryRegistry', 'ConfigurationRegistry']:
+            self.assertIn('adsws > ' + phase, totals)
+        self.assertEqual(check_budget(totals, self.BUDGET), [])
+
+
+TEST_SUITE = make_test_suite(StartupProfileTestCase, StartupBudgetTestCase)
+
+
+if __name__ == "__main__":
+    run_test_suite(TEST_SUITE)
@@ -12,6 +12,20 @@ TESTING = False
 # e.g. if you have 'sqlite:///adsws.sqlite' then the
 # db will be saved at adsws/api/adsws.sqlite
 SQLALCHEMY_DATABASE_URI = 'sqlite://'
+# when True, every response reports the number of SQL statements
+# issued while serving it (X-Adsws-Sql-Statements header)
+SQLALCHEMY_COUNT_STATEMENTS = False
+# the apps of a process share one engine (connection pool) per database;
+# it is set up by the first app connecting. None leaves the SQLAlchemy
+# defaults: 5 connections kept, 10 more allowed, never recycled
+SQLALCHEMY_POOL_SIZE = None
+SQLALCHEMY_MAX_OVERFLOW = None
+# seconds after which a connection is replaced (e.g. below the idle timeout
+# of PgBouncer)
+SQLALCHEMY_POOL_RECYCLE = None
+# when True, the connections are checked (SELECT 1) before being used and
+# reopened if the database dropped them
+SQLALCHEMY_POOL_PRE_PING = False
 SITE_SECURE_URL = 'http://0.0.0.0:5000'
 
 # Flask session config (http://flask.pocoo.org/docs/0.12/config/)
@@ -21,3 +35,12 @@ SESSION_REFRESH_EACH_REQUEST = True
 REQUESTS_POOL_CONNECTIONS=20
 REQUESTS_POOL_MAXSIZE=1000
 REQUESTS_MAX_RETRIES=1
+
+# Sub-applications mounted by wsgi.py (names among api, accounts, feedback,
+# benchmark), e.g. ['api'] for the API-only pods; None mounts them all.
+# Can be overridden by the WSGI_MOUNTS environment variable (comma separated)
+WSGI_MOUNTS = None
+# when True, each sub-application is created by the first request it gets
+# (in every worker) instead of when wsgi.py is imported (then initialized
+# before forking); env WSGI_LAZY_MOUNTS=1
+WSGI_LAZY_MOUNTS = False
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""
+    gunicorn configuration
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+
+    The applications are created once, by the master importing wsgi.py
+    (preload_app), and initialized before forking (see adsws.prefork);
+    every worker then drops what it must not share with the master.
+"""
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+preload_app = True
+
+
+def post_fork(server, worker):
+    # the database connections opened by the master
+    import wsgi
+    wsgi.post_fork()
@@ -7,13 +7,21 @@
 """
 
 import os
+import sys
+import json
+import tempfile
+import subprocess
+from collections import OrderedDict
+
 import flask
 from flask.ext.script import Manager
 from adsws.accounts.manage import accounts_manager
+from adsws.api.manage import api_manager
 
 manager = Manager(flask.Flask('manager'))
 
 manager.add_command("accounts", accounts_manager)
+manager.add_command("api", api_manager)
 
 @manager.command
 def generate_secret_key():
@@ -24,6 +32,40 @@ def generate_secret_key():
     print "\nSECRET_KEY = '{0}'\n".format(key.encode('hex'))
 
 
+@manager.command
+def profile_startup(budget=None):
+    """
+    Reports the wall time of the startup phases of the wsgi applications
+    (imports, load_config, registries, discover, bootstrap of every
+    service...), measured in a fresh interpreter, and checks them against
+    a budget
+
+    :param budget: JSON {phase: seconds} replacing the default budget of
+        adsws.startup; a phase name also applies to the phases it ends
+        (e.g. "load_config")
+    :return: 1 if a phase is over budget, 0 otherwise
+    """
+    from adsws.startup import profile, check_budget
+
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        subprocess.check_call(
+            [sys.executable, '-m', 'adsws.startup', path],
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        with open(path) as f:
+            totals = json.load(f, object_pairs_hook=OrderedDict)
+    finally:
+        os.unlink(path)
+
+    print profile.report(totals)
+    overruns = check_budget(totals, json.loads(budget) if budget else None)
+    for name, seconds, limit in overruns:
+        print "Over budget: {0} took {1:.3f}s (budget {2}s)".format(name, seconds, limit)
+    return 1 if overruns else 0
+
+
 @manager.shell
 def make_shell_context():
     from wsgi import application, API, ACCOUNTS
@@ -0,0 +1,131 @@
+"""
+Measures the per-request overhead of the stages wrapped around a discovered
+view: the former stack of nested decorators (headers, require_oauth,
+affinity, shared_limit_and_check) against the RoutePipeline that replaced
+it (see adsws/api/discoverer/pipeline.py).
+
+The view itself does nothing, the token verification is replaced by a
+constant answer and the ratelimit/affinity storages live in memory, so that
+only the cost of going through the stages is measured.
+
+Usage:
+
+    python scripts/benchmark_pipeline.py --requests 20000
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask, request
+from flask.ext.headers import headers
+
+from adsws.modules.oauth2server.provider import oauth2
+from adsws.ext.ratelimiter import ratelimit, limit_func, scope_func, key_func
+from adsws.api.discoverer.affinity import affinity_decorator
+from adsws.api.discoverer.pipeline import RoutePipeline, HeadersStage, \
+    OAuthStage, RateLimitStage, AffinityStage
+
+
+class MemoryStorage(dict):
+    """ Affinity route storage """
+
+    def setex(self, key, value, seconds):
+        self[key] = value
+
+
+class VerifiedRequest(object):
+    """ What the token verification hands to the view (request.oauth) """
+    user = None
+    client = None
+    scopes = ['user']
+
+
+def nested_view():
+    return '{}', 200, {'Content-Type': 'application/json'}
+
+
+def pipeline_view():
+    return '{}', 200, {'Content-Type': 'application/json'}
+
+
+def bare_view():
+    return '{}', 200, {'Content-Type': 'application/json'}
+
+
+def create_app(requests_count):
+    app = Flask('benchmark_pipeline')
+    app.config.update(
+        RATELIMIT_STORAGE_URL='memory://',
+        API_PROXYVIEW_HEADERS={'Cache-Control': 'public, max-age=600'},
+    )
+    ratelimit.init_app(app)
+    app.extensions['symbolic_ratelimits'] = {}
+    storage = MemoryStorage()
+    limit = lambda counts=requests_count * 10, per_second=86400: limit_func(counts, per_second)
+
+    # what bootstrap_remote_service used to build
+    view = ratelimit.shared_limit_and_check(
+        limit, scope=scope_func, key_func=key_func, methods=['GET'],
+        per_method=False
+    )(nested_view)
+    view = affinity_decorator(storage, name='sroute')(view)
+    view = oauth2.require_oauth('user')(view)
+    view = headers(app.config['API_PROXYVIEW_HEADERS'])(view)
+    app.add_url_rule('/nested', '/nested', view)
+
+    # what it builds now
+    ratelimit.register_limit(
+        pipeline_view, limit, shared=True, scope=scope_func,
+        key_func=key_func, methods=['GET'], per_method=False
+    )
+    view = RoutePipeline(pipeline_view, [
+        HeadersStage(app.config['API_PROXYVIEW_HEADERS']),
+        OAuthStage(['user']),
+        AffinityStage(storage, name='sroute'),
+        RateLimitStage(),
+    ])
+    app.add_url_rule('/pipeline', '/pipeline', view)
+
+    # nothing but turning the view's return value into a response, as
+    # the headers stage does
+    app.add_url_rule('/bare', '/bare', lambda: app.make_response(bare_view()))
+    return app
+
+
+def measure(app, route, requests_count):
+    """
+    Seconds per call of the view of the route, within one request context
+    """
+    view = app.view_functions[route]
+    headers = {'Authorization': 'Bearer ' + 'x' * 40}
+    with app.test_request_context(route, headers=headers):
+        start = time.time()
+        for _ in xrange(requests_count):
+            # every request verifies its token
+            request.oauth = None
+            view()
+        return (time.time() - start) / requests_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=20000)
+    args = parser.parse_args()
+
+    oauth2.verify_request = lambda scopes: (True, VerifiedRequest())
+    app = create_app(args.requests)
+
+    bare = measure(app, '/bare', args.requests)
+    print('{0:>10} {1:>14} {2:>14}'.format('', 'us/request', 'overhead (us)'))
+    for route in ('/nested', '/pipeline'):
+        per_request = measure(app, route, args.requests)
+        print('{0:>10} {1:>14.1f} {2:>14.1f}'.format(
+            route[1:], per_request * 1e6, (per_request - bare) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
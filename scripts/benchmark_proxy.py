@@ -0,0 +1,212 @@
+"""
+Compares the throughput of the proxy engines (see REMOTE_PROXY_ENGINE in
+adsws/api/config.py) in front of a slow remote service.
+
+A fake remote service answers every request after --delay seconds. For each
+engine, a proxy process serves one remote route:
+
+    - sync: ProxyView served by --workers threads, i.e. as many requests
+      in flight as there are sync workers
+    - gevent: GeventProxyView served by one monkey patched gevent server,
+      i.e. a single gunicorn -k gevent worker
+
+--requests requests are then sent, --concurrency at a time, and the
+throughput and latencies are reported.
+
+Usage (gevent has to be installed):
+
+    python scripts/benchmark_proxy.py --delay 0.5 --concurrency 200
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def serve_upstream(port, delay):
+    """
+    Remote service answering after `delay` seconds
+    """
+    from gevent import monkey
+    monkey.patch_all()
+    from gevent.pywsgi import WSGIServer
+
+    def application(environ, start_response):
+        time.sleep(delay)
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps({'path': environ['PATH_INFO']})]
+
+    WSGIServer(('127.0.0.1', port), application, log=None,
+               backlog=1024).serve_forever()
+
+
+def serve_proxy(engine, port, upstream_port, workers):
+    """
+    Proxy of the remote service /slow route, at /proxy/slow
+    """
+    if engine == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+
+    from flask import Flask
+    from flask.ext.login import LoginManager
+    from adsws.api.discoverer.views import ProxyView, GeventProxyView
+
+    app = Flask('benchmark_proxy')
+    app.config.update(
+        SECRET_KEY='benchmark',
+        REMOTE_PROXY_ALLOWED_HEADERS=['Content-Type'],
+        DEFAULT_REQUEST_TIMEOUT=60,
+    )
+    LoginManager(app)
+
+    service_uri = 'http://127.0.0.1:{0}/'.format(upstream_port)
+    proxyview_class = GeventProxyView if engine == 'gevent' else ProxyView
+    with app.app_context():
+        proxyview = proxyview_class(service_uri + 'slow', service_uri,
+                                    '/proxy', '/proxy/slow')
+    app.add_url_rule('/proxy/slow', 'slow', proxyview.dispatcher)
+
+    if engine == 'gevent':
+        from gevent.pywsgi import WSGIServer
+        WSGIServer(('127.0.0.1', port), app, log=None,
+                   backlog=1024).serve_forever()
+    else:
+        from multiprocessing.pool import ThreadPool
+        from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_message(self, *args):
+                pass
+
+        class ThreadPoolServer(WSGIServer):
+            """ Handles the requests with a fixed number of threads """
+            request_queue_size = 1024
+            pool = ThreadPool(workers)
+
+            def process_request(self, request, client_address):
+                self.pool.apply_async(self.process_request_thread,
+                                      (request, client_address))
+
+            def process_request_thread(self, request, client_address):
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                finally:
+                    self.shutdown_request(request)
+
+        server = ThreadPoolServer(('127.0.0.1', port), QuietHandler)
+        server.set_app(app)
+        server.serve_forever()
+
+
+def wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('Nothing is listening on port {0}'.format(port))
+
+
+def spawn(*args):
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__)] + [str(a) for a in args]
+    )
+    return process
+
+
+def load(url, requests_count, concurrency):
+    """
+    Sends the requests; returns the elapsed time, the latencies of the
+    successful requests and the number of failures
+    """
+    import requests
+    from multiprocessing.pool import ThreadPool
+
+    def call(_):
+        start = time.time()
+        try:
+            ok = requests.get(url, timeout=120).status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        return ok, time.time() - start
+
+    pool = ThreadPool(concurrency)
+    start = time.time()
+    results = pool.map(call, range(requests_count), chunksize=1)
+    elapsed = time.time() - start
+    pool.close()
+    latencies = sorted(t for ok, t in results if ok)
+    return elapsed, latencies, len(results) - len(latencies)
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--engine', choices=['sync', 'gevent', 'both'],
+                        default='both')
+    parser.add_argument('--delay', type=float, default=0.5,
+                        help='response time of the remote service (s)')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=8,
+                        help='threads of the sync engine')
+    parser.add_argument('--port', type=int, default=5110)
+    parser.add_argument('--serve-upstream', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--serve-proxy', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    upstream_port, proxy_port = args.port, args.port + 1
+    if args.serve_upstream:
+        return serve_upstream(upstream_port, args.delay)
+    if args.serve_proxy:
+        return serve_proxy(args.serve_proxy, proxy_port, upstream_port,
+                           args.workers)
+
+    engines = ['sync', 'gevent'] if args.engine == 'both' else [args.engine]
+    upstream = spawn('--serve-upstream', '--port', args.port,
+                     '--delay', args.delay)
+    try:
+        wait_for(upstream_port)
+        print('{0} requests, {1} concurrent, remote service delay {2}s'
+              .format(args.requests, args.concurrency, args.delay))
+        print('{0:>8} {1:>8} {2:>8} {3:>8} {4:>8} {5:>8}'.format(
+            'engine', 'req/s', 'p50 (s)', 'p99 (s)', 'errors', 'time (s)'))
+        for engine in engines:
+            proxy = spawn('--serve-proxy', engine, '--port', args.port,
+                          '--workers', args.workers)
+            try:
+                wait_for(proxy_port)
+                elapsed, latencies, errors = load(
+                    'http://127.0.0.1:{0}/proxy/slow'.format(proxy_port),
+                    args.requests, args.concurrency)
+            finally:
+                proxy.kill()
+                proxy.wait()
+            print('{0:>8} {1:>8.1f} {2:>8.3f} {3:>8.3f} {4:>8} {5:>8.1f}'
+                  .format(engine, len(latencies) / elapsed,
+                          percentile(latencies, 0.5),
+                          percentile(latencies, 0.99), errors, elapsed))
+    finally:
+        upstream.kill()
+        upstream.wait()
+
+
+if __name__ == '__main__':
+    main()
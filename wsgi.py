@@ -5,6 +5,9 @@
 
     adsws wsgi module
 """
+import os
+
+from flask import Config
 from werkzeug.serving import run_simple
 from werkzeug.wsgi import DispatcherMiddleware
 
@@ -13,6 +16,26 @@ from adsws import accounts
 from adsws import api
 from adsws import frontend
 from adsws import benchmark
+from adsws import prefork
+from adsws.middleware import LazyDispatcherMiddleware
+
+PROJ_HOME = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_config():
+    """
+    The WSGI_* settings: config.py, instance/local_config.py, then the
+    environment
+    """
+    config = Config(PROJ_HOME)
+    config.from_pyfile('config.py', silent=True)
+    config.from_pyfile(os.path.join('instance', 'local_config.py'), silent=True)
+    if os.environ.get('WSGI_MOUNTS'):
+        config['WSGI_MOUNTS'] = [name.strip() for name in os.environ['WSGI_MOUNTS'].split(',')]
+    if os.environ.get('WSGI_LAZY_MOUNTS'):
+        config['WSGI_LAZY_MOUNTS'] = os.environ['WSGI_LAZY_MOUNTS'].lower() in ('1', 'true', 'yes')
+    return config
+
 
 def get_resources(*apps):
     r = {}
@@ -26,19 +49,71 @@ def get_resources(*apps):
             r[app.name]['endpoints'].append(rule.rule)
     return r
 
-API = dict(mount='/v1', app=api.create_app())
-ACCOUNTS = dict(mount='/v1/accounts', app=accounts.create_app())
-FEEDBACK = dict(mount='/v1/feedback', app=feedback.create_app())
-BENCHMARK = dict(mount='/benchmark', app=benchmark.create_app())
 
-resources = get_resources(API, ACCOUNTS, FEEDBACK)
+CONFIG = load_config()
+LAZY = CONFIG.get('WSGI_LAZY_MOUNTS', False)
+MOUNTS = CONFIG.get('WSGI_MOUNTS') or ['api', 'accounts', 'feedback', 'benchmark']
+
+
+def mount(name, path, factory):
+    """
+    Container of a sub-application, None if this deployment does not mount
+    it; lazily, the app is created by the dispatcher (see below)
+    """
+    if name not in MOUNTS:
+        return None
+    return dict(mount=path, app=factory if LAZY else factory())
+
+
+API = mount('api', '/v1', api.create_app)
+ACCOUNTS = mount('accounts', '/v1/accounts', accounts.create_app)
+FEEDBACK = mount('feedback', '/v1/feedback', feedback.create_app)
+BENCHMARK = mount('benchmark', '/benchmark', benchmark.create_app)
+SUBAPPS = [c for c in [API, ACCOUNTS, FEEDBACK, BENCHMARK] if c is not None]
+
+
+def create_frontend():
+    # the frontend lists the resources of the mounted apps; lazily, those
+    # of the apps this worker created so far, when they are requested (the
+    # health checks of the frontend must not create the other apps)
+    listed = [c for c in [API, ACCOUNTS, FEEDBACK] if c is not None]
+    if LAZY:
+        resources = lambda: get_resources(*[c for c in listed if c['app'].created])
+    else:
+        resources = get_resources(*listed)
+    return frontend.create_app(resources=resources)
+
+
+if LAZY:
+    application = LazyDispatcherMiddleware(
+        create_frontend,
+        dict((c['mount'], c['app']) for c in SUBAPPS)
+    )
+    # from now on, the containers hold the (lazy) apps of the dispatcher
+    for c in SUBAPPS:
+        c['app'] = application.mounts[c['mount']]
+    FRONTEND = dict(mount='/', app=application.app)
+    # nothing is created before forking
+    APPS = []
+else:
+    FRONTEND = dict(mount='/', app=create_frontend())
+    application = DispatcherMiddleware(
+        FRONTEND['app'],
+        dict((c['mount'], c['app']) for c in SUBAPPS)
+    )
+    APPS = [FRONTEND['app']] + [c['app'] for c in SUBAPPS]
+
+# Pre-fork initialization: done once here (in the master of a preloading
+# server) rather than at the first request of every worker
+prefork.initialize(*APPS)
+
 
-application = DispatcherMiddleware(frontend.create_app(resources=resources), {
-    API['mount']: API['app'],
-    ACCOUNTS['mount']: ACCOUNTS['app'],
-    FEEDBACK['mount']: FEEDBACK['app'],
-    BENCHMARK['mount']: BENCHMARK['app'],
-})
+def post_fork():
+    """
+    To be called by every worker forked from a process having imported
+    this module (see adsws.prefork)
+    """
+    prefork.post_fork(*APPS)
 
 if __name__ == "__main__":
     run_simple('0.0.0.0', 5000, application, use_reloader=False, use_debugger=True)